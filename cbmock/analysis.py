@@ -0,0 +1,239 @@
+import re
+import json
+
+
+_function_re = re.compile(r"^\s*function\s*[\w$]*\s*\(([^)]*)\)\s*\{", re.S)
+_dynamic_re = re.compile(r"(?<![\w$.])(arguments|eval|with|Function)(?![\w$])")
+_member_re = re.compile(r"""\s*(?:\.\s*([A-Za-z_$][\w$]*)|\[\s*(?:"([^"\\]*)"|'([^'\\]*)')\s*\])""")
+
+
+def map_arguments(map_func):
+    """
+    returns the parameter names of a map function, or None if it doesn't look like one.
+    """
+    match = _function_re.match(map_func or "")
+    if not match:
+        return None
+    return [arg.strip() for arg in match.group(1).split(",") if arg.strip()]
+
+
+def argument_paths(map_func, position=0):
+    """
+    returns the set of member paths (tuples of names) read off one of the map function's
+    arguments, e.g. doc.address.city -> ("address", "city").
+
+    this is a conservative look at the source rather than a parse: None is returned when
+    the argument is used in any way that can't be followed (passed to a function, assigned,
+    indexed with a variable) so callers must treat None as "reads everything".
+    """
+    args = map_arguments(map_func)
+    if args is None or _dynamic_re.search(map_func):
+        return None
+    if position >= len(args):
+        return set()
+    name = args[position]
+    body = map_func[_function_re.match(map_func).end():]
+    paths = set()
+    for match in re.finditer(r"(?<![\w$.])" + re.escape(name) + r"(?![\w$])", body):
+        path = list()
+        end = match.end()
+        member = _member_re.match(body, end)
+        while member:
+            path.append(member.group(1) or member.group(2) or member.group(3) or "")
+            end = member.end()
+            member = _member_re.match(body, end)
+        if not path:
+            return None
+        if body[end:].lstrip().startswith("("):
+            # doc.name.toUpperCase() reads doc.name
+            path.pop()
+        paths.add(tuple(path))
+    return paths
+
+
+def project(doc, paths):
+    """
+    serializes the values a set of paths reads from a document, so two versions of a
+    document can be compared for what a map function would see. a path stops at the
+    first value that isn't an object and takes all of it.
+    """
+    values = list()
+    for path in paths:
+        value = doc
+        present = True
+        for part in path:
+            if not isinstance(value, dict):
+                break
+            if part not in value:
+                present = False
+                break
+            value = value[part]
+        values.append([1, value] if present else [0])
+    return json.dumps(values, sort_keys=True)
+
+
+_token_re = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(?:\s+|//[^\n]*|/\*.*?\*/)+""", re.S)
+
+
+def normalize_source(source):
+    """
+    drops comments and whitespace that doesn't separate two words, leaving string literals
+    alone, so copies of a function that only differ in formatting compare equal.
+    """
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        before = source[match.start() - 1:match.start()]
+        after = source[match.end():match.end() + 1]
+        if re.match(r"[\w$]", before) and re.match(r"[\w$]", after):
+            return " "
+        if before and after and before in "+-/" and after in "+-/":
+            # a - -b isn't a--b
+            return " "
+        return ""
+    return _token_re.sub(replace, source or "").strip()
+
+
+def _skip_literal(source, position):
+    """
+    returns the position after a string literal or comment starting at position, or None.
+    """
+    char = source[position]
+    if char in "\"'":
+        position += 1
+        while position < len(source) and source[position] != char:
+            position += 2 if source[position] == "\\" else 1
+        return position + 1
+    if source.startswith("//", position):
+        end = source.find("\n", position)
+        return len(source) if end == -1 else end
+    if source.startswith("/*", position):
+        end = source.find("*/", position)
+        return len(source) if end == -1 else end + 2
+    return None
+
+
+def _matching(source, position):
+    """
+    position is an opening bracket, returns the position of its closing bracket or None.
+    """
+    opening = source[position]
+    closing = {"(": ")", "{": "}", "[": "]"}[opening]
+    depth = 0
+    while position < len(source):
+        skipped = _skip_literal(source, position)
+        if skipped is not None:
+            position = skipped
+            continue
+        if source[position] == opening:
+            depth += 1
+        elif source[position] == closing:
+            depth -= 1
+            if depth == 0:
+                return position
+        position += 1
+    return None
+
+
+def _split(condition, operator):
+    """
+    splits a condition on an operator outside of any brackets or strings.
+    """
+    parts = list()
+    start = position = 0
+    while position < len(condition):
+        skipped = _skip_literal(condition, position)
+        if skipped is not None:
+            position = skipped
+        elif condition[position] in "([{":
+            end = _matching(condition, position)
+            if end is None:
+                return None
+            position = end + 1
+        elif condition.startswith(operator, position):
+            parts.append(condition[start:position])
+            start = position = position + len(operator)
+        else:
+            position += 1
+    parts.append(condition[start:])
+    return [part.strip() for part in parts]
+
+
+def _unwrap(condition):
+    while condition.startswith("(") and _matching(condition, 0) == len(condition) - 1:
+        condition = condition[1:-1].strip()
+    return condition
+
+
+_literal = r"""("[^"\\]*"|'[^'\\]*')"""
+
+
+def _guard(condition, doc, meta, negated):
+    """
+    turns doc.type == "x" or meta.id.indexOf("x::") === 0 (or their negations when
+    negated) into a filter.
+    """
+    condition = _unwrap(condition)
+    equals = r"!==?" if negated else r"===?"
+    field = r"{0}((?:\.[A-Za-z_$][\w$]*)+)".format(re.escape(doc))
+    for pattern in (r"^{0}\s*{1}\s*{2}$".format(field, equals, _literal),
+                    r"^{2}\s*{1}\s*{0}$".format(field, equals, _literal)):
+        match = re.match(pattern, condition)
+        if match:
+            groups = [group for group in match.groups()]
+            path, literal = (groups[0], groups[1]) if groups[0].startswith(".") else (groups[1], groups[0])
+            return {"field": path[1:], "value": literal[1:-1]}
+    if meta:
+        key = r"{0}\s*\.\s*id".format(re.escape(meta))
+        patterns = [r"^{0}\.indexOf\({1}\)\s*{2}\s*0$".format(key, _literal, equals)]
+        if negated:
+            patterns.append(r"^!\s*{0}\.startsWith\({1}\)$".format(key, _literal))
+        else:
+            patterns.append(r"^{0}\.startsWith\({1}\)$".format(key, _literal))
+        for pattern in patterns:
+            match = re.match(pattern, condition)
+            if match:
+                return {"key_prefix": match.group(1)[1:-1]}
+    return None
+
+
+def infer_filter(map_func):
+    """
+    recognizes map functions guarded as a whole by a document type or key prefix check:
+
+        function (doc, meta) { if (doc.type == "order") { ... } }
+        function (doc, meta) { if (meta.id.indexOf("order::") !== 0) return; ... }
+
+    and returns the guard as a filter dict, or None.
+    """
+    args = map_arguments(map_func)
+    if not args:
+        return None
+    doc = args[0]
+    meta = args[1] if len(args) > 1 else None
+    source = map_func.strip()
+    start = _function_re.match(source).end() - 1
+    end = _matching(source, start)
+    if end is None:
+        return None
+    body = _token_re.sub(lambda match: match.group(1) or " ", source[start + 1:end]).strip()
+    match = re.match(r"if\s*\(", body)
+    if not match:
+        return None
+    condition_end = _matching(body, match.end() - 1)
+    if condition_end is None:
+        return None
+    condition = body[match.end():condition_end].strip()
+    rest = body[condition_end + 1:].strip()
+    early_return = re.match(r"(?:return\b|\{\s*return\s*;?\s*\})", rest)
+    if early_return:
+        conditions, negated = _split(condition, "||"), True
+    elif rest.startswith("{") and _matching(rest, 0) == len(rest.rstrip(";").rstrip()) - 1:
+        conditions, negated = _split(condition, "&&"), False
+    else:
+        return None
+    for part in conditions or ():
+        guard = _guard(part, doc, meta, negated)
+        if guard:
+            return guard
+    return None
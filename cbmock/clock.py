@@ -0,0 +1,36 @@
+import threading
+import time
+
+
+class CBMockClock(object):
+    """
+    The time document TTLs and lock timeouts go by, the system's by default.
+    """
+
+    def time(self):
+        return time.time()
+
+
+class CBMockManualClock(CBMockClock):
+    """
+    A clock that only moves when told to, so tests can expire TTLs and locks without
+    sleeping:
+
+        clock = CBMockManualClock()
+        connection = MockCouchbaseConnection(clock=clock)
+        connection.lock("key", ttl=15)
+        clock.advance(15)
+    """
+
+    def __init__(self, now=None):
+        # starts at the current time so TTLs given as unix times mean the same thing
+        self.now = time.time() if now is None else now
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        with self._lock:
+            self.now += seconds
+            return self.now
@@ -0,0 +1,296 @@
+import threading
+from cbmock.views import CBMockDirtySet, parse_document
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMBER = "number"
+STRING = "string"
+
+
+def _field_value(doc, path):
+    for part in path:
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _native(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+class CBMockColumn(object):
+    """
+    One field of a snapshot. number columns are float64 with NaN for anything that isn't a
+    number, string columns are int32 codes into a dictionary of the distinct strings with
+    -1 for anything that isn't a string.
+    """
+
+    def __init__(self, field, kind, values):
+        self.field = field
+        self.path = tuple(field.split("."))
+        self.kind = kind
+        self.dictionary = list()
+        self.codes = dict()
+        if kind == NUMBER:
+            self.data = numpy.array([value if _is_number(value) else numpy.nan for value in values],
+                                    dtype=numpy.float64)
+        else:
+            self.data = numpy.array([self.encode(value) for value in values], dtype=numpy.int32)
+
+    def encode(self, value):
+        if not isinstance(value, basestring):
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.dictionary)
+            self.dictionary.append(value)
+        return code
+
+    def store(self, row, value):
+        if self.kind == NUMBER:
+            self.data[row] = value if _is_number(value) else numpy.nan
+        else:
+            self.data[row] = self.encode(value)
+
+    def grow(self, capacity):
+        missing = numpy.nan if self.kind == NUMBER else -1
+        data = numpy.empty(capacity, dtype=self.data.dtype)
+        data[:len(self.data)] = self.data
+        data[len(self.data):] = missing
+        self.data = data
+
+    def present(self, size):
+        if self.kind == NUMBER:
+            return ~numpy.isnan(self.data[:size])
+        return self.data[:size] >= 0
+
+    def matches(self, size, value):
+        if self.kind == NUMBER:
+            if not _is_number(value):
+                return numpy.zeros(size, dtype=bool)
+            return self.data[:size] == value
+        code = self.codes.get(value) if isinstance(value, basestring) else None
+        if code is None:
+            return numpy.zeros(size, dtype=bool)
+        return self.data[:size] == code
+
+    def groups(self, rows):
+        """
+        returns (group number of each row, value of each group), rows where the field is
+        missing are grouped under None.
+        """
+        data = self.data[rows]
+        if self.kind == NUMBER:
+            missing = numpy.isnan(data)
+            values, inverse = numpy.unique(data[~missing], return_inverse=True)
+            groups = numpy.empty(len(data), dtype=numpy.int64)
+            groups[~missing] = inverse
+            groups[missing] = len(values)
+            return groups, [_native(value) for value in values] + [None]
+        codes, inverse = numpy.unique(data, return_inverse=True)
+        return inverse, [self.dictionary[code] if code >= 0 else None for code in codes]
+
+    def ranks(self):
+        """
+        the sort position of every dictionary entry, so strings can be compared by code.
+        """
+        order = sorted(range(len(self.dictionary)), key=self.dictionary.__getitem__)
+        ranks = numpy.empty(len(order), dtype=numpy.int64)
+        ranks[order] = numpy.arange(len(order))
+        return ranks
+
+
+class CBMockColumnarSnapshot(object):
+    """
+    Some fields of every JSON document copied into numpy columns, for aggregations over
+    the whole bucket without touching the documents.
+
+    Like the view indexes, writes only mark keys dirty and the snapshot catches up on them
+    before every aggregation, so it never goes through the whole bucket again.
+    """
+
+    def __init__(self, connection, fields):
+        if numpy is None:
+            raise ImportError("columnar snapshots need numpy, pip install py-mock-couchbase[columnar]")
+        self.connection = connection
+        if isinstance(fields, dict):
+            self.kinds = dict(fields)
+        else:
+            self.kinds = dict.fromkeys(fields)
+        self._lock = threading.RLock()
+        self.built = False
+        self.dirty = CBMockDirtySet()
+
+    def _build(self):
+        """
+        copies a snapshot of the bucket, writes made after it are marked dirty.
+        """
+        ids = list()
+        docs = list()
+        with self.connection.data.snapshot() as documents:
+            for doc_id, value in documents.iteritems():
+                doc, ok = parse_document(value)
+                if ok:
+                    ids.append(doc_id)
+                    docs.append(doc)
+        self.ids = ids
+        self.rows = dict((doc_id, row) for row, doc_id in enumerate(ids))
+        self.size = len(ids)
+        self.free = list()
+        self.alive = numpy.ones(self.size, dtype=bool)
+        self.columns = dict()
+        for field, kind in self.kinds.iteritems():
+            path = tuple(field.split("."))
+            values = [_field_value(doc, path) for doc in docs]
+            if kind is None:
+                # the type of the first value decides
+                first = next((value for value in values if value is not None), None)
+                kind = STRING if isinstance(first, basestring) else NUMBER
+            if kind not in (NUMBER, STRING):
+                raise Exception("invalid column type")
+            self.columns[field] = CBMockColumn(field, kind, values)
+
+    def mark_dirty(self, doc_id, document=None):
+        self.dirty.add(doc_id)
+
+    def refresh(self, keys=None):
+        with self._lock:
+            if not self.built:
+                self._build()
+                self.built = True
+            dirty = self.dirty.take(keys)
+            data = self.connection.data
+            for doc_id in dirty:
+                value = data.get(doc_id)
+                doc, ok = parse_document(value) if value is not None else (None, False)
+                self._store(doc_id, doc if ok else None)
+
+    def _store(self, doc_id, doc):
+        row = self.rows.get(doc_id)
+        if doc is None:
+            if row is not None:
+                del self.rows[doc_id]
+                self.alive[row] = False
+                self.free.append(row)
+            return
+        if row is None:
+            row = self._allocate(doc_id)
+        for column in self.columns.itervalues():
+            column.store(row, _field_value(doc, column.path))
+
+    def _allocate(self, doc_id):
+        if self.free:
+            row = self.free.pop()
+            self.ids[row] = doc_id
+        else:
+            row = self.size
+            self.size += 1
+            self.ids.append(doc_id)
+            if row >= len(self.alive):
+                capacity = max(16, len(self.alive) * 2)
+                alive = numpy.zeros(capacity, dtype=bool)
+                alive[:len(self.alive)] = self.alive
+                self.alive = alive
+                for column in self.columns.itervalues():
+                    column.grow(capacity)
+        self.alive[row] = True
+        self.rows[doc_id] = row
+        return row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def close(self):
+        if self in self.connection.columnar_snapshots:
+            self.connection.columnar_snapshots.remove(self)
+
+    def aggregate(self, aggregates, group_by=None, where=None):
+        """
+        aggregates maps result names to (function, field) with function one of count, sum,
+        avg, min and max, ("count", None) counts rows. where is a dict of field: value
+        equality conditions. returns a list of dicts, one per group of the group_by field(s)
+        sorted by group, or a single dict when there is no group_by.
+
+            snapshot.aggregate({"orders": ("count", None), "total": ("sum", "amount")},
+                               group_by="status", where={"type": "order"})
+        """
+        self.connection.reap_expired()
+        self.refresh()
+        with self._lock:
+            size = self.size
+            mask = self.alive[:size].copy()
+            for field, value in (where or dict()).iteritems():
+                mask &= self._column(field).matches(size, value)
+            rows = numpy.flatnonzero(mask)
+            if isinstance(group_by, basestring):
+                group_by = [group_by]
+            group_by = list(group_by or [])
+            groups = numpy.zeros(len(rows), dtype=numpy.int64)
+            group_values = list()
+            for field in group_by:
+                field_groups, values = self._column(field).groups(rows)
+                groups = groups * len(values) + field_groups
+                group_values.append(values)
+            used, groups = numpy.unique(groups, return_inverse=True)
+            count = len(used) if group_by else 1
+            results = [dict() for position in range(count)]
+            for name, (function, field) in aggregates.iteritems():
+                values = self._aggregate(function, field, rows, groups, count)
+                for result, value in zip(results, values):
+                    result[name] = value
+            if group_by:
+                for result, group in zip(results, used):
+                    for field, values in reversed(zip(group_by, group_values)):
+                        group, position = divmod(int(group), len(values))
+                        result[field] = values[position]
+                results.sort(key=lambda result: [(result[field] is not None, result[field]) for field in group_by])
+                return results
+            return results[0]
+
+    def _column(self, field):
+        if field not in self.columns:
+            raise Exception("field not in snapshot")
+        return self.columns[field]
+
+    def _aggregate(self, function, field, rows, groups, count):
+        if function == "count" and field is None:
+            return [int(value) for value in numpy.bincount(groups, minlength=count)]
+        column = self._column(field)
+        present = column.present(self.size)[rows]
+        counts = numpy.bincount(groups, weights=present, minlength=count)
+        if function == "count":
+            return [int(value) for value in counts]
+        data = column.data[rows]
+        if function in ("sum", "avg"):
+            if column.kind != NUMBER:
+                return [None] * count
+            sums = numpy.bincount(groups, weights=numpy.where(present, data, 0), minlength=count)
+            if function == "avg":
+                sums = sums / numpy.maximum(counts, 1)
+            return [_native(value) if seen else None for value, seen in zip(sums, counts)]
+        if function not in ("min", "max"):
+            raise Exception("invalid aggregate")
+        if column.kind == STRING:
+            data = column.ranks()[data[present]] if len(column.dictionary) else data[present]
+        else:
+            data = data[present]
+        groups = groups[present]
+        if function == "min":
+            extremes = numpy.full(count, numpy.inf)
+            numpy.minimum.at(extremes, groups, data)
+        else:
+            extremes = numpy.full(count, -numpy.inf)
+            numpy.maximum.at(extremes, groups, data)
+        if column.kind == STRING:
+            order = sorted(column.dictionary)
+            return [order[int(value)] if seen else None for value, seen in zip(extremes, counts)]
+        return [_native(value) if seen else None for value, seen in zip(extremes, counts)]
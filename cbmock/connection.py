@@ -1,26 +1,103 @@
 import os
-from couchbase.exceptions import KeyExistsError, NotFoundError
-import threading
-from cbmock.views import CBMockView
+from couchbase.exceptions import (CouchbaseError, DeltaBadvalError, KeyExistsError, NotFoundError, NotStoredError,
+                                   TimeoutError, ValueFormatError)
+import time
+from cbmock.views import CBMockView, CBMockViewIndex, parse_document
+from cbmock.spatial import CBMockSpatialView
+from cbmock.search import CBMockSearchIndex
+from cbmock.n1ql import CBMockN1QLQuery, CBMockIndexDefinition, parse, n1ql_params
+from cbmock.gsi import CBMockSecondaryIndex
+from cbmock.columnar import CBMockColumnarSnapshot
+from cbmock.store import ABSENT, CBMockChunks, CBMockStore, expiry_time
+from cbmock.scheduler import CBMockScheduler
+from cbmock.clock import CBMockClock
+from cbmock.results import CBMockResult, OperationResult, ValueResult, MultiResult
+from cbmock.analysis import normalize_source
+from cbmock.indexer import CBMockIndexer
+from cbmock.watcher import CBMockViewWatcher, read_design
 import json
 
 
+# counters are unsigned 64 bit
+COUNTER_LIMIT = 2 ** 64
+
+
+def counter_value(value):
+    """
+    the number a stored value holds, counters set as strings of digits count too.
+    """
+    if isinstance(value, (int, long)) and not isinstance(value, bool) and value >= 0:
+        return value
+    if isinstance(value, basestring) and value.strip().isdigit():
+        return int(value)
+    raise DeltaBadvalError("not a counter")
+
+
+def result_cas(keys, key):
+    """
+    the CAS a *_multi operation was given for key, keys maps keys to CAS values or to
+    results carrying one.
+    """
+    if not isinstance(keys, dict):
+        return 0
+    return getattr(keys[key], "cas", keys[key]) or 0
+
+
 class MockCouchbaseConnection(object):
     """
     Covers basic document operations and locks.
 
-    TODO - counters.
+    Safe to share between threads: every operation on a key holds the lock of the vBucket
+    the key maps to, so operations on different keys rarely wait on each other.
+
+    Documents written with a ttl expire like on the server: a ttl of up to 30 days is in
+    seconds from now, a larger one is a unix time. TTLs and lock timeouts go by clock, pass
+    a CBMockManualClock to move time along by hand.
+
+    Counters (incr, decr) are native ints, append and prepend add chunks joined on reads,
+    and the *_multi operations take each vBucket's lock once and mark the indexes dirty in
+    one pass.
     """
 
-    def __init__(self, data_dir=None, view_dir=None):
+    # expired documents removed by each mutation, at most
+    REAP_BATCH = 16
+
+    def __init__(self, data_dir=None, view_dir=None, background_indexing=False, index_cache_dir=None,
+                 watch_views=False, clock=None):
+        self.clock = clock or CBMockClock()
         self.locks = dict()
         self.lock_timeouts = dict()
-        self.data = dict()
+        self.scheduler = CBMockScheduler()
+        self.data = CBMockStore()
         self.pre_load_data(data_dir)
-        self.cas_counter = 100
         self.design_docs = dict()
         self.views = dict()
-        self.load_views(view_dir)
+        self.spatial_views = dict()
+        self.view_indexes = dict()
+        self.search_indexes = dict()
+        self.n1ql_indexes = dict()
+        self.columnar_snapshots = list()
+        self.indexer = None
+        self.index_cache_dir = index_cache_dir
+        self.watchers = list()
+        self.load_views(view_dir, watch=watch_views)
+        if background_indexing:
+            self.indexer = CBMockIndexer(self)
+            self.indexer.start()
+
+    def close(self):
+        for watcher in self.watchers:
+            watcher.stop()
+        self.watchers = list()
+        if self.indexer:
+            self.indexer.stop()
+            self.indexer = None
+        self.save_index_snapshots()
+
+    def save_index_snapshots(self):
+        if self.index_cache_dir:
+            for index in self.view_indexes.values():
+                index.save_snapshot()
 
     def pre_load_data(self, data_dir):
         if data_dir:
@@ -36,88 +113,355 @@ class MockCouchbaseConnection(object):
                                 self.data[doc_id] = fp.read()
 
 
-    def load_views(self, view_dir, design_name="default"):
+    def load_views(self, view_dir, design_name="default", watch=False, poll_interval=1.0):
+        """
+        with watch=True the directory is polled for edits, and views whose map function
+        changed are rebuilt while the rest keep their indexes.
+        """
         if view_dir:
-            design = dict()
-            for dirname, dirnames, filenames in os.walk(view_dir):
-                for name in dirnames:
-                    if name.startswith(".") or  name.startswith("_"):
-                        dirnames.remove(name)
-                for filename in filenames:
-                    if filename[0] != "_":
-                        doc_id, ext = filename.split(".")
-                        if doc_id:
-                            with open(os.path.join(dirname, filename), 'r') as fp:
-                                data = fp.read()
-                                design[doc_id] = json.loads(data)
-            self.design_create(design_name, {"views": design})
+            self.design_create(design_name, {"views": read_design(view_dir)})
+            if watch:
+                watcher = CBMockViewWatcher(self, view_dir, design_name, poll_interval)
+                self.watchers.append(watcher)
+                watcher.start()
 
 
-    def set(self, key, value, cas=0, ttl=0, format=None, persist_to=0, replicate_to=0):
-        if key in self.locks:
-            if cas != self.locks[key]:
+    def key_lock(self, key):
+        return self.data.lock_for(key)
+
+    def next_cas(self):
+        return self.data.next_cas()
+
+    @property
+    def cas_counter(self):
+        """
+        the CAS the next write gets, read only. the store hands out CAS values, see next_cas.
+        """
+        return self.data.peek_cas()
+
+    def check_cas(self, key, cas):
+        """
+        a locked key only takes the lock's CAS, otherwise a nonzero cas has to be the
+        document's current one. called with the key's lock held.
+        """
+        lock_cas = self.lock_cas(key)
+        if lock_cas is not None:
+            if cas != lock_cas:
+                raise KeyExistsError("Key exits")
+        elif cas:
+            item = self.live_item(key)
+            if item is None:
+                raise NotFoundError("not found")
+            if cas != item.cas:
                 raise KeyExistsError("Key exits")
-        self.data[key] = value
-        self.update_views(key, value)
+
+    def lock_cas(self, key):
+        """
+        the CAS the key is locked with, None if it isn't locked or the lock timed out, in
+        which case it is released. called with the key's lock held.
+        """
+        cas = self.locks.get(key)
+        if cas is not None:
+            deadline = self.lock_timeouts.get(key)
+            if deadline is not None and deadline <= self.clock.time():
+                self.release_lock(key)
+                return None
+        return cas
+
+    def release_lock(self, key):
+        self.locks.pop(key, None)
+        self.lock_timeouts.pop(key, None)
+
+    def live_item(self, key):
+        """
+        the key's item, None if it doesn't exist or has expired, in which case it is removed.
+        called with the key's lock held.
+        """
+        item = self.data.item(key)
+        if item is not None and item.expired(self.clock.time()):
+            self.expire(key)
+            return None
+        return item
+
+    def expire(self, key):
+        del self.data[key]
+        self.release_lock(key)
+        self.update_views(key, None)
+
+    def reap_expired(self, limit=None):
+        """
+        removes documents whose TTL ran out, limit of them at most. every mutation reaps a
+        small batch and every query all of them, the expiry heap means only expired
+        documents are looked at.
+        """
+        now = self.clock.time()
+        reaped = 0
+        for key in self.data.due(now, limit):
+            with self.key_lock(key):
+                item = self.data.item(key)
+                if item is not None and item.expired(now):
+                    self.expire(key)
+                    reaped += 1
+        return reaped
+
+    def set(self, key, value, cas=0, ttl=0, format=None, persist_to=0, replicate_to=0):
+        return self.single(key, lambda: self.store_value(key, value, cas, ttl, "set"))
 
     def add(self, key, value, ttl=0, format=None, persist_to=0, replicate_to=0):
-        if key in self.data:
-            raise KeyExistsError("Key exits")
-        self.data[key] = value
-        self.update_views(key, value)
+        return self.single(key, lambda: self.store_value(key, value, 0, ttl, "add"))
 
     def replace(self, key, value, cas=0, ttl=0, format=None, persist_to=0, replicate_to=0):
-        if key not in self.data:
+        return self.single(key, lambda: self.store_value(key, value, cas, ttl, "replace"))
+
+    def set_multi(self, keys, ttl=0, format=None, persist_to=0, replicate_to=0):
+        """
+        keys is a dict of key: value. like every *_multi operation errors are not
+        propagated, the key's result is None and all_ok False.
+        """
+        return self.batch(keys, lambda key: self.store_value(key, keys[key], 0, ttl, "set"))
+
+    def add_multi(self, keys, ttl=0, format=None, persist_to=0, replicate_to=0):
+        return self.batch(keys, lambda key: self.store_value(key, keys[key], 0, ttl, "add"))
+
+    def replace_multi(self, keys, ttl=0, format=None, persist_to=0, replicate_to=0):
+        return self.batch(keys, lambda key: self.store_value(key, keys[key], 0, ttl, "replace"))
+
+    def store_value(self, key, value, cas, ttl, operation):
+        """
+        the set, add or replace operation, called with the key's lock held. returns (result,
+        value written) like every operation batch() runs.
+        """
+        if operation == "add" and self.live_item(key) is not None:
+            raise KeyExistsError("Key exits")
+        if operation == "replace" and self.live_item(key) is None:
             raise NotFoundError("not found")
-        self.data[key] = value
-        self.update_views(key, value)
+        self.check_cas(key, cas)
+        cas = self.data.write(key, value, expiry=expiry_time(ttl, self.clock.time()))
+        return OperationResult(key, cas), value
+
+    def single(self, key, operation):
+        """
+        runs one of the operations batch() runs for a single key, errors are raised.
+        """
+        self.reap_expired(self.REAP_BATCH)
+        with self.key_lock(key):
+            result, value = operation()
+            if value is not ABSENT:
+                self.update_views(key, value)
+        return result
 
     def get(self, key, ttl=0, quiet=None, replica=False, no_format=False):
-        if key not in self.data:
-            raise NotFoundError("not found")
-        return ValueResult(key, self.data[key])
+        """
+        a ttl makes it a get-and-touch, the document gets the new TTL (and a new CAS).
+        """
+        item = self.data.item(key)
+        if item is None or item.expired(self.clock.time()) or ttl:
+            with self.key_lock(key):
+                item = self.live_item(key)
+                if item is None:
+                    raise NotFoundError("not found")
+                if ttl:
+                    self.check_cas(key, 0)
+                    cas = self.data.write(key, item.value, expiry=expiry_time(ttl, self.clock.time()))
+                    return ValueResult(key, item.value, cas)
+        return ValueResult(key, item.value, item.cas)
 
     def get_multi(self, keys, ttl=0, quiet=None, replica=False, no_format=False):
         """
         this breaks the pattern in that errors are not propagated.
+
+        all values are read from one snapshot, so writes landing meanwhile aren't seen.
         """
         results = MultiResult()
-        for key in keys:
-            try:
-                results[key] = self.get(key)
-            except:
-                results.all_ok = False
-                results[key] = None
+        now = self.clock.time()
+        with self.data.snapshot() as snapshot:
+            for key in keys:
+                item = snapshot.item(key)
+                if item is None or item.expired(now):
+                    results.all_ok = False
+                    results[key] = None
+                else:
+                    results[key] = ValueResult(key, item.value, item.cas)
         return results
 
     def delete(self, key, cas=0, quiet=None, persist_to=0, replicate_to=0):
-        if key not in self.data:
+        return self.single(key, lambda: self.delete_value(key, cas))
+
+    def delete_multi(self, keys, quiet=None, persist_to=0, replicate_to=0):
+        """
+        keys is a list, or a dict of key: CAS (or the result holding it).
+        """
+        return self.batch(keys, lambda key: self.delete_value(key, result_cas(keys, key)))
+
+    def delete_value(self, key, cas):
+        if self.live_item(key) is None:
             raise NotFoundError("not found")
-        if key in self.locks:
-            if cas != self.locks[key]:
-                raise KeyExistsError("Key exits")
+        self.check_cas(key, cas)
         del self.data[key]
-        self.update_views(key, None)
+        return OperationResult(key, self.next_cas()), None
+
+    def append(self, key, value, cas=0, ttl=0, format=None, persist_to=0, replicate_to=0):
+        """
+        adds value to the end of the key's string, NotStoredError if the key doesn't exist.
+        the expiry is left as it was, like on the server.
+        """
+        return self.extend(key, value, cas, False)
+
+    def prepend(self, key, value, cas=0, ttl=0, format=None, persist_to=0, replicate_to=0):
+        return self.extend(key, value, cas, True)
+
+    def extend(self, key, chunk, cas, prepend):
+        """
+        the value is kept in chunks and only joined when read, by a get or an index that
+        needs the document.
+        """
+        if not isinstance(chunk, basestring):
+            raise ValueFormatError("only strings can be appended")
+        self.reap_expired(self.REAP_BATCH)
+        with self.key_lock(key):
+            item = self.live_item(key)
+            if item is None:
+                raise NotStoredError("not found")
+            self.check_cas(key, cas)
+            if isinstance(item.raw, (int, long)):
+                # counters are digits to the server
+                chunks = CBMockChunks(list(), 0, [str(item.raw)], 1)
+            elif isinstance(item.raw, (basestring, CBMockChunks)):
+                chunks = item.chunks()
+            else:
+                raise ValueFormatError("only strings can be appended to")
+            cas = self.data.write(key, chunks.prepend(chunk) if prepend else chunks.append(chunk), expiry=item.expiry)
+            if self.n1ql_indexes or any(index.needs_document(key) for index in self.view_indexes.values()):
+                self.update_views(key, self.data[key])
+            else:
+                # the value is joined once a view maps it, not on every append
+                self.mark_views_dirty([(key, None)])
+        return OperationResult(key, cas)
+
+    def incr(self, key, amount=1, initial=None, ttl=0):
+        """
+        adds amount to a counter and returns its new value. a missing counter is created
+        with initial (not incremented) and ttl, or raises NotFoundError if initial is None.
+        """
+        return self.single(key, lambda: self.counter(key, amount, initial, ttl))
+
+    def decr(self, key, amount=1, initial=None, ttl=0):
+        """
+        like incr, counters don't go below 0.
+        """
+        return self.incr(key, -amount, initial, ttl)
+
+    def incr_multi(self, keys, amount=1, initial=None, ttl=0):
+        """
+        keys is a list, or a dict of key: amount.
+        """
+        return self.counter_multi(keys, amount, initial, ttl, 1)
+
+    def decr_multi(self, keys, amount=1, initial=None, ttl=0):
+        return self.counter_multi(keys, amount, initial, ttl, -1)
+
+    def counter_multi(self, keys, amount, initial, ttl, sign):
+        amounts = keys if isinstance(keys, dict) else dict.fromkeys(keys, amount)
+        return self.batch(amounts, lambda key: self.counter(key, sign * amounts[key], initial, ttl))
+
+    def counter(self, key, delta, initial, ttl):
+        """
+        counters are stored as native ints, unsigned 64 bit like the server's: increments
+        wrap around and decrements stop at 0. called with the key's lock held.
+        """
+        self.check_cas(key, 0)
+        item = self.live_item(key)
+        if item is None:
+            if initial is None:
+                raise NotFoundError("not found")
+            value, expiry = initial, expiry_time(ttl, self.clock.time())
+        else:
+            value, expiry = counter_value(item.value), item.expiry
+            value = max(value + delta, 0) % COUNTER_LIMIT
+        cas = self.data.write(key, value, expiry=expiry)
+        return ValueResult(key, value, cas), value
+
+    def batch(self, keys, operation):
+        """
+        runs operation(key) for every key, holding each vBucket's lock once for all of its
+        keys. operations return (the key's result, the value written), None for a deletion
+        and ABSENT when nothing was written. N1QL indexes are updated under the locks, the
+        other indexes are marked dirty in one pass at the end.
+
+        like get_multi errors are not propagated, the key's result is None instead.
+        """
+        results = MultiResult()
+        changes = list()
+        partitions = dict()
+        for key in keys:
+            partitions.setdefault(self.data.partition(key), list()).append(key)
+        self.reap_expired(self.REAP_BATCH)
+        for partition, partition_keys in partitions.iteritems():
+            with partition.lock:
+                for key in partition_keys:
+                    try:
+                        results[key], value = operation(key)
+                    except CouchbaseError:
+                        results.all_ok = False
+                        results[key] = None
+                        continue
+                    if value is not ABSENT:
+                        self.update_n1ql_indexes(key, value)
+                        changes.append((key, value))
+        self.mark_views_dirty(changes)
+        return results
 
     def lock(self, key, ttl=0):
-        cas = self.cas_counter
-        self.cas_counter += 1
+        """
+        the returned CAS becomes the document's, like the server's get-and-lock.
+
+        a ttl releases the lock after that many seconds: operations on the key check the
+        deadline themselves, and the scheduler forgets the locks nobody looked at again.
+        """
+        self.scheduler.run_due(self.clock.time(), self.REAP_BATCH)
+        return self.single(key, lambda: self.lock_key(key, ttl)).cas
+
+    def lock_multi(self, keys, ttl=0):
+        """
+        returns OperationResults holding each lock's CAS, pass them to unlock_multi.
+        """
+        self.scheduler.run_due(self.clock.time(), self.REAP_BATCH)
+        return self.batch(keys, lambda key: self.lock_key(key, ttl))
+
+    def lock_key(self, key, ttl):
+        cas = self.next_cas()
+        item = self.live_item(key)
+        if item is not None:
+            self.data.write(key, item.raw, cas, item.expiry)
         self.locks[key] = cas
+        self.lock_timeouts.pop(key, None)
         if ttl:
-            def unlock():
-                try:
-                    self.unlock(key, cas)
-                except:
-                    pass
-            timer = threading.Timer(ttl, unlock)
-            timer.start()
-        return cas
+            deadline = self.clock.time() + ttl
+            self.lock_timeouts[key] = deadline
+            self.scheduler.schedule(deadline, self.lock_expired, key, cas)
+        return OperationResult(key, cas), ABSENT
+
+    def lock_expired(self, key, cas):
+        with self.key_lock(key):
+            if self.locks.get(key) == cas:
+                self.lock_cas(key)
 
     def unlock(self, key, cas):
-        if key in self.locks:
-            if cas != self.locks[key]:
+        self.single(key, lambda: self.unlock_key(key, cas))
+
+    def unlock_multi(self, keys):
+        """
+        keys is a dict of key: CAS or the result of lock_multi.
+        """
+        return self.batch(keys, lambda key: self.unlock_key(key, result_cas(keys, key)))
+
+    def unlock_key(self, key, cas):
+        lock_cas = self.lock_cas(key)
+        if lock_cas is not None:
+            if cas != lock_cas:
                 raise KeyExistsError("Key exits")
-            del self.locks[key]
+            self.release_lock(key)
+        return OperationResult(key), ABSENT
 
     def design_create(self, name, ddoc, use_devmode=True, syncwait=0):
         views = ddoc.get("views", dict())
@@ -131,25 +475,66 @@ class MockCouchbaseConnection(object):
         to_add = new_view_names.difference(cur_view_names)
         to_update = cur_view_names.intersection(new_view_names)
         for key in to_remove:
-            del view_set[key]
+            view_set.pop(key).release()
         for key in to_add:
             view_info = views.get(key)
-            view = CBMockView(self, view_info.get("map"), view_info.get("reduce"))
+            view = CBMockView(self, view_info.get("map"), view_info.get("reduce"), view_info.get("filter"))
             view_set[key] = view
         for key in to_update:
             view_info = views.get(key)
             view = view_set[key]
-            view.update(view_info.get("map"), view_info.get("reduce"))
+            view.update(view_info.get("map"), view_info.get("reduce"), view_info.get("filter"))
+        spatial = ddoc.get("spatial", dict())
+        spatial_set = self.spatial_views.setdefault(name, dict())
+        for key in set(spatial_set).difference(spatial):
+            spatial_set.pop(key).release()
+        for key, map_func in spatial.iteritems():
+            if key in spatial_set:
+                spatial_set[key].update(map_func)
+            else:
+                spatial_set[key] = CBMockSpatialView(self, map_func)
+        if syncwait:
+            self._build_views(view_set.values() + spatial_set.values(), syncwait)
+
+    def _build_views(self, views, syncwait):
+        """
+        builds any unbuilt views in the background, waiting up to syncwait seconds for them.
+        """
+        deadline = time.time() + syncwait
+        threads = [view.build_async() for view in views if not view.built]
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+            if thread.is_alive():
+                raise TimeoutError("views not built within syncwait")
 
     def design_get(self, name, use_devmode=True):
         return ValueResult(name, self.design_docs.get(name, dict()))
 
     def design_publish(self, name, syncwait=0):
-        pass
+        """
+        promotes the dev_<name> design doc to <name>, keeping the views and whatever they
+        have already indexed. unlike the real client, design_create doesn't add the dev_
+        prefix itself, so only design docs created as dev_<name> can be published.
+        """
+        if name.startswith("dev_"):
+            name = name[len("dev_"):]
+        dev_name = "dev_" + name
+        if dev_name not in self.views:
+            raise NotFoundError("not found")
+        # the production views being replaced, like design_delete
+        for view in self.views.pop(name, dict()).values() + self.spatial_views.pop(name, dict()).values():
+            view.release()
+        self.views[name] = self.views.pop(dev_name)
+        self.spatial_views[name] = self.spatial_views.pop(dev_name, dict())
+        self.design_docs[name] = self.design_docs.pop(dev_name, dict())
+        if syncwait:
+            self._build_views(self.views[name].values() + self.spatial_views[name].values(), syncwait)
 
     def design_delete(self, name, use_devmode=True, syncwait=0):
         if name in self.design_docs:
             del self.design_docs[name]
+        for view in self.views.pop(name, dict()).values() + self.spatial_views.pop(name, dict()).values():
+            view.release()
 
     def query(self, design_name, view_name, **kwargs):
         if design_name in self.views:
@@ -162,40 +547,173 @@ class MockCouchbaseConnection(object):
         else:
             raise Exception("invalid design name")
 
-    def update_views(self, key, value):
-        meta = {"id": key}
-        doc = value
-        for design in self.views.values():
-            for view in design.values():
-                view.map_item(doc, meta)
-
-
-
-class CBMockResult(object):
-
-    def __init__(self, key):
-        self.rc = None
-        self.success = True
-        self.errstr = None
-        self.key = key
+    def query_spatial(self, design_name, view_name, **kwargs):
+        """
+        queries a spatial view, e.g. query_spatial("places", "points", bbox=[0, 0, 10, 10]).
+        """
+        if design_name in self.spatial_views:
+            view_set = self.spatial_views[design_name]
+            if view_name in view_set:
+                return view_set.get(view_name).query(**kwargs)
+            else:
+                raise Exception("invalid view name")
+        else:
+            raise Exception("invalid design name")
 
+    def search_index_create(self, name, fields):
+        """
+        defines a full text search index over some (dotted) JSON fields of every document.
+        """
+        self.search_indexes[name] = CBMockSearchIndex(self, name, fields)
 
-class OperationResult(CBMockResult):
-    pass
+    def search_index_delete(self, name):
+        if name not in self.search_indexes:
+            raise NotFoundError("not found")
+        del self.search_indexes[name]
 
+    def search(self, index, query, limit=10):
+        """
+        returns scored CBMockSearchHits for a query of words and "quoted phrases".
+        """
+        if index not in self.search_indexes:
+            raise Exception("invalid search index")
+        self.reap_expired()
+        return self.search_indexes[index].search(query, limit)
 
-class ValueResult(CBMockResult):
-    
-    def __init__(self, key, value):
-        super(ValueResult, self).__init__(key)
-        self.value = value
+    def n1ql_query(self, statement, *args, **kwargs):
+        """
+        runs a N1QL SELECT over the bucket and returns an iterator of result rows. positional
+        arguments fill $1, $2... (or ?) and keyword arguments $name placeholders.
 
+        supported: projection (with DISTINCT and RAW), USE KEYS, WHERE, GROUP BY / HAVING with
+        COUNT, SUM, AVG, MIN, MAX and ARRAY_AGG, ORDER BY, LIMIT and OFFSET, EXPLAIN, and
+        CREATE [PRIMARY] INDEX / DROP [PRIMARY] INDEX.
+        """
+        statement = parse(statement)
+        if isinstance(statement, CBMockIndexDefinition):
+            if statement.drop:
+                self.n1ql_index_drop(statement)
+            else:
+                self.n1ql_index_create(statement)
+            return iter([])
+        self.reap_expired()
+        query = CBMockN1QLQuery(self, statement, n1ql_params(args, kwargs), self.n1ql_indexes.values())
+        if statement.explain:
+            return iter([query.explain()])
+        return query.execute()
+
+    def n1ql_index_create(self, definition):
+        name = "#primary" if definition.primary and not definition.name else definition.name
+        if name in self.n1ql_indexes:
+            raise KeyExistsError("index exists")
+        index = CBMockSecondaryIndex(self, name, definition.keys, definition.where,
+                                     definition.keyspace, definition.primary)
+        # writes update it from here on, those made while it builds are queued
+        self.n1ql_indexes[name] = index
+        index.build()
+
+    def n1ql_index_drop(self, definition):
+        if definition.primary:
+            names = [name for name, index in self.n1ql_indexes.items() if index.primary]
+        else:
+            names = [definition.name] if definition.name in self.n1ql_indexes else []
+        if not names:
+            raise NotFoundError("index not found")
+        for name in names:
+            del self.n1ql_indexes[name]
 
-class MultiResult(dict):
+    def columnar_snapshot(self, fields):
+        """
+        copies some (dotted) fields of every JSON document into numpy columns for fast
+        aggregations, see CBMockColumnarSnapshot.aggregate. fields is a list, or a dict of
+        field: "number" or "string" to not go by the first value found. close() the snapshot
+        once done with it so writes stop tracking it.
+        """
+        snapshot = CBMockColumnarSnapshot(self, fields)
+        # tracked before it copies the bucket so no write falls in between
+        self.columnar_snapshots.append(snapshot)
+        snapshot.refresh()
+        return snapshot
 
-    def __init__(self):
-        self.all_ok = True
+    def _indexes(self):
+        return self.view_indexes.values() + self.search_indexes.values() + self.columnar_snapshots
 
+    def update_views(self, key, value):
+        """
+        only records the key as dirty, views map it the next time they are queried. N1QL
+        indexes are updated right away. called with the key's lock held, so indexes see the
+        writes to one key in order.
+        """
+        self.update_n1ql_indexes(key, value)
+        self.mark_views_dirty([(key, value)])
 
+    def update_n1ql_indexes(self, key, value):
+        if self.n1ql_indexes:
+            doc, ok = parse_document(value) if value is not None else (None, False)
+            for index in self.n1ql_indexes.values():
+                index.update(key, doc if ok else None)
 
+    def mark_views_dirty(self, changes):
+        """
+        changes is a list of (key, new value or None). marking is the same whatever order
+        it happens in, each index only takes its CBMockDirtySet's lock for it.
+        """
+        indexes = self._indexes()
+        if indexes:
+            for index in indexes:
+                for key, value in changes:
+                    index.mark_dirty(key, value)
+        if self.indexer:
+            self.indexer.enqueue_many([key for key, value in changes])
+
+    def refresh_views(self, keys=None):
+        """
+        maps the dirty documents among keys, all of them if keys is None. indexes that
+        haven't been built yet are built.
+        """
+        for index in self._indexes():
+            index.refresh(keys if index.built else None)
 
+    def acquire_view_index(self, map_func, view_filter=None, index_class=CBMockViewIndex):
+        """
+        returns the index for a map function, shared by every view whose map source is the
+        same once comments and formatting are ignored (and that declares the same filter).
+        """
+        source = (normalize_source(map_func), json.dumps(view_filter, sort_keys=True), index_class.__name__)
+        index = self.view_indexes.get(source)
+        if index is None:
+            index = index_class(self, map_func, view_filter)
+            index.registry_key = source
+            self.view_indexes[source] = index
+        index.refcount += 1
+        return index
+
+    def release_view_index(self, index):
+        index.refcount -= 1
+        if index.refcount <= 0:
+            self.view_indexes.pop(index.registry_key, None)
+
+    def wait_for_index(self, timeout=None):
+        """
+        blocks until every write so far is in the view indexes, returns False on timeout.
+        without a background indexer the views are refreshed in the calling thread, with one
+        the calling thread only builds the indexes no query built yet.
+        """
+        if self.indexer and not self.indexer.wait(timeout):
+            return False
+        self.refresh_views()
+        return True
+
+    def index_lag(self):
+        if self.indexer:
+            return self.indexer.stats()
+        dirty = set()
+        for index in self._indexes():
+            dirty.update(index.dirty)
+        return {
+            "pending": len(dirty),
+            "lag_seconds": 0.0,
+            "batches": 0,
+            "indexed": 0,
+            "last_batch_seconds": 0.0,
+        }
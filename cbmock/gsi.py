@@ -0,0 +1,307 @@
+import bisect
+import threading
+from cbmock.views import parse_document
+from cbmock.n1ql import CBMockN1QLCompiler, CBMockN1QLRow, MISSING, collation_key, is_true
+
+# sorts after every collation key, (key, MAX) is past every entry starting with key
+_MAX = (8,)
+
+_FLIPPED = {">": "<", ">=": "<=", "<": ">", "<=": ">=", "=": "="}
+
+
+def relative(node, alias):
+    """
+    rewrites alias.name to name and META(alias) to META(), so expressions from queries with
+    different aliases and from index definitions compare equal.
+    """
+    if isinstance(node, tuple):
+        if node[:2] == ("call", "meta"):
+            return ("call", "meta", [], False, False)
+        if len(node) == 3 and node[0] == "field" and node[1] == ("identifier", alias):
+            return ("identifier", node[2])
+        return tuple(relative(part, alias) for part in node)
+    if isinstance(node, list):
+        return [relative(part, alias) for part in node]
+    return node
+
+
+def conjuncts(node):
+    if node is None:
+        return []
+    if node[0] == "binary" and node[1] == "and":
+        return conjuncts(node[2]) + conjuncts(node[3])
+    return [node]
+
+
+def path(node):
+    """
+    the document path of a name or a chain of .fields, None for anything else.
+    """
+    if node[0] == "identifier":
+        return (node[1],)
+    if node[0] == "field":
+        parent = path(node[1])
+        return parent + (node[2],) if parent else None
+    return None
+
+
+def _constant(node):
+    if node[0] in ("literal", "param"):
+        return True
+    if node[0] == "negate":
+        return _constant(node[1])
+    if node[0] == "array":
+        return all(_constant(item) for item in node[1])
+    return False
+
+
+def _references(node, alias, paths):
+    """
+    adds the document paths an expression reads to paths, returns False when it reads the
+    whole document.
+    """
+    if not isinstance(node, tuple):
+        return True
+    kind = node[0]
+    if kind == "star":
+        return False
+    if kind == "identifier":
+        if node[1] == alias:
+            return False
+        paths.add((node[1],))
+        return True
+    if kind == "field":
+        node_path = path(node)
+        if node_path:
+            paths.add(node_path)
+            return True
+        return _references(node[1], alias, paths)
+    if kind == "call" and node[1] == "meta":
+        return True
+    for part in node[1:]:
+        parts = part if isinstance(part, list) else [part]
+        for item in parts:
+            if not _references(item, alias, paths):
+                return False
+    return True
+
+
+class CBMockSecondaryIndex(object):
+    """
+    A stand-in for a GSI index: (collation key of the index keys, doc id) entries in a
+    sorted list, kept up to date on every write. Documents whose leading key is MISSING or
+    that don't pass the index's WHERE aren't indexed, like the real thing.
+
+    The primary index is the same with META().id as its only key.
+    """
+
+    def __init__(self, connection, name, keys, where=None, keyspace=None, primary=False):
+        self.connection = connection
+        self.name = name
+        self.keyspace = keyspace
+        self.primary = primary
+        if primary:
+            keys = [("field", ("call", "meta", [], False, False), "id")]
+        self.keys = [relative(key, keyspace) for key in keys]
+        self.where = relative(where, keyspace)
+        self.key_paths = [path(key) for key in self.keys]
+        compiler = CBMockN1QLCompiler(keyspace, dict())
+        self._key_functions = [compiler.compile(key) for key in self.keys]
+        self._where_function = compiler.compile(self.where) if self.where else None
+        self._lock = threading.RLock()
+        self.entries = list()
+        self.doc_entries = dict()
+        # updates queue up here until build() is done, register the index with the
+        # connection before building it so none is missed
+        self.pending = list()
+
+    def build(self):
+        """
+        indexes a snapshot of the bucket. writers hold their vBucket's lock while updating
+        the index, so the lock isn't held while pinning the snapshot: updates made meanwhile
+        are queued and applied afterwards, in order.
+        """
+        with self._lock:
+            if self.pending is None:
+                self.pending = list()
+        entries = list()
+        doc_entries = dict()
+        with self.connection.data.snapshot() as documents:
+            for doc_id, value in documents.iteritems():
+                doc, ok = parse_document(value)
+                entry = self._entry(doc_id, doc) if ok else None
+                if entry:
+                    entries.append((entry[0], doc_id))
+                    doc_entries[doc_id] = entry
+        entries.sort()
+        with self._lock:
+            self.entries = entries
+            self.doc_entries = doc_entries
+            pending, self.pending = self.pending, None
+            for doc_id, entry in pending:
+                self._apply(doc_id, entry)
+
+    def _entry(self, doc_id, doc):
+        row = CBMockN1QLRow(doc, {"id": doc_id, "type": "json"})
+        if self._where_function and not is_true(self._where_function(row)):
+            return None
+        values = [key(row) for key in self._key_functions]
+        if values[0] is MISSING:
+            return None
+        return tuple(collation_key(value) for value in values), values
+
+    def update(self, doc_id, doc):
+        """
+        doc is the parsed document, None when it was deleted or isn't JSON.
+        """
+        entry = self._entry(doc_id, doc) if doc is not None else None
+        with self._lock:
+            if self.pending is not None:
+                self.pending.append((doc_id, entry))
+            else:
+                self._apply(doc_id, entry)
+
+    def _apply(self, doc_id, entry):
+        old = self.doc_entries.pop(doc_id, None)
+        if old:
+            position = bisect.bisect_left(self.entries, (old[0], doc_id))
+            del self.entries[position]
+        if entry:
+            bisect.insort(self.entries, (entry[0], doc_id))
+            self.doc_entries[doc_id] = entry
+
+    def plan(self, query):
+        """
+        returns a CBMockIndexScan if this index can answer the query, None otherwise. the
+        leading key has to be constrained by the WHERE clause (unless this is the primary
+        index) and a partial index's own WHERE has to be part of the query's.
+        """
+        if self.pending is not None:
+            # still building
+            return None
+        select = query.select
+        where = conjuncts(relative(select.where, select.alias))
+        if any(condition not in where for condition in conjuncts(self.where)):
+            return None
+        low, high, low_inclusive, high_inclusive, equalities = list(), list(), True, True, 0
+        for key in self.keys:
+            bounds = [bound for condition in where for bound in self._bounds(key, condition)]
+            equal = [value for operator, value in bounds if operator == "="]
+            if equal:
+                low.append(query.compiler.compile(equal[0])(None))
+                high.append(low[-1])
+                equalities += 1
+                continue
+            lows = [(query.compiler.compile(value)(None), operator == ">=")
+                    for operator, value in bounds if operator in (">", ">=")]
+            highs = [(query.compiler.compile(value)(None), operator == "<=")
+                     for operator, value in bounds if operator in ("<", "<=")]
+            if lows:
+                value, low_inclusive = max(lows, key=lambda bound: (collation_key(bound[0]), not bound[1]))
+                low.append(value)
+            if highs:
+                value, high_inclusive = min(highs, key=lambda bound: (collation_key(bound[0]), bound[1]))
+                high.append(value)
+            break
+        if not low and not high and not self.primary:
+            return None
+        covering = self._covers(query)
+        score = (equalities, len(low) + len(high), covering, not self.primary, -len(self.keys))
+        return CBMockIndexScan(self, low, high, low_inclusive, high_inclusive, covering, score)
+
+    def _bounds(self, key, condition):
+        """
+        the (operator, constant expression) bounds a condition puts on an index key.
+        """
+        kind = condition[0]
+        if kind == "binary" and condition[1] in _FLIPPED:
+            operator, left, right = condition[1:]
+            if left == key and _constant(right):
+                return [(operator, right)]
+            if right == key and _constant(left):
+                return [(_FLIPPED[operator], left)]
+        elif kind == "between" and not condition[4] and condition[1] == key:
+            if _constant(condition[2]) and _constant(condition[3]):
+                return [(">=", condition[2]), ("<=", condition[3])]
+        elif kind == "like" and not condition[3] and condition[1] == key and condition[2][0] == "literal":
+            pattern = condition[2][1]
+            prefix = pattern.split("%")[0].split("_")[0] if isinstance(pattern, basestring) else None
+            if prefix:
+                return [(">=", ("literal", prefix)), ("<", ("literal", prefix + u"\uffff"))]
+        return []
+
+    def _covers(self, query):
+        """
+        whether every path the query reads is inside one of the index keys, then rows can be
+        built from the index alone.
+        """
+        select = query.select
+        nodes = [expression for expression, name in select.projection] + [select.where, select.having]
+        nodes += select.group_by + [expression for expression, descending in select.order_by]
+        paths = set()
+        for node in nodes:
+            if node is not None and not _references(relative(node, select.alias), select.alias, paths):
+                return False
+        key_paths = [key_path for key_path in self.key_paths if key_path]
+        return all(any(read[:len(key_path)] == key_path for key_path in key_paths) for read in paths)
+
+    def scan(self, low, high, low_inclusive, high_inclusive):
+        """
+        yields (doc id, index values) in index order for the entries between low and high.
+        """
+        low_key = tuple(collation_key(value) for value in low)
+        high_key = tuple(collation_key(value) for value in high)
+        with self._lock:
+            entries = self.entries
+            start = 0
+            if low:
+                start = bisect.bisect_left(entries, (low_key + (_MAX,) if not low_inclusive else low_key,))
+            stop = len(entries)
+            if high:
+                stop = bisect.bisect_left(entries, (high_key + (_MAX,) if high_inclusive else high_key,))
+            matches = [(doc_id, self.doc_entries[doc_id][1]) for key, doc_id in entries[start:stop]]
+        return matches
+
+
+class CBMockIndexScan(object):
+
+    def __init__(self, index, low, high, low_inclusive, high_inclusive, covering, score):
+        self.index = index
+        self.low = low
+        self.high = high
+        self.low_inclusive = low_inclusive
+        self.high_inclusive = high_inclusive
+        self.covering = covering
+        self.score = score
+
+    def scan(self, documents):
+        for doc_id, values in self.index.scan(self.low, self.high, self.low_inclusive, self.high_inclusive):
+            if self.covering:
+                yield doc_id, self._covered_document(values), None
+            else:
+                yield doc_id, None, None
+
+    def _covered_document(self, values):
+        doc = dict()
+        for key_path, value in zip(self.index.key_paths, values):
+            if not key_path or value is MISSING:
+                continue
+            target = doc
+            for part in key_path[:-1]:
+                target = target.setdefault(part, dict())
+            target[key_path[-1]] = value
+        return doc
+
+    def explain(self):
+        span = {"inclusion": (1 if self.low_inclusive else 0) + (2 if self.high_inclusive else 0)}
+        if self.low:
+            span["low"] = self.low
+        if self.high:
+            span["high"] = self.high
+        return {
+            "#operator": "PrimaryScan" if self.index.primary else "IndexScan",
+            "index": self.index.name,
+            "keyspace": self.index.keyspace,
+            "spans": [span],
+            "covering": self.covering,
+        }
@@ -0,0 +1,106 @@
+import threading
+import time
+import Queue
+from collections import deque
+from traceback import print_exc
+
+
+_STOP = object()
+
+
+class CBMockIndexer(threading.Thread):
+    """
+    Drains the keys written to a connection and applies them to every view in batches,
+    so writes never wait on node. Queries can still ask for a consistent index with
+    stale=false, or callers can block on wait().
+    """
+
+    def __init__(self, connection, batch_size=1000):
+        super(CBMockIndexer, self).__init__(name="cbmock-indexer")
+        self.daemon = True
+        self.connection = connection
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.enqueued_at = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.pending = 0
+        self.batches = 0
+        self.indexed = 0
+        self.last_batch_seconds = 0.0
+
+    def enqueue(self, key):
+        self.enqueue_many([key])
+
+    def enqueue_many(self, keys):
+        with self.condition:
+            self.pending += len(keys)
+        self.enqueued_at.extend([time.time()] * len(keys))
+        for key in keys:
+            self.queue.put(key)
+
+    def run(self):
+        while self.running:
+            keys = [self.queue.get()]
+            while len(keys) < self.batch_size:
+                try:
+                    keys.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            done = len(keys)
+            keys = [key for key in keys if key is not _STOP]
+            started = time.time()
+            try:
+                self.connection.refresh_views(set(keys))
+            except:
+                print_exc()
+            for _ in keys:
+                self.enqueued_at.popleft()
+            with self.condition:
+                self.pending -= len(keys)
+                self.batches += 1
+                self.indexed += len(keys)
+                self.last_batch_seconds = time.time() - started
+                self.condition.notify_all()
+            if done != len(keys):
+                break
+
+    def wait(self, timeout=None):
+        """
+        blocks until every queued key has been indexed, returns False if timeout ran out first.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+        return True
+
+    def stats(self):
+        try:
+            lag = time.time() - self.enqueued_at[0]
+        except IndexError:
+            lag = 0.0
+        with self.condition:
+            return {
+                "pending": self.pending,
+                "lag_seconds": lag,
+                "batches": self.batches,
+                "indexed": self.indexed,
+                "last_batch_seconds": self.last_batch_seconds,
+            }
+
+    def stop(self, timeout=5):
+        """
+        waits up to timeout seconds for the thread to finish the batch it's on, so it isn't
+        left inside Queue.get when the interpreter shuts down.
+        """
+        self.running = False
+        self.queue.put(_STOP)
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
@@ -0,0 +1,1151 @@
+import re
+import json
+import math
+import heapq
+import itertools
+from functools import cmp_to_key
+from cbmock.views import parse_document
+
+
+class CBMockN1QLError(Exception):
+    pass
+
+
+class _Missing(object):
+    """
+    N1QL's MISSING, what a path into a document that isn't there evaluates to.
+    """
+
+    def __repr__(self):
+        return "MISSING"
+
+    def __nonzero__(self):
+        return False
+
+
+MISSING = _Missing()
+
+KEYWORDS = set("""
+    all and any as asc between by create desc distinct drop explain false from group having
+    in index is keys like limit missing not null offset on or order primary raw select true
+    use using valued where
+""".split())
+
+_token_re = re.compile(r"""
+    (?P<space>\s+|--[^\n]*|/\*.*?\*/)
+  | (?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.|"")*"|'(?:[^'\\]|\\.|'')*')
+  | (?P<qident>`(?:[^`]|``)*`)
+  | (?P<param>\$\w+|\?)
+  | (?P<ident>[A-Za-z_][\w]*)
+  | (?P<op><=|>=|!=|<>|==|\|\||[-+*/%=<>()\[\]{},.:;])
+""", re.S | re.X)
+
+
+def _unquote(token):
+    """
+    the value of a "double" or 'single' quoted string literal, a doubled quote stands for
+    one and backslash escapes are JSON's.
+    """
+    quote = token[0]
+    body = token[1:-1].replace(quote * 2, quote)
+
+    def escape(match):
+        text = match.group(0)
+        if text == '"':
+            return '\\"'
+        if text == "\\'":
+            return "'"
+        return text
+    return json.loads('"' + re.sub(r'\\.|"', escape, body, flags=re.S) + '"')
+
+
+def tokenize(statement):
+    """
+    returns a list of (kind, value) tokens, keywords are lowercased and tagged "keyword".
+    """
+    tokens = list()
+    position = 0
+    positional = 0
+    while position < len(statement):
+        match = _token_re.match(statement, position)
+        if not match:
+            raise CBMockN1QLError("syntax error near: {0}".format(statement[position:position + 20]))
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "space":
+            continue
+        if kind == "number":
+            value = float(value) if re.search(r"[.eE]", value) else int(value)
+        elif kind == "string":
+            value = _unquote(value)
+        elif kind == "qident":
+            value = value[1:-1].replace("``", "`")
+        elif kind == "param":
+            if value == "?":
+                positional += 1
+                value = positional
+            else:
+                value = int(value[1:]) if value[1:].isdigit() else value[1:]
+        elif kind == "ident" and value.lower() in KEYWORDS:
+            kind, value = "keyword", value.lower()
+        tokens.append((kind, value))
+    tokens.append(("end", None))
+    return tokens
+
+
+class CBMockSelect(object):
+    """
+    A parsed SELECT statement, expressions are tuples like ("binary", "=", left, right).
+    """
+
+    def __init__(self):
+        self.explain = False
+        self.distinct = False
+        self.raw = False
+        self.projection = list()
+        self.keyspace = None
+        self.alias = None
+        self.use_keys = None
+        self.where = None
+        self.group_by = list()
+        self.having = None
+        self.order_by = list()
+        self.limit = None
+        self.offset = None
+
+
+class CBMockIndexDefinition(object):
+    """
+    A parsed CREATE [PRIMARY] INDEX or DROP [PRIMARY] INDEX statement.
+    """
+
+    def __init__(self):
+        self.drop = False
+        self.primary = False
+        self.name = None
+        self.keyspace = None
+        self.keys = list()
+        self.where = None
+
+
+_binary_precedence = {
+    "or": 1,
+    "and": 2,
+    "=": 4, "==": 4, "!=": 4, "<>": 4, "<": 4, "<=": 4, ">": 4, ">=": 4,
+    "like": 4, "in": 4, "between": 4, "is": 4, "not": 4,
+    "||": 5,
+    "+": 6, "-": 6,
+    "*": 7, "/": 7, "%": 7,
+}
+
+
+class CBMockN1QLParser(object):
+
+    def __init__(self, statement):
+        self.tokens = tokenize(statement)
+        self.position = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.position + offset]
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def at(self, *values):
+        kind, value = self.peek()
+        return kind in ("keyword", "op") and value in values
+
+    def accept(self, *values):
+        if self.at(*values):
+            return self.next()[1]
+        return None
+
+    def expect(self, *values):
+        if not self.at(*values):
+            raise CBMockN1QLError("expected {0} near {1!r}".format(" or ".join(values), self.peek()[1]))
+        return self.next()[1]
+
+    def identifier(self):
+        kind, value = self.next()
+        if kind not in ("ident", "qident"):
+            raise CBMockN1QLError("expected an identifier near {0!r}".format(value))
+        return value
+
+    def parse(self):
+        statement = self.statement()
+        self.accept(";")
+        if self.peek()[0] != "end":
+            raise CBMockN1QLError("unexpected {0!r}".format(self.peek()[1]))
+        return statement
+
+    def statement(self):
+        if self.accept("create"):
+            return self.create_index()
+        if self.accept("drop"):
+            return self.drop_index()
+        explain = bool(self.accept("explain"))
+        select = self.select()
+        select.explain = explain
+        return select
+
+    def keyspace(self):
+        keyspace = self.identifier()
+        if self.accept(":"):
+            keyspace = self.identifier()
+        return keyspace
+
+    def index_options(self):
+        """
+        skips USING GSI and WITH {...}, the mock builds every index right away.
+        """
+        if self.accept("using"):
+            self.identifier()
+        kind, value = self.peek()
+        if kind == "ident" and value.lower() == "with":
+            self.next()
+            self.expression()
+
+    def create_index(self):
+        definition = CBMockIndexDefinition()
+        definition.primary = bool(self.accept("primary"))
+        self.expect("index")
+        if not definition.primary or not self.at("on"):
+            definition.name = self.identifier()
+        self.expect("on")
+        definition.keyspace = self.keyspace()
+        if not definition.primary:
+            self.expect("(")
+            definition.keys.append(self.index_key())
+            while self.accept(","):
+                definition.keys.append(self.index_key())
+            self.expect(")")
+            if self.accept("where"):
+                definition.where = self.expression()
+        self.index_options()
+        return definition
+
+    def index_key(self):
+        expression = self.expression()
+        if self.accept("asc", "desc") == "desc":
+            raise CBMockN1QLError("descending index keys aren't supported")
+        return expression
+
+    def drop_index(self):
+        definition = CBMockIndexDefinition()
+        definition.drop = True
+        definition.primary = bool(self.accept("primary"))
+        self.expect("index")
+        if definition.primary:
+            self.expect("on")
+            definition.keyspace = self.keyspace()
+        else:
+            name = self.identifier()
+            if self.accept("on"):
+                definition.name, definition.keyspace = name, self.keyspace()
+            else:
+                self.expect(".")
+                definition.keyspace, definition.name = name, self.identifier()
+        self.index_options()
+        return definition
+
+    def select(self):
+        select = CBMockSelect()
+        self.expect("select")
+        select.distinct = bool(self.accept("distinct"))
+        self.accept("all")
+        select.raw = bool(self.accept("raw"))
+        select.projection.append(self.result_term())
+        while self.accept(","):
+            select.projection.append(self.result_term())
+        if self.accept("from"):
+            select.keyspace = self.keyspace()
+            self.accept("as")
+            if self.peek()[0] in ("ident", "qident"):
+                select.alias = self.identifier()
+        select.alias = select.alias or select.keyspace
+        if self.accept("use"):
+            self.accept("primary")
+            self.expect("keys")
+            select.use_keys = self.expression()
+        if self.accept("where"):
+            select.where = self.expression()
+        if self.accept("group"):
+            self.expect("by")
+            select.group_by.append(self.expression())
+            while self.accept(","):
+                select.group_by.append(self.expression())
+            if self.accept("having"):
+                select.having = self.expression()
+        if self.accept("order"):
+            self.expect("by")
+            select.order_by.append(self.order_term())
+            while self.accept(","):
+                select.order_by.append(self.order_term())
+        while self.at("limit", "offset"):
+            if self.next()[1] == "limit":
+                select.limit = self.expression()
+            else:
+                select.offset = self.expression()
+        return select
+
+    def result_term(self):
+        if self.accept("*"):
+            return ("star", None), None
+        expression = self.expression()
+        if expression[0] == "star":
+            return expression, None
+        name = None
+        if self.accept("as"):
+            name = self.identifier()
+        elif self.peek()[0] in ("ident", "qident"):
+            name = self.identifier()
+        return expression, name
+
+    def order_term(self):
+        expression = self.expression()
+        descending = self.accept("asc", "desc") == "desc"
+        return expression, descending
+
+    def expression(self, precedence=0):
+        left = self.prefix()
+        while True:
+            kind, value = self.peek()
+            if kind not in ("keyword", "op") or value not in _binary_precedence:
+                return left
+            operator_precedence = _binary_precedence[value]
+            if operator_precedence <= precedence:
+                return left
+            left = self.infix(left, operator_precedence)
+
+    def infix(self, left, precedence):
+        operator = self.next()[1]
+        if operator == "is":
+            negated = bool(self.accept("not"))
+            kind = self.expect("null", "missing", "valued")
+            return ("is", left, kind, negated)
+        negated = False
+        if operator == "not":
+            negated = True
+            operator = self.expect("like", "in", "between")
+        if operator == "like":
+            return ("like", left, self.expression(precedence), negated)
+        if operator == "in":
+            return ("in", left, self.expression(precedence), negated)
+        if operator == "between":
+            low = self.expression(_binary_precedence["and"])
+            self.expect("and")
+            return ("between", left, low, self.expression(precedence), negated)
+        operator = {"==": "=", "<>": "!="}.get(operator, operator)
+        return ("binary", operator, left, self.expression(precedence))
+
+    def prefix(self):
+        kind, value = self.next()
+        if kind == "number" or kind == "string":
+            node = ("literal", value)
+        elif kind == "param":
+            node = ("param", value)
+        elif kind == "keyword" and value in ("true", "false", "null", "missing"):
+            node = ("literal", {"true": True, "false": False, "null": None, "missing": MISSING}[value])
+        elif kind == "keyword" and value == "not":
+            node = ("not", self.expression(_binary_precedence["and"]))
+        elif kind == "op" and value == "-":
+            node = ("negate", self.expression(7))
+        elif kind == "op" and value == "(":
+            node = self.expression()
+            self.expect(")")
+        elif kind == "op" and value == "[":
+            items = list()
+            if not self.accept("]"):
+                items.append(self.expression())
+                while self.accept(","):
+                    items.append(self.expression())
+                self.expect("]")
+            node = ("array", items)
+        elif kind == "op" and value == "{":
+            pairs = list()
+            if not self.accept("}"):
+                while True:
+                    key_kind, key = self.next()
+                    if key_kind not in ("string", "ident", "qident"):
+                        raise CBMockN1QLError("expected an object key near {0!r}".format(key))
+                    self.expect(":")
+                    pairs.append((key, self.expression()))
+                    if not self.accept(","):
+                        break
+                self.expect("}")
+            node = ("object", pairs)
+        elif kind in ("ident", "qident"):
+            if kind == "ident" and self.at("("):
+                node = self.call(value.lower())
+            else:
+                node = ("identifier", value)
+        else:
+            raise CBMockN1QLError("unexpected {0!r}".format(value))
+        return self.postfix(node)
+
+    def call(self, name):
+        self.expect("(")
+        if self.accept("*"):
+            self.expect(")")
+            return ("call", name, [], False, True)
+        distinct = bool(self.accept("distinct"))
+        args = list()
+        if not self.accept(")"):
+            args.append(self.expression())
+            while self.accept(","):
+                args.append(self.expression())
+            self.expect(")")
+        return ("call", name, args, distinct, False)
+
+    def postfix(self, node):
+        while True:
+            if self.accept("."):
+                if self.accept("*"):
+                    node = ("star", node)
+                else:
+                    node = ("field", node, self.identifier())
+            elif self.accept("["):
+                node = ("element", node, self.expression())
+                self.expect("]")
+            else:
+                return node
+
+
+def parse(statement):
+    return CBMockN1QLParser(statement).parse()
+
+
+# values
+
+def _type_rank(value):
+    if value is MISSING:
+        return 0
+    if value is None:
+        return 1
+    if value is False:
+        return 2
+    if value is True:
+        return 3
+    if isinstance(value, (int, long, float)):
+        return 4
+    if isinstance(value, basestring):
+        return 5
+    if isinstance(value, (list, tuple)):
+        return 6
+    return 7
+
+
+def collation_key(value):
+    """
+    a sort key following N1QL's collation: MISSING < null < false < true < numbers <
+    strings < arrays < objects.
+    """
+    rank = _type_rank(value)
+    if rank == 4 or rank == 5:
+        return (rank, value)
+    if rank == 6:
+        return (rank, tuple(collation_key(item) for item in value))
+    if rank == 7:
+        return (rank, len(value), tuple((key, collation_key(value[key])) for key in sorted(value)))
+    return (rank,)
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def is_true(value):
+    """
+    whether WHERE and HAVING keep a row: MISSING, null, false, 0 and empty values don't.
+    """
+    return bool(value)
+
+
+def _compare(operator, left, right):
+    if left is MISSING or right is MISSING:
+        return MISSING
+    if left is None or right is None:
+        return None
+    if operator == "=":
+        return _type_rank(left) == _type_rank(right) and collation_key(left) == collation_key(right)
+    if operator == "!=":
+        return not (_type_rank(left) == _type_rank(right) and collation_key(left) == collation_key(right))
+    left, right = collation_key(left), collation_key(right)
+    if operator == "<":
+        return left < right
+    if operator == "<=":
+        return left <= right
+    if operator == ">":
+        return left > right
+    return left >= right
+
+
+def _arithmetic(operator, left, right):
+    if left is MISSING or right is MISSING:
+        return MISSING
+    if not _is_number(left) or not _is_number(right):
+        return None
+    if operator == "+":
+        return left + right
+    if operator == "-":
+        return left - right
+    if operator == "*":
+        return left * right
+    if right == 0:
+        return None
+    if operator == "/":
+        return float(left) / right
+    return left % right
+
+
+def _and(values):
+    if any(value is False for value in values):
+        return False
+    if any(value is MISSING for value in values):
+        return MISSING
+    if any(value is None for value in values):
+        return None
+    return all(is_true(value) for value in values)
+
+
+def _or(values):
+    if any(value is not MISSING and value is not None and is_true(value) for value in values):
+        return True
+    if any(value is None for value in values):
+        return None
+    if any(value is MISSING for value in values):
+        return MISSING
+    return False
+
+
+def _like(pattern):
+    regex = "".join(".*" if char == "%" else "." if char == "_" else re.escape(char) for char in pattern)
+    return re.compile(regex + r"\Z", re.S)
+
+
+def _round(value, digits=0):
+    return round(value, digits) if _is_number(value) else None
+
+
+def _number_function(function):
+    return lambda value, *args: function(value, *args) if _is_number(value) else None
+
+
+def _string_function(function):
+    return lambda value: function(value) if isinstance(value, basestring) else None
+
+
+def _length(value):
+    if isinstance(value, basestring):
+        return len(value)
+    return None
+
+
+def _to_number(value):
+    if _is_number(value):
+        return value
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, basestring):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def _to_string(value):
+    if isinstance(value, basestring):
+        return value
+    if value is None or isinstance(value, (list, dict)):
+        return None
+    return json.dumps(value)
+
+
+def _first(*values):
+    for value in values:
+        if value is not MISSING and value is not None:
+            return value
+    return None
+
+
+FUNCTIONS = {
+    "lower": _string_function(lambda value: value.lower()),
+    "upper": _string_function(lambda value: value.upper()),
+    "length": _length,
+    "array_length": lambda value: len(value) if isinstance(value, list) else None,
+    "abs": _number_function(abs),
+    "round": _round,
+    "floor": _number_function(lambda value: int(math.floor(value))),
+    "ceil": _number_function(lambda value: int(math.ceil(value))),
+    "contains": lambda value, part: part in value if isinstance(value, basestring) and isinstance(part, basestring) else None,
+    "array_contains": lambda value, item: item in value if isinstance(value, list) else None,
+    "tonumber": _to_number,
+    "tostring": _to_string,
+    "ifmissing": lambda *values: next((value for value in values if value is not MISSING), None),
+    "ifnull": lambda *values: next((value for value in values if value is not None), None),
+    "ifmissingornull": _first,
+}
+
+AGGREGATES = set(["count", "sum", "avg", "min", "max", "array_agg"])
+
+
+class CBMockN1QLRow(object):
+    """
+    what an expression is evaluated against: the keyspace document, its meta, the result
+    of the projection (for ORDER BY aliases) and the aggregates of its group.
+    """
+    __slots__ = ("doc", "meta", "result", "aggregates")
+
+    def __init__(self, doc, meta):
+        self.doc = doc
+        self.meta = meta
+        self.result = None
+        self.aggregates = None
+
+
+class _Aggregate(object):
+
+    def __init__(self, name, distinct, star, argument):
+        self.name = name
+        self.distinct = distinct
+        self.star = star
+        self.argument = argument
+
+    def start(self):
+        return {"count": 0, "total": 0, "value": MISSING, "items": list(), "seen": set()}
+
+    def add(self, state, row):
+        if self.star:
+            state["count"] += 1
+            return
+        value = self.argument(row)
+        if value is MISSING or (value is None and self.name != "array_agg"):
+            return
+        if self.distinct:
+            seen = json.dumps(value, sort_keys=True)
+            if seen in state["seen"]:
+                return
+            state["seen"].add(seen)
+        if self.name in ("sum", "avg"):
+            if not _is_number(value):
+                return
+            state["total"] += value
+        elif self.name in ("min", "max"):
+            current = state["value"]
+            if current is MISSING or (collation_key(value) < collation_key(current)) == (self.name == "min"):
+                state["value"] = value
+        elif self.name == "array_agg":
+            state["items"].append(value)
+        state["count"] += 1
+
+    def finish(self, state):
+        if self.name == "count":
+            return state["count"]
+        if self.name == "sum":
+            return state["total"] if state["count"] else None
+        if self.name == "avg":
+            return float(state["total"]) / state["count"] if state["count"] else None
+        if self.name in ("min", "max"):
+            return None if state["value"] is MISSING else state["value"]
+        return state["items"] if state["items"] else None
+
+
+class CBMockN1QLCompiler(object):
+    """
+    turns expression tuples into closures taking a CBMockN1QLRow.
+    """
+
+    def __init__(self, alias, params):
+        self.alias = alias
+        self.params = params
+        self.aggregates = list()
+
+    def compile(self, node, in_aggregate=False):
+        kind = node[0]
+        method = getattr(self, "_compile_" + kind)
+        return method(node, in_aggregate)
+
+    def _compile_literal(self, node, in_aggregate):
+        value = node[1]
+        return lambda row: value
+
+    def _compile_param(self, node, in_aggregate):
+        name = node[1]
+        if name not in self.params:
+            raise CBMockN1QLError("no value for parameter ${0}".format(name))
+        value = self.params[name]
+        return lambda row: value
+
+    def _compile_identifier(self, node, in_aggregate):
+        name = node[1]
+        alias = self.alias
+
+        def identifier(row):
+            if row.result is not None and name in row.result:
+                return row.result[name]
+            if name == alias:
+                return row.doc
+            if isinstance(row.doc, dict):
+                return row.doc.get(name, MISSING)
+            return MISSING
+        return identifier
+
+    def _compile_field(self, node, in_aggregate):
+        target = self.compile(node[1], in_aggregate)
+        name = node[2]
+
+        def field(row):
+            value = target(row)
+            if isinstance(value, dict):
+                return value.get(name, MISSING)
+            return MISSING
+        return field
+
+    def _compile_element(self, node, in_aggregate):
+        target = self.compile(node[1], in_aggregate)
+        index = self.compile(node[2], in_aggregate)
+
+        def element(row):
+            value = target(row)
+            position = index(row)
+            if isinstance(value, list) and _is_number(position):
+                try:
+                    return value[int(position)]
+                except IndexError:
+                    return MISSING
+            if isinstance(value, dict) and isinstance(position, basestring):
+                return value.get(position, MISSING)
+            return MISSING
+        return element
+
+    def _compile_array(self, node, in_aggregate):
+        items = [self.compile(item, in_aggregate) for item in node[1]]
+        return lambda row: [value for value in (item(row) for item in items) if value is not MISSING]
+
+    def _compile_object(self, node, in_aggregate):
+        pairs = [(key, self.compile(value, in_aggregate)) for key, value in node[1]]
+
+        def make_object(row):
+            result = dict()
+            for key, value in pairs:
+                value = value(row)
+                if value is not MISSING:
+                    result[key] = value
+            return result
+        return make_object
+
+    def _compile_star(self, node, in_aggregate):
+        raise CBMockN1QLError("* is only allowed in the projection")
+
+    def _compile_not(self, node, in_aggregate):
+        operand = self.compile(node[1], in_aggregate)
+
+        def negate(row):
+            value = operand(row)
+            if value is MISSING or value is None:
+                return value
+            return not is_true(value)
+        return negate
+
+    def _compile_negate(self, node, in_aggregate):
+        operand = self.compile(node[1], in_aggregate)
+        return lambda row: _arithmetic("-", 0, operand(row))
+
+    def _compile_binary(self, node, in_aggregate):
+        operator = node[1]
+        left = self.compile(node[2], in_aggregate)
+        right = self.compile(node[3], in_aggregate)
+        if operator == "and":
+            return lambda row: _and([left(row), right(row)])
+        if operator == "or":
+            return lambda row: _or([left(row), right(row)])
+        if operator == "||":
+            def concat(row):
+                a, b = left(row), right(row)
+                if a is MISSING or b is MISSING:
+                    return MISSING
+                if isinstance(a, basestring) and isinstance(b, basestring):
+                    return a + b
+                return None
+            return concat
+        if operator in ("+", "-", "*", "/", "%"):
+            return lambda row: _arithmetic(operator, left(row), right(row))
+        return lambda row: _compare(operator, left(row), right(row))
+
+    def _compile_is(self, node, in_aggregate):
+        operand = self.compile(node[1], in_aggregate)
+        kind, negated = node[2], node[3]
+
+        def test(row):
+            value = operand(row)
+            if kind == "null":
+                if value is MISSING:
+                    return MISSING
+                result = value is None
+            elif kind == "missing":
+                result = value is MISSING
+            else:
+                result = value is not None and value is not MISSING
+            return not result if negated else result
+        return test
+
+    def _compile_like(self, node, in_aggregate):
+        operand = self.compile(node[1], in_aggregate)
+        pattern = self.compile(node[2], in_aggregate)
+        negated = node[3]
+        patterns = dict()
+
+        def like(row):
+            value, text = operand(row), pattern(row)
+            if value is MISSING or text is MISSING:
+                return MISSING
+            if not isinstance(value, basestring) or not isinstance(text, basestring):
+                return None
+            if text not in patterns:
+                patterns[text] = _like(text)
+            result = bool(patterns[text].match(value))
+            return not result if negated else result
+        return like
+
+    def _compile_in(self, node, in_aggregate):
+        operand = self.compile(node[1], in_aggregate)
+        collection = self.compile(node[2], in_aggregate)
+        negated = node[3]
+
+        def contains(row):
+            value, items = operand(row), collection(row)
+            if value is MISSING or items is MISSING:
+                return MISSING
+            if value is None or not isinstance(items, list):
+                return None
+            result = any(_compare("=", value, item) is True for item in items)
+            return not result if negated else result
+        return contains
+
+    def _compile_between(self, node, in_aggregate):
+        operand = self.compile(node[1], in_aggregate)
+        low = self.compile(node[2], in_aggregate)
+        high = self.compile(node[3], in_aggregate)
+        negated = node[4]
+
+        def between(row):
+            value = operand(row)
+            result = _and([_compare(">=", value, low(row)), _compare("<=", value, high(row))])
+            if result is MISSING or result is None:
+                return result
+            return not result if negated else result
+        return between
+
+    def _compile_call(self, node, in_aggregate):
+        name, args, distinct, star = node[1:]
+        if name in AGGREGATES:
+            if in_aggregate:
+                raise CBMockN1QLError("aggregates can't be nested")
+            argument = None if star else self.compile(args[0], True)
+            position = len(self.aggregates)
+            self.aggregates.append(_Aggregate(name, distinct, star, argument))
+
+            def aggregate(row):
+                if row.aggregates is None:
+                    raise CBMockN1QLError("aggregates are only allowed in the projection, HAVING and ORDER BY")
+                return row.aggregates[position]
+            return aggregate
+        if name == "meta":
+            return lambda row: row.meta
+        if name not in FUNCTIONS:
+            raise CBMockN1QLError("unknown function {0}".format(name))
+        function = FUNCTIONS[name]
+        arguments = [self.compile(arg, in_aggregate) for arg in args]
+
+        def call(row):
+            values = [argument(row) for argument in arguments]
+            if name not in ("ifmissing", "ifnull", "ifmissingornull"):
+                if any(value is MISSING for value in values):
+                    return MISSING
+                if any(value is None for value in values):
+                    return None
+            return function(*values)
+        return call
+
+
+def _result_name(expression, position):
+    if expression[0] == "identifier":
+        return expression[1]
+    if expression[0] == "field":
+        return expression[2]
+    return "${0}".format(position)
+
+
+def _has_aggregate(node):
+    if not isinstance(node, tuple):
+        return False
+    if node[0] == "call" and node[1] in AGGREGATES:
+        return True
+    for part in node[1:]:
+        if isinstance(part, tuple) and _has_aggregate(part):
+            return True
+        if isinstance(part, list) and any(_has_aggregate(item) for item in part if isinstance(item, tuple)):
+            return True
+    return False
+
+
+class CBMockN1QLQuery(object):
+    """
+    Executes a CBMockSelect over a connection's documents as a pipeline of generators:
+    scan (USE KEYS fetches only those keys, an index scan only the entries in its span and
+    a covering one no documents at all) -> WHERE -> GROUP BY / aggregates -> HAVING
+    -> projection -> DISTINCT -> ORDER BY -> OFFSET / LIMIT. Without ORDER BY, GROUP BY or
+    DISTINCT, LIMIT stops the scan early, with ORDER BY it keeps only the top rows in a heap.
+    """
+
+    def __init__(self, connection, select, params, indexes=()):
+        self.connection = connection
+        self.select = select
+        self.compiler = CBMockN1QLCompiler(select.alias, params)
+        compile = self.compiler.compile
+        self.use_keys = compile(select.use_keys) if select.use_keys else None
+        self.where = compile(select.where) if select.where else None
+        self.group_by = [compile(expression) for expression in select.group_by]
+        self.projection = list()
+        for position, (expression, name) in enumerate(select.projection, 1):
+            if expression[0] == "star":
+                target = compile(expression[1]) if expression[1] else None
+                self.projection.append(("star", target, None))
+            else:
+                self.projection.append(("value", compile(expression), name or _result_name(expression, position)))
+        self.having = compile(select.having) if select.having else None
+        self.order_by = [(compile(expression), descending) for expression, descending in select.order_by]
+        self.limit = self._number(select.limit, "LIMIT")
+        self.offset = self._number(select.offset, "OFFSET") or 0
+        self.grouped = bool(select.group_by) or any(
+            _has_aggregate(node) for node in [expression for expression, name in select.projection] +
+            [select.having] + [expression for expression, descending in select.order_by])
+        self.plan = self.choose_plan(indexes)
+
+    def _number(self, node, clause):
+        if node is None:
+            return None
+        value = self.compiler.compile(node)(None)
+        if not _is_number(value) or value < 0:
+            raise CBMockN1QLError("{0} must be a non negative number".format(clause))
+        return int(value)
+
+    def choose_plan(self, indexes):
+        """
+        USE KEYS wins, then the best index that can answer the query, then a scan of every
+        document.
+        """
+        if self.select.keyspace is None:
+            return None
+        if self.use_keys is not None:
+            return CBMockKeyScan(self)
+        plans = [index.plan(self) for index in indexes]
+        plans = [plan for plan in plans if plan is not None]
+        if plans:
+            return max(plans, key=lambda plan: plan.score)
+        return CBMockKeyspaceScan(self)
+
+    def scan(self):
+        """
+        documents are read from a snapshot taken when the scan starts, released once the
+        results are exhausted or dropped. plans yield (key, parsed document, value), a
+        covering index has the document and a keyspace scan the value, the rest are fetched.
+        """
+        documents = self.connection.data.snapshot()
+        try:
+            for key, doc, value in self.plan.scan(documents):
+                if doc is None:
+                    if value is None:
+                        value = documents.get(key)
+                        if value is None:
+                            continue
+                    doc, ok = parse_document(value)
+                    if not ok:
+                        continue
+                yield CBMockN1QLRow(doc, {"id": key, "type": "json"})
+        finally:
+            documents.release()
+
+    def filtered(self, rows):
+        where = self.where
+        for row in rows:
+            if is_true(where(row)):
+                yield row
+
+    def groups(self, rows):
+        aggregates = self.compiler.aggregates
+        groups = dict()
+        order = list()
+        for row in rows:
+            key = json.dumps([collation_key(group(row)) for group in self.group_by])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (row, [aggregate.start() for aggregate in aggregates])
+                order.append(key)
+            for aggregate, state in zip(aggregates, group[1]):
+                aggregate.add(state, row)
+        if not groups and not self.group_by:
+            groups[None] = (CBMockN1QLRow(MISSING, None), [aggregate.start() for aggregate in aggregates])
+            order.append(None)
+        for key in order:
+            row, states = groups[key]
+            row.aggregates = [aggregate.finish(state) for aggregate, state in zip(aggregates, states)]
+            if self.having is None or is_true(self.having(row)):
+                yield row
+
+    def project(self, row):
+        if self.select.raw:
+            kind, expression, name = self.projection[0]
+            value = expression(row) if kind == "value" else row.doc
+            return MISSING if value is MISSING else value
+        result = dict()
+        for kind, expression, name in self.projection:
+            if kind == "star":
+                if expression is None:
+                    result[self.select.alias] = row.doc
+                else:
+                    value = expression(row)
+                    if isinstance(value, dict):
+                        result.update(value)
+            else:
+                value = expression(row)
+                if value is not MISSING:
+                    result[name] = value
+        return result
+
+    def projected(self, rows):
+        for row in rows:
+            result = self.project(row)
+            if result is MISSING:
+                continue
+            row.result = result if isinstance(result, dict) else dict()
+            yield row, result
+
+    def distinct(self, rows):
+        seen = set()
+        for row, result in rows:
+            key = json.dumps(result, sort_keys=True)
+            if key not in seen:
+                seen.add(key)
+                yield row, result
+
+    def sort_key(self):
+        order_by = self.order_by
+
+        def compare(a, b):
+            for (expression, descending), left, right in zip(order_by, a[0], b[0]):
+                result = cmp(collation_key(left), collation_key(right))
+                if result:
+                    return -result if descending else result
+            return cmp(a[1], b[1])
+        return cmp_to_key(compare)
+
+    def ordered(self, rows):
+        keyed = ((tuple(expression(row) for expression, descending in self.order_by), position, result)
+                 for position, (row, result) in enumerate(rows))
+        if self.limit is not None:
+            ordered = heapq.nsmallest(self.offset + self.limit, keyed, key=self.sort_key())
+        else:
+            ordered = sorted(keyed, key=self.sort_key())
+        for values, position, result in ordered:
+            yield result
+
+    def explain(self):
+        select = self.select
+        operators = list()
+        if self.plan is not None:
+            operators.append(self.plan.explain())
+            if not self.plan.covering:
+                operators.append({"#operator": "Fetch", "keyspace": select.keyspace, "as": select.alias})
+        if self.where is not None:
+            operators.append({"#operator": "Filter"})
+        if self.grouped:
+            operators.append({"#operator": "Group"})
+        operators.append({"#operator": "Project"})
+        if select.distinct:
+            operators.append({"#operator": "Distinct"})
+        if self.order_by:
+            operators.append({"#operator": "Order"})
+        if self.offset:
+            operators.append({"#operator": "Offset", "expr": self.offset})
+        if self.limit is not None:
+            operators.append({"#operator": "Limit", "expr": self.limit})
+        return {"plan": {"#operator": "Sequence", "~children": operators}}
+
+    def execute(self):
+        if self.select.keyspace is None:
+            rows = iter([CBMockN1QLRow(MISSING, None)])
+        else:
+            rows = self.scan()
+        if self.where is not None:
+            rows = self.filtered(rows)
+        if self.grouped:
+            rows = self.groups(rows)
+        rows = self.projected(rows)
+        if self.select.distinct:
+            rows = self.distinct(rows)
+        if self.order_by:
+            results = self.ordered(rows)
+        else:
+            results = (result for row, result in rows)
+        stop = None if self.limit is None else self.offset + self.limit
+        return itertools.islice(results, self.offset, stop)
+
+
+class CBMockKeyScan(object):
+    """
+    fetches only the USE KEYS documents.
+    """
+    score = None
+    covering = False
+
+    def __init__(self, query):
+        keys = query.use_keys(CBMockN1QLRow(None, None))
+        if isinstance(keys, basestring):
+            keys = [keys]
+        elif not isinstance(keys, list):
+            keys = []
+        self.keys = [key for key in keys if isinstance(key, basestring)]
+
+    def scan(self, documents):
+        for key in self.keys:
+            yield key, None, None
+
+    def explain(self):
+        return {"#operator": "KeyScan", "keys": self.keys}
+
+
+class CBMockKeyspaceScan(object):
+    """
+    visits every document, what's left when no index applies.
+    """
+    score = None
+    covering = False
+
+    def __init__(self, query):
+        pass
+
+    def scan(self, documents):
+        for key, value in documents.iteritems():
+            yield key, None, value
+
+    def explain(self):
+        return {"#operator": "KeyspaceScan"}
+
+
+def n1ql_params(args, kwargs):
+    """
+    positional arguments become $1, $2... and keyword arguments $name.
+    """
+    params = dict((position, value) for position, value in enumerate(args, 1))
+    for name, value in kwargs.iteritems():
+        params[name.lstrip("$")] = value
+    return params
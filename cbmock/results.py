@@ -0,0 +1,27 @@
+class CBMockResult(object):
+
+    def __init__(self, key):
+        self.rc = None
+        self.success = True
+        self.errstr = None
+        self.key = key
+
+
+class OperationResult(CBMockResult):
+
+    def __init__(self, key, cas=0):
+        super(OperationResult, self).__init__(key)
+        self.cas = cas
+
+
+class ValueResult(OperationResult):
+    
+    def __init__(self, key, value, cas=0):
+        super(ValueResult, self).__init__(key, cas)
+        self.value = value
+
+
+class MultiResult(dict):
+
+    def __init__(self):
+        self.all_ok = True
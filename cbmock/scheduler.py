@@ -0,0 +1,37 @@
+import heapq
+import itertools
+import threading
+
+
+class CBMockScheduler(object):
+    """
+    Calls due at some time, kept in one priority queue. Nothing runs them in the
+    background: the connection calls run_due() as it is used, so a scheduled call costs a
+    heap push and no thread.
+    """
+
+    def __init__(self):
+        self.queue = list()
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def schedule(self, deadline, function, *args):
+        with self._lock:
+            # the counter keeps calls due at the same time in order, and functions uncompared
+            heapq.heappush(self.queue, (deadline, next(self._order), function, args))
+
+    def run_due(self, now, limit=None):
+        """
+        runs up to limit calls due by now, outside the lock so they can schedule more.
+        returns how many ran.
+        """
+        due = list()
+        with self._lock:
+            while self.queue and self.queue[0][0] <= now and (limit is None or len(due) < limit):
+                due.append(heapq.heappop(self.queue))
+        for deadline, order, function, args in due:
+            function(*args)
+        return len(due)
+
+    def __len__(self):
+        return len(self.queue)
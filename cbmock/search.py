@@ -0,0 +1,186 @@
+import re
+import math
+import heapq
+import threading
+from collections import defaultdict
+from cbmock.views import CBMockDirtySet, parse_document
+
+
+_word_re = re.compile(r"\w+", re.UNICODE)
+_clause_re = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def tokenize(text):
+    return [word.lower() for word in _word_re.findall(text)]
+
+
+def parse_search_query(query):
+    """
+    splits a query into clauses, each a list of terms: single words are term clauses and
+    "quoted words" are phrase clauses.
+    """
+    clauses = list()
+    for phrase, word in _clause_re.findall(query):
+        terms = tokenize(phrase or word)
+        if terms:
+            clauses.append(terms)
+    return clauses
+
+
+def _field_values(doc, path):
+    for part in path:
+        if not isinstance(doc, dict) or part not in doc:
+            return
+        doc = doc[part]
+    values = doc if isinstance(doc, list) else [doc]
+    for value in values:
+        if isinstance(value, basestring):
+            yield value
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            yield unicode(value)
+
+
+class CBMockSearchIndex(object):
+    """
+    A stand-in for a full text search index: an inverted index of term -> {doc id:
+    positions} over some JSON fields of the bucket's documents, scored with BM25.
+
+    Like views it is built on the first search, after that writes only mark documents
+    dirty and every search catches up on them first.
+    """
+
+    FIELD_GAP = 100
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, connection, name, fields):
+        self.connection = connection
+        self.name = name
+        self.fields = list(fields)
+        self.paths = [tuple(field.split(".")) for field in self.fields]
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self.built = False
+        self.postings = dict()
+        self.doc_terms = dict()
+        self.doc_lengths = dict()
+        self.total_length = 0
+        self.dirty = CBMockDirtySet()
+
+    def mark_dirty(self, doc_id, document=None):
+        if self.built:
+            self.dirty.add(doc_id)
+
+    def refresh(self, keys=None):
+        with self._lock:
+            if not self.built:
+                if keys is None:
+                    self._reset()
+                    self.built = True
+                    with self.connection.data.snapshot() as documents:
+                        for key, value in documents.iteritems():
+                            self._index_document(key, value)
+                return
+            dirty = self.dirty.take(keys)
+            data = self.connection.data
+            for doc_id in dirty:
+                self._index_document(doc_id, data.get(doc_id))
+
+    def _tokens(self, doc):
+        """
+        yields (position, term), fields and list items are kept FIELD_GAP positions apart
+        so phrases don't match across them.
+        """
+        position = 0
+        for path in self.paths:
+            for text in _field_values(doc, path):
+                terms = tokenize(text)
+                for offset, term in enumerate(terms):
+                    yield position + offset, term
+                position += len(terms) + self.FIELD_GAP
+
+    def _index_document(self, doc_id, document):
+        self._remove_document(doc_id)
+        if document is None:
+            return
+        doc, ok = parse_document(document)
+        if not ok:
+            return
+        positions = dict()
+        length = 0
+        for position, term in self._tokens(doc):
+            positions.setdefault(term, list()).append(position)
+            length += 1
+        if not positions:
+            return
+        for term, term_positions in positions.iteritems():
+            self.postings.setdefault(term, dict())[doc_id] = term_positions
+        self.doc_terms[doc_id] = positions.keys()
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+
+    def _remove_document(self, doc_id):
+        terms = self.doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            posting = self.postings[term]
+            del posting[doc_id]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def search(self, query, limit=10):
+        """
+        returns the limit best scoring hits for a query of words and "quoted phrases",
+        documents matching any clause are hits.
+        """
+        self.refresh()
+        with self._lock:
+            scores = defaultdict(float)
+            for terms in parse_search_query(query):
+                self._score(terms, scores)
+            hits = heapq.nlargest(limit, scores.iteritems(), key=lambda hit: hit[1])
+        return [CBMockSearchHit(doc_id, score) for doc_id, score in hits]
+
+    def _score(self, terms, scores):
+        if len(terms) == 1:
+            matches = ((doc_id, len(positions)) for doc_id, positions in self.postings.get(terms[0], dict()).iteritems())
+        else:
+            matches = self._phrase_matches(terms)
+        idf = sum(self._idf(term) for term in terms)
+        average = float(self.total_length) / (len(self.doc_lengths) or 1)
+        for doc_id, frequency in matches:
+            norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[doc_id] / average)
+            scores[doc_id] += idf * frequency * (self.K1 + 1) / (frequency + norm)
+
+    def _idf(self, term):
+        documents = len(self.doc_lengths)
+        frequency = len(self.postings.get(term, ()))
+        return math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+
+    def _phrase_matches(self, terms):
+        """
+        yields (doc id, number of times the phrase occurs), walking the rarest term's postings.
+        """
+        postings = [self.postings.get(term) for term in terms]
+        if not all(postings):
+            return
+        for doc_id in min(postings, key=len):
+            if all(doc_id in posting for posting in postings):
+                following = [set(posting[doc_id]) for posting in postings[1:]]
+                frequency = 0
+                for start in postings[0][doc_id]:
+                    if all(start + offset in positions for offset, positions in enumerate(following, 1)):
+                        frequency += 1
+                if frequency:
+                    yield doc_id, frequency
+
+
+class CBMockSearchHit(object):
+
+    def __init__(self, docid, score):
+        self.docid = docid
+        self.score = score
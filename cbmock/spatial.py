@@ -0,0 +1,304 @@
+import itertools
+from cbmock.views import CBMockViewIndex, CBMockView, estimate_size
+
+
+def _area(bbox):
+    return (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+
+
+def _union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and b[2] <= a[2] and b[3] <= a[3]
+
+
+def _cover(entries):
+    bbox = entries[0][0]
+    for entry in entries[1:]:
+        bbox = _union(bbox, entry[0])
+    return bbox
+
+
+def _points(coordinates):
+    if isinstance(coordinates, (list, tuple)) and coordinates:
+        if isinstance(coordinates[0], (int, long, float)):
+            if len(coordinates) >= 2:
+                yield coordinates[0], coordinates[1]
+        else:
+            for child in coordinates:
+                for point in _points(child):
+                    yield point
+
+
+def _is_ranges(value):
+    return isinstance(value, (list, tuple)) and len(value) == 2 and all(
+        isinstance(bounds, (list, tuple)) and len(bounds) == 2 and
+        all(isinstance(bound, (int, long, float)) for bound in bounds) for bounds in value)
+
+
+def geometry_bbox(geometry):
+    """
+    returns (min x, min y, max x, max y) for a GeoJSON geometry, a bare [x, y] point or
+    the range form [[min x, max x], [min y, max y]], None if there is nothing to index.
+    a GeoJSON "bbox" member is used as it is.
+    """
+    if _is_ranges(geometry):
+        (min_x, max_x), (min_y, max_y) = geometry
+        return (min_x, min_y, max_x, max_y)
+    if isinstance(geometry, dict):
+        bbox = geometry.get("bbox")
+        if isinstance(bbox, (list, tuple)) and len(bbox) == 4:
+            return tuple(bbox)
+        if geometry.get("type") == "GeometryCollection":
+            boxes = [geometry_bbox(child) for child in geometry.get("geometries", ())]
+            boxes = [bbox for bbox in boxes if bbox]
+            return reduce(_union, boxes) if boxes else None
+        coordinates = geometry.get("coordinates")
+    else:
+        coordinates = geometry
+    points = list(_points(coordinates))
+    if not points:
+        return None
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+class _Node(object):
+    __slots__ = ("leaf", "entries")
+
+    def __init__(self, leaf, entries=None):
+        self.leaf = leaf
+        # [bbox, item] in leaves, [bbox, child node] otherwise
+        self.entries = entries or list()
+
+
+class CBMockRTree(object):
+    """
+    A Guttman R-tree with quadratic splits. Items are stored with their bounding boxes,
+    insert and delete are O(log n) and search only visits nodes overlapping the box.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.min_entries = max(2, int(max_entries * 0.4))
+        self.root = _Node(True)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, bbox, item):
+        self._insert_entry(tuple(bbox), item)
+        self.size += 1
+
+    def _insert_entry(self, bbox, item):
+        sibling = self._insert(self.root, bbox, item)
+        if sibling is not None:
+            self.root = _Node(False, [[_cover(self.root.entries), self.root], [_cover(sibling.entries), sibling]])
+
+    def _insert(self, node, bbox, item):
+        if node.leaf:
+            node.entries.append([bbox, item])
+        else:
+            entry = min(node.entries, key=lambda entry: (_area(_union(entry[0], bbox)) - _area(entry[0]), _area(entry[0])))
+            entry[0] = _union(entry[0], bbox)
+            sibling = self._insert(entry[1], bbox, item)
+            if sibling is not None:
+                entry[0] = _cover(entry[1].entries)
+                node.entries.append([_cover(sibling.entries), sibling])
+        if len(node.entries) > self.max_entries:
+            return self._split(node)
+        return None
+
+    def _split(self, node):
+        """
+        quadratic split, node keeps one group and the new sibling gets the other.
+        """
+        entries = node.entries
+        worst = None
+        for i, j in itertools.combinations(range(len(entries)), 2):
+            waste = _area(_union(entries[i][0], entries[j][0])) - _area(entries[i][0]) - _area(entries[j][0])
+            if worst is None or waste > worst[0]:
+                worst = (waste, i, j)
+        waste, i, j = worst
+        groups = [[entries[i]], [entries[j]]]
+        boxes = [entries[i][0], entries[j][0]]
+        remaining = [entry for position, entry in enumerate(entries) if position not in (i, j)]
+        while remaining:
+            for group in (0, 1):
+                if len(groups[group]) + len(remaining) <= self.min_entries:
+                    groups[group].extend(remaining)
+                    remaining = list()
+                    break
+            if not remaining:
+                break
+            best = None
+            for position, entry in enumerate(remaining):
+                growth = [_area(_union(boxes[group], entry[0])) - _area(boxes[group]) for group in (0, 1)]
+                difference = abs(growth[0] - growth[1])
+                if best is None or difference > best[0]:
+                    best = (difference, position, growth)
+            difference, position, growth = best
+            entry = remaining.pop(position)
+            if growth[0] != growth[1]:
+                group = 0 if growth[0] < growth[1] else 1
+            else:
+                group = 0 if len(groups[0]) <= len(groups[1]) else 1
+            groups[group].append(entry)
+            boxes[group] = _union(boxes[group], entry[0])
+        node.entries = groups[0]
+        return _Node(node.leaf, groups[1])
+
+    def delete(self, bbox, item):
+        """
+        returns False if the item wasn't stored under bbox.
+        """
+        orphans = list()
+        if not self._delete(self.root, tuple(bbox), item, orphans):
+            return False
+        self.size -= 1
+        while not self.root.leaf and len(self.root.entries) == 1:
+            self.root = self.root.entries[0][1]
+        if not self.root.entries:
+            self.root = _Node(True)
+        for orphan_bbox, orphan in orphans:
+            self._insert_entry(orphan_bbox, orphan)
+        return True
+
+    def _delete(self, node, bbox, item, orphans):
+        if node.leaf:
+            for position, (entry_bbox, entry_item) in enumerate(node.entries):
+                if entry_item == item and entry_bbox == bbox:
+                    del node.entries[position]
+                    return True
+            return False
+        for position, entry in enumerate(node.entries):
+            if _contains(entry[0], bbox) and self._delete(entry[1], bbox, item, orphans):
+                child = entry[1]
+                if len(child.entries) < self.min_entries:
+                    # condense the tree, whatever was under the child gets inserted again
+                    del node.entries[position]
+                    orphans.extend(self._leaf_entries(child))
+                else:
+                    entry[0] = _cover(child.entries)
+                return True
+        return False
+
+    def _leaf_entries(self, node):
+        if node.leaf:
+            return list(node.entries)
+        entries = list()
+        for bbox, child in node.entries:
+            entries.extend(self._leaf_entries(child))
+        return entries
+
+    def nodes(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            if not node.leaf:
+                stack.extend(child for bbox, child in node.entries)
+
+    def search(self, bbox=None):
+        """
+        yields (bbox, item) for every item overlapping bbox, or every item if bbox is None.
+        """
+        bbox = tuple(bbox) if bbox is not None else None
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for entry_bbox, child in node.entries:
+                if bbox is None or _intersects(entry_bbox, bbox):
+                    if node.leaf:
+                        yield entry_bbox, child
+                    else:
+                        stack.append(child)
+
+
+class CBMockSpatialIndex(CBMockViewIndex):
+    """
+    The emissions of a spatial map function, emit(geometry, value), kept in an R-tree
+    keyed by each geometry's bounding box.
+    """
+
+    def _reset(self):
+        super(CBMockSpatialIndex, self)._reset()
+        self.tree = CBMockRTree()
+
+    def _add_emissions(self, meta_data, emissions):
+        doc_id = meta_data["id"]
+        for position, (geometry, value) in enumerate(emissions):
+            bbox = geometry_bbox(geometry)
+            if bbox:
+                self.tree.insert(bbox, (doc_id, position))
+        self.doc_emissions[doc_id] = emissions
+
+    def _remove_emissions(self, doc_id):
+        self.doc_projections.pop(doc_id, None)
+        for position, (geometry, value) in enumerate(self.doc_emissions.pop(doc_id, ())):
+            bbox = geometry_bbox(geometry)
+            if bbox:
+                self.tree.delete(bbox, (doc_id, position))
+
+    def stats(self):
+        """
+        rows are the R-tree's entries, distinct keys their distinct bounding boxes.
+        """
+        with self._lock:
+            stats = super(CBMockSpatialIndex, self).stats()
+            tree = self.tree
+            stats["rows"] = len(tree)
+            stats["distinct_keys"] = len(set(bbox for bbox, item in tree.search()))
+            # nodes aren't containers to estimate_size, their entries are
+            stats["memory_bytes"] = estimate_size([tree.root, [node.entries for node in tree.nodes()],
+                                                   self.doc_emissions, self.doc_projections, self.memo])
+            return stats
+
+
+class CBMockSpatialView(CBMockView):
+    """
+    A spatial view, queried with a bounding box [min x, min y, max x, max y].
+    """
+
+    index_class = CBMockSpatialIndex
+
+    def __init__(self, connection, map_func, view_filter=None):
+        super(CBMockSpatialView, self).__init__(connection, map_func, None, view_filter)
+
+    def update(self, map_func, view_filter=None):
+        super(CBMockSpatialView, self).update(map_func, None, view_filter)
+
+    def query(self, bbox=None, include_docs=False, stale=None, limit=None, skip=0, explain=False, **kwargs):
+        if isinstance(bbox, basestring):
+            bbox = [float(part) for part in bbox.split(",")]
+        return self._query(stale, lambda trace: self._spatial_rows(bbox, include_docs, limit, skip, trace), explain)
+
+    def _spatial_rows(self, bbox, include_docs, limit, skip, trace):
+        results = list()
+        index = self.index
+        stop = None if limit is None else skip + limit
+        for item_bbox, (doc_id, position) in itertools.islice(index.tree.search(bbox), skip, stop):
+            geometry, value = index.doc_emissions[doc_id][position]
+            doc = self._fetch(doc_id, include_docs, trace)
+            results.append(CBMockSpatialViewRow(list(item_bbox), geometry, value, doc_id, doc))
+        # rows skipped were visited too
+        trace["rows_scanned"] = len(results) + skip if results else min(skip, len(index.tree))
+        return results
+
+
+class CBMockSpatialViewRow(object):
+
+    def __init__(self, bbox, geometry, value, docid, doc=None):
+        self.bbox = bbox
+        self.geometry = geometry
+        self.value = value
+        self.docid = docid
+        self.doc = doc
@@ -0,0 +1,445 @@
+import bisect
+import heapq
+import itertools
+import threading
+import zlib
+
+
+class _Absent(object):
+
+    def __repr__(self):
+        return "ABSENT"
+
+
+# what the history records for a key that didn't exist before a write
+ABSENT = _Absent()
+
+VBUCKETS = 1024
+
+# larger TTLs are unix times rather than seconds from now, like the server's
+RELATIVE_TTL_LIMIT = 30 * 24 * 60 * 60
+
+
+def expiry_time(ttl, now):
+    """
+    the unix time a document written at now with ttl expires at, 0 for never.
+    """
+    if not ttl:
+        return 0
+    if ttl <= RELATIVE_TTL_LIMIT:
+        return now + ttl
+    return ttl
+
+
+class CBMockChunks(object):
+    """
+    A string grown by appends and prepends, kept as chunks and joined when read, so
+    growing it is O(1) rather than a copy of the whole value.
+
+    Every version shares the chunk lists and only knows how many chunks are its own, an
+    append to the newest version adds to the list in place. Older versions, still read by
+    snapshots, never look past their own chunks.
+    """
+
+    __slots__ = ("front", "front_size", "back", "back_size")
+
+    def __init__(self, front, front_size, back, back_size):
+        # prepended chunks, last one first
+        self.front = front
+        self.front_size = front_size
+        # the value the chunks were added to, then the appended chunks
+        self.back = back
+        self.back_size = back_size
+
+    def append(self, chunk):
+        back = self.back
+        if len(back) != self.back_size:
+            # another version appended to the list already
+            back = back[:self.back_size]
+        back.append(chunk)
+        return CBMockChunks(self.front, self.front_size, back, self.back_size + 1)
+
+    def prepend(self, chunk):
+        front = self.front
+        if len(front) != self.front_size:
+            front = front[:self.front_size]
+        front.append(chunk)
+        return CBMockChunks(front, self.front_size + 1, self.back, self.back_size)
+
+    def join(self):
+        return "".join(self.front[self.front_size - 1::-1] if self.front_size else ()) + \
+            "".join(self.back[:self.back_size])
+
+
+class CBMockItem(object):
+    """
+    A stored document, its value, 64 bit CAS and expiry time (0 if it doesn't expire).
+    Never changed once stored, a write stores a new one.
+    """
+
+    __slots__ = ("raw", "cas", "expiry")
+
+    def __init__(self, value, cas, expiry=0):
+        self.raw = value
+        self.cas = cas
+        self.expiry = expiry
+
+    @property
+    def value(self):
+        raw = self.raw
+        if isinstance(raw, CBMockChunks):
+            # the same string every time, keeping it changes nothing a reader can see
+            raw = self.raw = raw.join()
+        return raw
+
+    def chunks(self):
+        raw = self.raw
+        if isinstance(raw, CBMockChunks):
+            return raw
+        return CBMockChunks(list(), 0, [raw], 1)
+
+    def expired(self, now):
+        return 0 < self.expiry <= now
+
+
+def vbucket(key, vbuckets=VBUCKETS):
+    """
+    the vBucket of a key, the way the client library maps it: bits 16 to 30 of the key's
+    CRC32, modulo the number of vBuckets.
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return ((zlib.crc32(key) & 0xffffffff) >> 16 & 0x7fff) % vbuckets
+
+
+class CBMockPartition(object):
+    """
+    The documents of one vBucket, with its own lock and sequence numbers.
+    """
+
+    def __init__(self, store, number):
+        self.store = store
+        self.number = number
+        self.current = dict()
+        self.history = dict()
+        self.seqno = 0
+        self.lock = threading.RLock()
+
+    def write(self, key, item):
+        with self.lock:
+            if item is ABSENT and key not in self.current:
+                raise KeyError(key)
+            self.seqno += 1
+            store = self.store
+            if store.pins:
+                # recorded before the new item is visible, see CBMockSnapshot._item
+                self.history.setdefault(key, list()).append((next(store.sequence), self.current.get(key, ABSENT)))
+                store.kept.add(self)
+            if item is ABSENT:
+                del self.current[key]
+            else:
+                self.current[key] = item
+
+    def trim(self, oldest):
+        """
+        forgets the versions replaced before sequence number oldest, the oldest one a
+        pinned snapshot reads, or all of them when oldest is None.
+        """
+        with self.lock:
+            if oldest is None:
+                self.history = dict()
+            for key, versions in self.history.items():
+                position = bisect.bisect_left(versions, (oldest,))
+                if position == len(versions):
+                    del self.history[key]
+                elif position:
+                    # a new list, readers may be looking at the old one
+                    self.history[key] = versions[position:]
+            if not self.history:
+                self.store.kept.discard(self)
+
+    def __len__(self):
+        return len(self.current)
+
+
+class CBMockStore(object):
+    """
+    The bucket's documents, a dict-like mapping of key -> value with multi version reads,
+    split by key into vBuckets like the real bucket.
+
+    Every write gets a sequence number in its vBucket. A reader pins a CBMockSnapshot,
+    which is just a bucket-wide sequence number, and sees the bucket as it was then however
+    long it takes: while any snapshot is pinned, writers take the next bucket-wide number
+    and keep the value each write replaced under it in a per-key history, and a snapshot
+    reads a key's newest version not replaced before its number. Histories are trimmed as
+    snapshots are released and dropped when none is left, so without readers a write costs
+    what a dict assignment does.
+
+    Writers only hold their vBucket's lock to order their write. A snapshot takes a
+    vBucket's lock once, the first time it reads from it, to wait out a write that was
+    under way when it was pinned.
+
+    Values are kept in CBMockItems with the CAS of the write that stored them, the mapping
+    methods deal in bare values and item() returns the whole thing.
+
+    Writes with an expiry time also go in a min-heap of (expiry, key, CAS), so the expired
+    documents can be found without looking at the others. Entries for documents written
+    again since are skipped when they come up.
+    """
+
+    def __init__(self, vbuckets=VBUCKETS):
+        self.vbuckets = vbuckets
+        self.partitions = [CBMockPartition(self, number) for number in range(vbuckets)]
+        self.pins = dict()
+        # snapshots garbage collected without a release(), done by the next release
+        self.dropped = list()
+        self._tokens = itertools.count()
+        self._cas = itertools.count(100)
+        self.sequence = itertools.count()
+        # the partitions with a history to trim
+        self.kept = set()
+        self._lock = threading.Lock()
+        self.expiries = list()
+        self._expiry_lock = threading.Lock()
+
+    def partition(self, key):
+        return self.partitions[vbucket(key, self.vbuckets)]
+
+    def lock_for(self, key):
+        return self.partition(key).lock
+
+    def peek_cas(self):
+        """
+        the CAS the next write gets, without taking it.
+        """
+        # a count pickles as the next number it yields
+        return self._cas.__reduce__()[1][0]
+
+    def next_cas(self):
+        # next() on a count is atomic, no lock needed
+        return next(self._cas)
+
+    def write(self, key, value, cas=None, expiry=0):
+        """
+        stores value under a new CAS, or the given one. returns the CAS.
+        """
+        if cas is None:
+            cas = self.next_cas()
+        self.partition(key).write(key, CBMockItem(value, cas, expiry))
+        if expiry:
+            with self._expiry_lock:
+                heapq.heappush(self.expiries, (expiry, key, cas))
+        return cas
+
+    def due(self, now, limit=None):
+        """
+        takes up to limit keys whose documents expired by now off the heap. they are only
+        candidates, the caller checks again under the key's lock.
+        """
+        keys = list()
+        expiries = self.expiries
+        # a slice is read in one go, another thread can't empty the heap in between
+        head = expiries[:1]
+        if not head or head[0][0] > now:
+            # nothing due, the common case for every write, without the lock
+            return keys
+        with self._expiry_lock:
+            while expiries and expiries[0][0] <= now and (limit is None or len(keys) < limit):
+                expiry, key, cas = heapq.heappop(expiries)
+                item = self.item(key)
+                if item is not None and item.cas == cas:
+                    keys.append(key)
+        return keys
+
+    def item(self, key):
+        return self.partition(key).current.get(key)
+
+    def __setitem__(self, key, value):
+        self.write(key, value)
+
+    def __delitem__(self, key):
+        self.partition(key).write(key, ABSENT)
+
+    def __getitem__(self, key):
+        return self.partition(key).current[key].value
+
+    def get(self, key, default=None):
+        item = self.partition(key).current.get(key)
+        return default if item is None else item.value
+
+    def __contains__(self, key):
+        return key in self.partition(key).current
+
+    def __len__(self):
+        return sum(len(partition.current) for partition in self.partitions)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [key for partition in self.partitions for key in partition.current.keys()]
+
+    def values(self):
+        return [item.value for partition in self.partitions for item in partition.current.values()]
+
+    def items(self):
+        return [(key, item.value) for partition in self.partitions for key, item in partition.current.items()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def counts(self):
+        """
+        the number of documents in every vBucket.
+        """
+        return [len(partition.current) for partition in self.partitions]
+
+    def snapshot(self):
+        self._release_dropped()
+        with self._lock:
+            token = next(self._tokens)
+            sequence = self.pins[token] = next(self.sequence)
+        return CBMockSnapshot(self, token, sequence)
+
+    def _release(self, token):
+        with self._lock:
+            sequence = self.pins.pop(token)
+            oldest = min(self.pins.itervalues()) if self.pins else None
+            if oldest is not None and oldest < sequence:
+                # an older snapshot still reads everything this one did
+                return
+            for partition in list(self.kept):
+                partition.trim(oldest)
+
+    def _release_dropped(self):
+        while True:
+            try:
+                # pop() is atomic, each token goes to one thread however many release at once
+                token = self.dropped.pop()
+            except IndexError:
+                return
+            self._release(token)
+
+    def versions(self):
+        """
+        how many replaced versions are kept for pinned snapshots.
+        """
+        self._release_dropped()
+        return sum(len(versions) for partition in list(self.kept) for versions in partition.history.values())
+
+
+class CBMockSnapshot(object):
+    """
+    A read only view of a CBMockStore as of a bucket-wide sequence number. release() it
+    (or use it as a context manager) once done, so the store can forget old versions.
+    """
+
+    def __init__(self, store, token, sequence):
+        self.store = store
+        self.token = token
+        self.sequence = sequence
+        # the vBuckets read from so far
+        self.synced = set()
+        self.released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def __del__(self):
+        if not self.released:
+            # runs whenever the collector decides, maybe under a vBucket lock: no locking here
+            self.released = True
+            self.store.dropped.append(self.token)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.store._release(self.token)
+            self.store._release_dropped()
+
+    def _partition(self, number):
+        partition = self.store.partitions[number]
+        if number not in self.synced:
+            # a write that didn't see the pin is over once its lock is free, and is in the
+            # snapshot. every later one keeps what it replaced
+            with partition.lock:
+                self.synced.add(number)
+        return partition
+
+    def _item(self, partition, key):
+        # the current item is read first: a write landing in between has recorded the
+        # item it replaced by then, so the history below still finds it
+        item = partition.current.get(key, ABSENT)
+        versions = partition.history.get(key)
+        if versions:
+            position = bisect.bisect_left(versions, (self.sequence,))
+            if position < len(versions):
+                item = versions[position][1]
+        return item
+
+    def _key_item(self, key):
+        return self._item(self._partition(vbucket(key, self.store.vbuckets)), key)
+
+    def item(self, key):
+        item = self._key_item(key)
+        return None if item is ABSENT else item
+
+    def get(self, key, default=None):
+        item = self._key_item(key)
+        return default if item is ABSENT else item.value
+
+    def __getitem__(self, key):
+        value = self.get(key, ABSENT)
+        if value is ABSENT:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._key_item(key) is not ABSENT
+
+    def keys(self):
+        return [key for key, value in self.iteritems()]
+
+    def __iter__(self):
+        for key, value in self.iteritems():
+            yield key
+
+    def iteritems(self, vbuckets=None):
+        """
+        vBucket by vBucket, only the given ones if any so a scan can be split between
+        workers.
+        """
+        for number in (range(self.store.vbuckets) if vbuckets is None else vbuckets):
+            partition = self._partition(number)
+            # current keys plus those deleted since, the ones that didn't exist yet are
+            # filtered out when read
+            keys = partition.current.keys()
+            if partition.history:
+                current = set(keys)
+                keys += [key for key in partition.history.keys() if key not in current]
+            for key in keys:
+                item = self._item(partition, key)
+                if item is not ABSENT:
+                    yield key, item.value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+    def __len__(self):
+        return sum(1 for item in self.iteritems())
@@ -1,27 +1,196 @@
 import subprocess
 import json
+import os
+import sys
+import threading
+import hashlib
+import tempfile
+import time
+from collections import OrderedDict, deque
 from traceback import print_exc
+from cbmock.analysis import argument_paths, project, infer_filter, normalize_source
+from cbmock.results import ValueResult
 
 
 
-emit_func = '''
+STALE_OK = "ok"
+STALE_FALSE = "false"
+STALE_UPDATE_AFTER = "update_after"
+
+
+map_batch_script = '''
+        var __rows = [], __errors = [], __i = 0;
         function emit(key, value) {
-            console.log(JSON.stringify({key: key, value: value}));
+            __rows.push([__i, key, value === undefined ? null : value]);
         }
+        var map = %s;
+        var __docs = %s;
+        for (__i = 0; __i < __docs.length; __i++) {
+            try {
+                map(__docs[__i][0], __docs[__i][1]);
+            } catch (e) {
+                __errors.push([__i, String(e)]);
+            }
+        }
+        console.log(JSON.stringify({rows: __rows, errors: __errors}));
     '''
 
 
-class CBMockView(object):
+def normalize_stale(stale):
+    """
+    maps the couchbase stale argument (True, False, "ok", "false", "update_after") onto
+    one of the STALE_ constants. unlike the server, the mock defaults to stale=false so
+    writes are visible to the next query.
+    """
+    if stale is None or stale is False:
+        return STALE_FALSE
+    if stale is True:
+        return STALE_OK
+    stale = str(stale).lower()
+    if stale not in (STALE_OK, STALE_FALSE, STALE_UPDATE_AFTER):
+        raise Exception("invalid stale value")
+    return stale
+
+
+def parse_document(document):
+    """
+    returns (doc, True) for anything a map function can see, (None, False) for non json strings.
+    """
+    if isinstance(document, basestring):
+        try:
+            return json.loads(document), True
+        except ValueError:
+            return None, False
+    return document, True
+
+
+def content_hash(document):
+    if isinstance(document, unicode):
+        document = document.encode("utf-8")
+    elif not isinstance(document, str):
+        document = json.dumps(document, sort_keys=True)
+    return hashlib.sha1(document).hexdigest()
+
+
+def emission_key(key):
     """
-        TODO - reduce
+    an emitted key as a dict key, arrays and objects go by their JSON.
+    """
+    if isinstance(key, (list, dict)):
+        return ("json", json.dumps(key, sort_keys=True))
+    return key
+
+
+def estimate_size(value):
+    """
+    rough number of bytes held by nested dicts, lists, tuples and scalars, objects shared
+    between several places are counted once.
+    """
+    seen = set()
+    total = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        total += sys.getsizeof(value)
+        if isinstance(value, dict):
+            stack.extend(value.iterkeys())
+            stack.extend(value.itervalues())
+        elif isinstance(value, (list, tuple, set, deque)):
+            stack.extend(value)
+    return total
+
+
+class CBMockDirtySet(set):
+    """
+    The documents written since an index last caught up. Writers add to it holding only
+    their vBucket's lock and the index takes them holding its own, so the set has its own
+    lock for the two to share.
+    """
+
+    def __init__(self):
+        super(CBMockDirtySet, self).__init__()
+        self._lock = threading.Lock()
+
+    def add(self, doc_id):
+        with self._lock:
+            set.add(self, doc_id)
+
+    def discard(self, doc_id):
+        with self._lock:
+            set.discard(self, doc_id)
+
+    def take(self, keys=None):
+        """
+        removes and returns the dirty documents, only those among keys if given.
+        """
+        with self._lock:
+            if keys is None:
+                taken = set(self)
+                self.clear()
+            else:
+                taken = self.intersection(keys)
+                self.difference_update(taken)
+        return taken
+
+
+def percentile(samples, fraction):
+    """
+    nearest rank percentile of a sorted list, None when it is empty.
+    """
+    if not samples:
+        return None
+    rank = max(int(round(fraction * len(samples) + 0.5)) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def data_fingerprint(hashes):
+    """
+    hashes maps doc id -> content_hash of the document.
+    """
+    fingerprint = hashlib.sha1()
+    for doc_id in sorted(hashes):
+        fingerprint.update(json.dumps([doc_id, hashes[doc_id]]))
+    return fingerprint.hexdigest()
+
+
+class CBMockViewIndex(object):
+    """
+        The emissions of one map function. Views with the same (normalized) map source
+        share an index through the connection, each layering its own reduce on top.
+
+        Indexes are built the first time they are queried (or eagerly via build_async).
+        After that writes only mark documents dirty, the index catches up when a query
+        asks for stale=false (the default) or stale=update_after.
+
         TODO - make PyV8 work, shelling out to node is slow.
     """
-    def __init__(self, connection, map_func, reduce_func=None):
+
+    MEMO_SIZE = 10000
+    LATENCY_SAMPLES = 1000
+    engine_checked = False
+
+    def __init__(self, connection, map_func, view_filter=None):
         self.connection = connection
         self.map_func = map_func
-        self.reduce_func = reduce_func
-        self._process(["node", "--version"])
-        self.map_emissions = dict()
+        self.view_filter = view_filter
+        self.refcount = 0
+        if not CBMockViewIndex.engine_checked:
+            self._process(["node", "--version"])
+            CBMockViewIndex.engine_checked = True
+        self._reset()
+        self.memo = OrderedDict()
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.memo_evictions = 0
+        self.build_seconds = None
+        self.engine_seconds = 0.0
+        self.documents_mapped = 0
+        self.map_latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self._lock = threading.RLock()
+        self._analyze()
 
     def _process(self, cmd, input_data=None):
         process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
@@ -31,69 +200,501 @@ class CBMockView(object):
         return stdout
 
     def _process_all(self):
+        """
+        rebuilds the whole index. with an index_cache_dir on the connection, emissions are
+        loaded from a snapshot of the same map source and only documents whose content
+        changed since it was saved are mapped again.
+        """
+        with self._lock:
+            self._reset()
+            # writes that land while building are marked dirty and picked up by the next refresh
+            self.built = True
+            with self.connection.data.snapshot() as documents:
+                items = documents.items()
+            snapshot = self._load_snapshot()
+            if snapshot is None:
+                self._map_documents([({"id": key}, value) for key, value in items])
+                return
+            cached = snapshot.get("docs")
+            hashes = dict((key, content_hash(value)) for key, value in items)
+            if snapshot.get("fingerprint") == data_fingerprint(hashes):
+                for key, (doc_hash, emissions) in cached.iteritems():
+                    self._add_emissions({"id": key}, emissions)
+                return
+            to_map = list()
+            for key, value in items:
+                entry = cached.get(key)
+                if entry is not None and entry[0] == hashes[key]:
+                    self._add_emissions({"id": key}, entry[1])
+                else:
+                    to_map.append(({"id": key}, value))
+            self._map_documents(to_map)
+
+    def _reset(self):
+        self.built = False
         self.map_emissions = dict()
-        items = self.connection.data
-        for key, value in items.iteritems():
-            self.map_item(value, {"id": key})
-        self._reduce_all()
-
-
-    # def _reduce_all(self):
-    #     pass
-
-    def update(self, map_func, reduce_func=None):
-        # reprocess = False
-        # reduce_changed = False
-        if map_func != self.map_func:
-            self.map_func = map_func
-            self._process_all()
-            # reprocess = True
-        # if reduce_func != self.reduce_func:
-        #     self.reduce_func = reduce_func
-        #     reduce_changed = True
-        # if reprocess:
-        #     self._process_all()
-        # elif reduce_changed:
-        #     self._reduce_all()
+        self.doc_emissions = dict()
+        self.doc_projections = dict()
+        self.dirty = CBMockDirtySet()
+
+    def build_async(self):
+        """
+        builds the index in a background thread, returns the thread.
+        """
+        thread = threading.Thread(target=self.refresh, name="cbmock-view-build")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def source_hash(self):
+        # the index is shared by map sources that only differ in comments and formatting
+        map_source = normalize_source(self.map_func)
+        source = map_source if self.view_filter is None else [map_source, self.view_filter]
+        return hashlib.sha1(json.dumps(source, sort_keys=True)).hexdigest()
+
+    def _snapshot_path(self):
+        cache_dir = getattr(self.connection, "index_cache_dir", None)
+        if cache_dir:
+            return os.path.join(cache_dir, "{0}.json".format(self.source_hash()))
+
+    def _load_snapshot(self):
+        path = self._snapshot_path()
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as fp:
+                    return json.load(fp)
+            except:
+                print_exc()
+
+    def save_snapshot(self):
+        """
+        writes the index to the connection's index_cache_dir, keyed by the map source and
+        a fingerprint of the documents it covers.
+        """
+        path = self._snapshot_path()
+        if not path or not self.built:
+            return
+        self.refresh()
+        with self._lock:
+            with self.connection.data.snapshot() as documents:
+                items = documents.items()
+            hashes = dict((key, content_hash(value)) for key, value in items)
+            snapshot = {
+                "map": self.map_func,
+                "fingerprint": data_fingerprint(hashes),
+                # documents the filter rules out aren't in the index, they aren't saved either
+                "docs": dict((key, [hashes[key], self.doc_emissions[key]])
+                             for key, value in items if key in self.doc_emissions),
+            }
+        cache_dir = os.path.dirname(path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(snapshot, fp)
+        os.rename(tmp_path, path)
+
+    def _analyze(self):
+        """
+        works out which document paths the map function reads. when it only looks at
+        meta.id, a document whose read paths are unchanged doesn't need to be mapped again.
+        """
+        paths = argument_paths(self.map_func, 0)
+        meta_paths = argument_paths(self.map_func, 1)
+        if paths is None or meta_paths is None or not meta_paths.issubset([("id",)]):
+            self.read_paths = None
+        else:
+            self.read_paths = sorted(paths)
+        self.meta_paths = None if meta_paths is None else sorted(meta_paths)
+        self.map_hash = hashlib.sha1(json.dumps(self.map_func)).hexdigest()
+        view_filter = self.view_filter or infer_filter(self.map_func)
+        self.filter = CBMockViewFilter(**view_filter) if view_filter else None
 
+    def _memo_key(self, document, meta_data):
+        """
+        map output only depends on the map source, the document and whatever it reads off meta.
+        """
+        if self.meta_paths is None:
+            meta = json.dumps(meta_data, sort_keys=True)
+        else:
+            meta = project(meta_data, self.meta_paths)
+        return (self.map_hash, content_hash(document), meta)
+
+    def _memo_get(self, memo_key):
+        emissions = self.memo.pop(memo_key, None)
+        if emissions is not None:
+            self.memo[memo_key] = emissions
+        return emissions
+
+    def _memo_put(self, memo_key, emissions):
+        self.memo[memo_key] = tuple(emissions)
+        while len(self.memo) > self.MEMO_SIZE:
+            self.memo.popitem(last=False)
+            self.memo_evictions += 1
+
+    def memo_stats(self):
+        lookups = self.memo_hits + self.memo_misses
+        return {
+            "size": len(self.memo),
+            "hits": self.memo_hits,
+            "misses": self.memo_misses,
+            "evictions": self.memo_evictions,
+            "hit_rate": float(self.memo_hits) / lookups if lookups else 0.0,
+        }
+
+    def needs_document(self, doc_id):
+        """
+        whether mark_dirty reads the document, to run the filter on it.
+        """
+        return self.built and self.filter is not None and doc_id not in self.doc_emissions
+
+    def mark_dirty(self, doc_id, document=None):
+        """
+        documents the filter rules out are only tracked if they are in the index already.
+        """
+        if not self.built:
+            return
+        if self.filter and doc_id not in self.doc_emissions and not self.filter.accepts(doc_id, document):
+            return
+        self.dirty.add(doc_id)
+
+    def refresh(self, keys=None):
+        """
+        maps every dirty document once, using whatever value it has now. keys limits the
+        refresh to those documents. an index that hasn't been built yet is built, unless keys
+        are given.
+        """
+        with self._lock:
+            if not self.built:
+                if keys is None:
+                    started = time.time()
+                    self._process_all()
+                    self.build_seconds = time.time() - started
+                return
+            dirty = self.dirty.take(keys)
+            if dirty:
+                data = self.connection.data
+                self._map_documents([({"id": doc_id}, data.get(doc_id)) for doc_id in dirty])
 
     def map_item(self, document, meta_data):
-        doc = document if isinstance(document, basestring) else json.dumps(document)
-        meta = json.dumps(meta_data)
-        # go through and remove this object from all emissions if it exists already
-        for emissions in self.map_emissions.values():
-            for emission in emissions:
-                _meta = emission.get("meta")
-                if _meta.get("id") == meta_data["id"]:
-                    emissions.remove(emission)
-        if document:
-            # if document is None then all we needed to do was remove it from the view emissions
+        with self._lock:
+            self.dirty.discard(meta_data["id"])
+            self._map_documents([(meta_data, document)])
+
+    def _map_documents(self, items):
+        """
+        items is a list of (meta, document) pairs, a None document removes it from the view.
+        documents the filter rules out never reach the map function, others are skipped
+        when nothing the map function reads has changed, reuse memoized
+        emissions when the same content was mapped before, and the rest go through a single
+        node process.
+        """
+        batch = list()
+        positions = dict()
+        waiting = list()
+        for meta_data, document in items:
+            doc_id = meta_data["id"]
+            doc, ok = (None, False) if document is None else parse_document(document)
+            if ok and self.filter and not self.filter.accepts_document(doc_id, doc):
+                ok = False
+            projection = None
+            if ok and self.read_paths is not None:
+                projection = project(doc, self.read_paths)
+                if doc_id in self.doc_emissions and self.doc_projections.get(doc_id) == projection:
+                    continue
+            self._remove_emissions(doc_id)
+            if ok:
+                if projection is not None:
+                    self.doc_projections[doc_id] = projection
+                memo_key = self._memo_key(document, meta_data)
+                emissions = self._memo_get(memo_key)
+                if emissions is not None:
+                    self.memo_hits += 1
+                    self._add_emissions(meta_data, emissions)
+                    continue
+                if memo_key in positions:
+                    self.memo_hits += 1
+                else:
+                    self.memo_misses += 1
+                    positions[memo_key] = len(batch)
+                    batch.append((doc, meta_data))
+                waiting.append((meta_data, memo_key))
+        results = self._timed_map(batch)
+        for memo_key, position in positions.iteritems():
+            self._memo_put(memo_key, results[position])
+        for meta_data, memo_key in waiting:
+            self._add_emissions(meta_data, results[positions[memo_key]])
+
+    def _timed_map(self, batch):
+        if not batch:
+            return self._run_map(batch)
+        started = time.time()
+        results = self._run_map(batch)
+        elapsed = time.time() - started
+        self.engine_seconds += elapsed
+        self.documents_mapped += len(batch)
+        # documents of a batch share one node run, each gets an even share of it
+        latency = elapsed / len(batch)
+        self.map_latencies.extend([latency] * min(len(batch), self.LATENCY_SAMPLES))
+        return results
+
+    def stats(self):
+        """
+        size and timings of the index. map latency is per document, over the last
+        LATENCY_SAMPLES documents mapped.
+        """
+        with self._lock:
+            latencies = sorted(self.map_latencies)
+            return {
+                "built": self.built,
+                "rows": sum(len(rows) for rows in self.map_emissions.itervalues()),
+                "distinct_keys": len(self.map_emissions),
+                "documents": len(self.doc_emissions),
+                "memory_bytes": estimate_size([self.map_emissions, self.doc_emissions, self.doc_projections,
+                                               self.memo]),
+                "build_seconds": self.build_seconds,
+                "engine_seconds": self.engine_seconds,
+                "documents_mapped": self.documents_mapped,
+                "map_latency": {
+                    "p50": percentile(latencies, 0.5),
+                    "p90": percentile(latencies, 0.9),
+                    "p99": percentile(latencies, 0.99),
+                    "samples": len(latencies),
+                },
+                "dirty": len(self.dirty),
+                "shared_by": self.refcount,
+                "memo": self.memo_stats(),
+            }
+
+    def _run_map(self, batch):
+        emissions = [list() for _ in batch]
+        if batch:
             try:
-                data = self._process(["node"], "{3};var map = {0};map({1}, {2});".format(self.map_func, doc, meta, emit_func))
-                if data:
-                    obj = json.loads(data)
-                    key = obj.get("key")
-                    value = obj.get("value")
-                    if key not in self.map_emissions:
-                        self.map_emissions[key] = list()
-                    self.map_emissions[key].append({"meta": meta_data, "value": value})
+                data = self._process(["node"], map_batch_script % (self.map_func, json.dumps(batch)))
+                output = json.loads(data.strip().splitlines()[-1])
             except:
                 print_exc()
+                return emissions
+            for index, key, value in output.get("rows"):
+                emissions[index].append((key, value))
+            for index, error in output.get("errors"):
+                sys.stderr.write("map failed for {0}: {1}\n".format(batch[index][1].get("id"), error))
+        return emissions
+
+    def _add_emissions(self, meta_data, emissions):
+        doc_id = meta_data["id"]
+        try:
+            for position, (key, value) in enumerate(emissions):
+                hashable = emission_key(key)
+                rows = self.map_emissions.get(hashable)
+                if rows is None:
+                    rows = self.map_emissions[hashable] = CBMockKeyRows(key)
+                rows[(doc_id, position)] = {"meta": meta_data, "value": value}
+        except:
+            print_exc()
+        self.doc_emissions[doc_id] = emissions
+
+    def _remove_emissions(self, doc_id):
+        self.doc_projections.pop(doc_id, None)
+        for position, (key, value) in enumerate(self.doc_emissions.pop(doc_id, ())):
+            hashable = emission_key(key)
+            rows = self.map_emissions.get(hashable)
+            if rows is not None:
+                rows.pop((doc_id, position), None)
+                if not rows:
+                    del self.map_emissions[hashable]
+
+
+class CBMockKeyRows(OrderedDict):
+    """
+    The rows emitted under one key, in the order they were emitted, by (doc id, position
+    in the document's emissions) so removing a document's rows doesn't go through the rest.
+    """
+
+    def __init__(self, key):
+        super(CBMockKeyRows, self).__init__()
+        self.key = key
+
+
+class CBMockViewFilter(object):
+    """
+    A condition a document must meet to emit anything, either declared on the view
+    ({"filter": {"key_prefix": "order::"}} or {"filter": {"field": "type", "value": "order"}})
+    or inferred from a guard wrapping the whole map function. It is checked in python so
+    unrelated documents never reach node.
+    """
+
+    def __init__(self, key_prefix=None, field=None, value=None):
+        self.key_prefix = key_prefix
+        self.field = tuple(field.split(".")) if field else None
+        self.value = value
+
+    def accepts(self, doc_id, document):
+        """
+        document is the stored value, None when it isn't known.
+        """
+        if document is None:
+            return self.key_prefix is None or doc_id.startswith(self.key_prefix)
+        doc, ok = parse_document(document)
+        return ok and self.accepts_document(doc_id, doc)
+
+    def accepts_document(self, doc_id, doc):
+        if self.key_prefix is not None and not doc_id.startswith(self.key_prefix):
+            return False
+        if self.field is None:
+            return True
+        for part in self.field:
+            if not isinstance(doc, dict) or part not in doc:
+                return False
+            doc = doc[part]
+        if doc is None:
+            return False
+        # javascript's == coerces, so only values of the same kind are compared
+        if isinstance(doc, basestring) and isinstance(self.value, basestring):
+            return doc == self.value
+        if isinstance(doc, (int, long, float)) and isinstance(self.value, (int, long, float)):
+            return doc == self.value
+        return True
+
+
+class CBMockView(object):
+    """
+        A view is a reduce function (TODO - reduce) over a possibly shared CBMockViewIndex.
+    """
+
+    index_class = CBMockViewIndex
+
+    def __init__(self, connection, map_func, reduce_func=None, view_filter=None):
+        self.connection = connection
+        self.reduce_func = reduce_func
+        self.index = connection.acquire_view_index(map_func, view_filter, self.index_class)
+
+    @property
+    def map_func(self):
+        return self.index.map_func
+
+    @property
+    def built(self):
+        return self.index.built
+
+    @property
+    def dirty(self):
+        return self.index.dirty
+
+    @property
+    def map_emissions(self):
+        return self.index.map_emissions
+
+    def refresh(self, keys=None):
+        self.index.refresh(keys)
+
+    def build_async(self):
+        return self.index.build_async()
+
+    def memo_stats(self):
+        return self.index.memo_stats()
+
+    def stats(self):
+        return self.index.stats()
+
+    def map_item(self, document, meta_data):
+        self.index.map_item(document, meta_data)
+
+    def update(self, map_func, reduce_func=None, view_filter=None):
+        """
+        a new map function or filter moves the view to another index, a new reduce function
+        keeps it.
+        """
+        if map_func != self.index.map_func or view_filter != self.index.view_filter:
+            index = self.connection.acquire_view_index(map_func, view_filter, self.index_class)
+            self.connection.release_view_index(self.index)
+            self.index = index
+        self.reduce_func = reduce_func
+
+    def release(self):
+        self.connection.release_view_index(self.index)
 
     def delete_from_view(self, document, meta_data):
         pass
 
-    def query(self, key=None, reduce=False, include_docs=False, query=None, **kwargs):
+    def query(self, key=None, reduce=False, include_docs=False, query=None, stale=None, explain=False, **kwargs):
+        """
+        with explain=True a dict is returned instead of the rows, with the rows under "rows"
+        and how the query went: rows scanned and returned, whether the index could answer
+        without running the map function, and where the time went.
+        """
         # TODO - support multi, range, and reduce
+        if stale is None and query is not None:
+            stale = query.stale
+        return self._query(stale, lambda trace: self._rows(key, include_docs, query, trace), explain)
+
+    def _query(self, stale, rows, explain=False):
+        """
+        brings the index up to date as stale asks and collects rows(trace) under its lock.
+        rows counts keys_scanned and rows_scanned in trace and adds the time it spends
+        fetching documents to include_docs_seconds.
+        """
+        stale = normalize_stale(stale)
+        index = self.index
+        self.connection.reap_expired()
+        # include_docs come from the bucket as it was when the query started
+        trace = {"keys_scanned": 0, "rows_scanned": 0, "include_docs_seconds": 0.0,
+                 "documents": self.connection.data.snapshot()}
+        engine_seconds, documents_mapped, memo_hits = index.engine_seconds, index.documents_mapped, index.memo_hits
+        started = time.time()
+        if stale == STALE_FALSE or not index.built:
+            # whatever stale says, an index is built by its first query
+            index.refresh()
+        refreshed = time.time()
+        try:
+            with index._lock:
+                results = rows(trace)
+        finally:
+            trace["documents"].release()
+        finished = time.time()
+        if explain:
+            explanation = {
+                "rows": results,
+                "stale": stale,
+                "keys_scanned": trace["keys_scanned"],
+                "rows_scanned": trace["rows_scanned"],
+                "rows_returned": len(results),
+                "cache_hit": index.documents_mapped == documents_mapped,
+                "documents_mapped": index.documents_mapped - documents_mapped,
+                "memo_hits": index.memo_hits - memo_hits,
+                "dirty": len(index.dirty),
+                "refresh_seconds": refreshed - started,
+                "engine_seconds": index.engine_seconds - engine_seconds,
+                "index_seconds": finished - refreshed - trace["include_docs_seconds"],
+                "include_docs_seconds": trace["include_docs_seconds"],
+            }
+        if stale == STALE_UPDATE_AFTER and self.connection.indexer is None:
+            # with a background indexer the dirty keys are already queued
+            index.refresh()
+        if explain:
+            explanation["total_seconds"] = time.time() - started
+            return explanation
+        return results
+
+    def _fetch(self, doc_id, include_docs, trace):
+        if not include_docs:
+            return None
+        started = time.time()
+        item = trace["documents"].item(doc_id)
+        doc = None if item is None else ValueResult(doc_id, item.value, item.cas)
+        trace["include_docs_seconds"] += time.time() - started
+        return doc
+
+    def _rows(self, key, include_docs, query, trace):
         results = list()
         if key:
-            data = self.map_emissions.get(key)
-            for item in data:
+            trace["keys_scanned"] += 1
+            data = self.map_emissions.get(emission_key(key), dict())
+            for item in data.itervalues():
                 meta = item.get("meta")
-                doc = None
-                if include_docs:
-                    doc = self.connection.get(meta.get("id"))
+                doc = self._fetch(meta.get("id"), include_docs, trace)
                 results.append(CBMockViewRow(key, item.get("value"), meta.get("id"), doc))
+            trace["rows_scanned"] += len(data)
         elif query:
             start = 0
             end = CBMockQuery.STRING_RANGE_END
@@ -103,24 +704,22 @@ class CBMockView(object):
             elif query.startkey or query.endkey:
                 start = query.startkey or 0
                 end = query.endkey or CBMockQuery.STRING_RANGE_END
-            for emissions_key in self.map_emissions:
-                if emissions_key >= start and emissions_key <= end:
-                    data = self.map_emissions.get(emissions_key)
-                    for item in data:
+            for data in self.map_emissions.itervalues():
+                trace["keys_scanned"] += 1
+                if data.key >= start and data.key <= end:
+                    for item in data.itervalues():
                         meta = item.get("meta")
-                        doc = None
-                        if include_docs:
-                            doc = self.connection.get(meta.get("id"))
+                        doc = self._fetch(meta.get("id"), include_docs, trace)
                         results.append(CBMockViewRow(key, item.get("value"), meta.get("id"), doc))
+                    trace["rows_scanned"] += len(data)
         else:
-            for emissions_key in self.map_emissions:
-                data = self.map_emissions.get(emissions_key)
-                for item in data:
+            for data in self.map_emissions.itervalues():
+                trace["keys_scanned"] += 1
+                for item in data.itervalues():
                     meta = item.get("meta")
-                    doc = None
-                    if include_docs:
-                        doc = self.connection.get(meta.get("id"))
-                    results.append(CBMockViewRow(emissions_key, item.get("value"), meta.get("id"), doc))
+                    doc = self._fetch(meta.get("id"), include_docs, trace)
+                    results.append(CBMockViewRow(data.key, item.get("value"), meta.get("id"), doc))
+                trace["rows_scanned"] += len(data)
         return results
 
 
@@ -137,10 +736,11 @@ class CBMockQuery(object):
     
     STRING_RANGE_END = json.loads('"\u0FFF"')
 
-    def __init__(self, startkey=None, endkey=None, mapkey_range=None):
+    def __init__(self, startkey=None, endkey=None, mapkey_range=None, stale=None):
         self.startkey = startkey
         self.endkey = endkey
         self.mapkey_range = mapkey_range
+        self.stale = stale
 
 
 
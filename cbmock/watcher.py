@@ -0,0 +1,77 @@
+import os
+import json
+import threading
+from traceback import print_exc
+
+
+def view_files(view_dir):
+    """
+    yields (view name, path) for every view definition under view_dir.
+    """
+    for dirname, dirnames, filenames in os.walk(view_dir):
+        for name in dirnames:
+            if name.startswith(".") or  name.startswith("_"):
+                dirnames.remove(name)
+        for filename in filenames:
+            if filename[0] != "_":
+                doc_id, ext = filename.split(".")
+                if doc_id:
+                    yield doc_id, os.path.join(dirname, filename)
+
+
+def read_design(view_dir):
+    design = dict()
+    for doc_id, path in view_files(view_dir):
+        with open(path, 'r') as fp:
+            data = fp.read()
+            design[doc_id] = json.loads(data)
+    return design
+
+
+class CBMockViewWatcher(threading.Thread):
+    """
+    Polls a view directory for changed files and hands the new design to design_create,
+    which only rebuilds views whose map function changed.
+    """
+
+    def __init__(self, connection, view_dir, design_name, poll_interval=1.0):
+        super(CBMockViewWatcher, self).__init__(name="cbmock-view-watcher")
+        self.daemon = True
+        self.connection = connection
+        self.view_dir = view_dir
+        self.design_name = design_name
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.signature = self._signature()
+
+    def _signature(self):
+        signature = dict()
+        for doc_id, path in view_files(self.view_dir):
+            stat = os.stat(path)
+            signature[path] = (stat.st_mtime, stat.st_size)
+        return signature
+
+    def poll(self):
+        """
+        returns True if the design doc was updated.
+        """
+        signature = self._signature()
+        if signature == self.signature:
+            return False
+        # a half written file fails to parse, it is picked up again on the next poll
+        design = read_design(self.view_dir)
+        self.signature = signature
+        if design == self.connection.design_docs.get(self.design_name):
+            return False
+        self.connection.design_create(self.design_name, {"views": design})
+        return True
+
+    def run(self):
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                self.poll()
+            except:
+                print_exc()
+
+    def stop(self):
+        self.stop_event.set()
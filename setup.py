@@ -12,6 +12,8 @@ nosetests -v --cover-package=cbmock --with-cover -s
 
 requires nodejs be installed.
 
+columnar snapshots need numpy, pip install py-mock-couchbase[columnar]
+
 
 The MIT License (MIT)
 
@@ -43,6 +45,7 @@ setup(
     license='MIT',
     packages=find_packages(),
     include_package_data=True,
+    extras_require={"columnar": ["numpy"]},
     description='py-mock-couchbase',
     long_description=README,
     url='https://github.com/SPSCommerce/py-mock-couchbase',
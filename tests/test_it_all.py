@@ -1,11 +1,41 @@
 import unittest
 from cbmock.connection import MockCouchbaseConnection
+from cbmock.views import CBMockViewIndex, parse_document
+from cbmock.store import CBMockStore, vbucket
+from cbmock.clock import CBMockManualClock
+from cbmock import n1ql
+from cbmock.analysis import argument_paths, infer_filter
+from cbmock.spatial import CBMockRTree, geometry_bbox
 import os
-from couchbase.exceptions import KeyExistsError, NotFoundError
+from couchbase.exceptions import DeltaBadvalError, KeyExistsError, NotFoundError, NotStoredError
 from babymaker import BabyMaker, StringType, IntType, EnumType, UUIDType
 import time
 import json
+import shutil
+import tempfile
+import random
+import threading
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def count_mapped(test, target, mapped=None):
+    """
+    wraps the _run_map of target, a view index or CBMockViewIndex for all of them, so the
+    id of every document mapped goes in mapped. undone when the test is cleaned up.
+    """
+    mapped = list() if mapped is None else mapped
+    run_map = target._run_map
+
+    def counting_run_map(*args):
+        mapped.extend(meta.get("id") for doc, meta in args[-1])
+        return run_map(*args)
+    target._run_map = counting_run_map
+    test.addCleanup(setattr, target, "_run_map", run_map)
+    return mapped
 
 
 class TestPreloadData(unittest.TestCase):
@@ -168,6 +198,39 @@ class TestLocking(unittest.TestCase):
         ghost_data = self.connection.get(key)
         self.assertEquals(data_2, ghost_data.value)
 
+    def test_lock_and_advance_the_clock_and_set(self):
+        clock = CBMockManualClock()
+        connection = MockCouchbaseConnection(clock=clock)
+        connection.set("key", "value")
+        connection.lock("key", 15)
+        clock.advance(14.9)
+        with self.assertRaises(KeyExistsError):
+            connection.set("key", "locked")
+        clock.advance(0.1)
+        connection.set("key", "unlocked")
+        connection.set("expiring", "value", ttl=60)
+        clock.advance(59)
+        self.assertEquals(connection.get("expiring").value, "value")
+        clock.advance(1)
+        self.assertRaises(NotFoundError, connection.get, "expiring")
+
+    def test_lock_timeouts_without_threads(self):
+        clock = CBMockManualClock()
+        connection = MockCouchbaseConnection(clock=clock)
+        threads = threading.active_count()
+        for i in range(1000):
+            connection.lock("key_{0}".format(i), 1 + i / 1000.0)
+        self.assertEquals((threading.active_count(), len(connection.scheduler)), (threads, 1000))
+        with self.assertRaises(KeyExistsError):
+            connection.set("key_0", "locked")
+        clock.advance(3)
+        connection.set("key_0", "unlocked lazily")
+        connection.lock("other")
+        # key_0 was released already, its deadline was the first of the batch
+        self.assertEquals(len(connection.locks), 1000 - connection.REAP_BATCH + 1)
+        connection.scheduler.run_due(clock.time())
+        self.assertEquals((connection.locks.keys(), len(connection.scheduler)), (["other"], 0))
+
 
 
 class TestViews(unittest.TestCase):
@@ -194,7 +257,8 @@ class TestViews(unittest.TestCase):
         for baby in self.some_babies:
             gender_counts[baby.gender] += 1
         results = self.connection.query("default", "all_doc_ids")
-        self.assertEquals(len(results), len(self.some_babies))
+        # the preloaded 2319.json document is indexed too, ok.txt isn't json
+        self.assertEquals(len(results), len(self.some_babies) + 1)
         results = self.connection.query("default", "all_doc_ids", key=self.some_babies[0].get("id"), include_docs=True)
         # print ""
         # print "-" * 80
@@ -261,3 +325,992 @@ class TestViews(unittest.TestCase):
         self.assertEquals(len(results), gender_counts["Female"])
 
 
+
+
+class TestDeferredIndexing(unittest.TestCase):
+
+    def setUp(self):
+        view_dir = os.path.join(os.path.dirname(__file__), "views")
+        self.connection = MockCouchbaseConnection(view_dir=view_dir)
+        self.view = self.connection.views["default"]["gender"]
+        self.connection.query("default", "gender")
+
+    def test_writes_only_mark_dirty(self):
+        self.connection.set("deferred_1", {"gender": "Male"})
+        self.connection.set("deferred_2", {"gender": "Female"})
+        self.assertEquals(self.view.dirty, set(["deferred_1", "deferred_2"]))
+        self.assertEquals(len(self.view.map_emissions), 0)
+        results = self.connection.query("default", "gender", stale="ok")
+        self.assertEquals(len(results), 0)
+        results = self.connection.query("default", "gender", key="Male")
+        self.assertEquals(len(results), 1)
+        self.assertEquals(len(self.view.dirty), 0)
+
+    def test_overwrites_are_mapped_once(self):
+        mapped = count_mapped(self, self.view.index)
+        for gender in ["Male", "Female", "Male", "Female"]:
+            self.connection.set("deferred_overwrite", {"gender": gender})
+        results = self.connection.query("default", "gender", stale=False)
+        self.assertEquals(mapped, ["deferred_overwrite"])
+        self.assertEquals(len(results), 1)
+        self.assertEquals(results[0].key, "Female")
+
+    def test_update_after(self):
+        self.connection.set("deferred_update_after", {"gender": "Male"})
+        results = self.connection.query("default", "gender", stale="update_after")
+        self.assertEquals(len(results), 0)
+        results = self.connection.query("default", "gender", stale=True)
+        self.assertEquals(len(results), 1)
+        self.connection.delete("deferred_update_after")
+        results = self.connection.query("default", "gender", stale=True)
+        self.assertEquals(len(results), 1)
+        results = self.connection.query("default", "gender")
+        self.assertEquals(len(results), 0)
+
+    def test_removing_rows_under_a_shared_key_scales(self):
+        index = self.view.index
+        count = 20000
+        for i in range(count):
+            index._add_emissions({"id": "doc_{0}".format(i)}, [("Male", None)])
+        started = time.time()
+        for i in range(count):
+            index._remove_emissions("doc_{0}".format(i))
+            index._add_emissions({"id": "doc_{0}".format(i)}, [("Female", None)])
+        # going through the other rows of the key each time takes minutes
+        self.assertTrue(time.time() - started < 5)
+        self.assertFalse("Male" in index.map_emissions)
+        self.assertEquals(len(index.map_emissions["Female"]), count)
+
+    def test_compound_keys(self):
+        self.connection.design_create("compound", {"views": {"by_type": {
+            "map": "function (doc, meta) { emit([doc.type, doc.n], {n: doc.n}); emit({type: doc.type}, null); }"}}})
+        self.connection.set("compound_1", {"type": "a", "n": 1})
+        self.connection.set("compound_2", {"type": "a", "n": 2})
+        results = self.connection.query("compound", "by_type", stale=False)
+        self.assertEquals(len(results), 4)
+        self.connection.set("compound_1", {"type": "b", "n": 1})
+        self.connection.delete("compound_2")
+        results = self.connection.query("compound", "by_type", key=["b", 1])
+        self.assertEquals([(row.docid, row.value) for row in results], [("compound_1", {"n": 1})])
+        self.assertEquals(sorted(row.key for row in self.connection.query("compound", "by_type")),
+                          [{"type": "b"}, ["b", 1]])
+
+
+class TestBackgroundIndexer(unittest.TestCase):
+
+    def setUp(self):
+        view_dir = os.path.join(os.path.dirname(__file__), "views")
+        self.connection = MockCouchbaseConnection(view_dir=view_dir, background_indexing=True)
+        self.connection.query("default", "gender")
+        self.connection.query("default", "all_doc_ids")
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_wait_for_index(self):
+        for i in range(50):
+            self.connection.set("background_%d" % i, {"id": "background_%d" % i, "gender": "Male"})
+        self.assertTrue(self.connection.wait_for_index(timeout=30))
+        stats = self.connection.index_lag()
+        self.assertEquals(stats["pending"], 0)
+        self.assertEquals(stats["indexed"], 50)
+        results = self.connection.query("default", "gender", key="Male", stale="ok")
+        self.assertEquals(len(results), 50)
+        self.assertEquals(len(self.connection.views["default"]["all_doc_ids"].dirty), 0)
+
+    def test_close_stops_the_thread(self):
+        indexer = self.connection.indexer
+        self.connection.close()
+        self.assertFalse(indexer.is_alive())
+
+    def test_consistent_query(self):
+        self.connection.set("background_consistent", {"gender": "Female"})
+        results = self.connection.query("default", "gender", key="Female", stale=False)
+        self.assertEquals(len(results), 1)
+
+
+class TestIndexSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.view_dir = os.path.join(os.path.dirname(__file__), "views")
+        for i, gender in enumerate(["Male", "Female", "Male"]):
+            self.write_doc("snapshot_%d" % i, {"id": "snapshot_%d" % i, "gender": gender})
+        self.mapped = count_mapped(self, CBMockViewIndex)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def write_doc(self, doc_id, doc):
+        with open(os.path.join(self.data_dir, doc_id + ".json"), "w") as fp:
+            json.dump(doc, fp)
+
+    def connect(self):
+        connection = MockCouchbaseConnection(self.data_dir, self.view_dir, index_cache_dir=self.cache_dir)
+        connection.query("default", "all_doc_ids")
+        connection.query("default", "gender")
+        return connection
+
+    def test_snapshot_skips_indexing(self):
+        self.connect().close()
+        self.assertEquals(len(self.mapped), 6)
+        del self.mapped[:]
+        connection = self.connect()
+        self.assertEquals(self.mapped, [])
+        results = connection.query("default", "gender", key="Male", stale="ok")
+        self.assertEquals(len(results), 2)
+
+    def test_snapshot_remaps_changed_documents(self):
+        self.connect().close()
+        del self.mapped[:]
+        self.write_doc("snapshot_1", {"id": "snapshot_1", "gender": "Male"})
+        connection = self.connect()
+        self.assertEquals(self.mapped, ["snapshot_1", "snapshot_1"])
+        results = connection.query("default", "gender", key="Male", stale="ok")
+        self.assertEquals(len(results), 3)
+
+    def test_snapshot_of_a_filtered_view(self):
+        map_func = "function (doc, meta) { if (doc.gender == 'Male') { emit(meta.id, null); } }"
+        for source in (map_func, map_func.replace(" {", "\n    {"), map_func):
+            connection = MockCouchbaseConnection(self.data_dir, index_cache_dir=self.cache_dir)
+            connection.design_create("males", {"views": {"by_id": {"map": source}}})
+            view = connection.views["males"]["by_id"]
+            self.assertEquals(len(view.query(stale="ok")), 2)
+            self.assertEquals(view.stats()["documents"], 2)
+            connection.close()
+        # the other sources only differ in formatting, they loaded the first one's snapshot
+        self.assertEquals(sorted(self.mapped), ["snapshot_0", "snapshot_2"])
+
+    def test_unbuilt_views_are_not_saved(self):
+        MockCouchbaseConnection(self.data_dir, self.view_dir, index_cache_dir=self.cache_dir).close()
+        self.assertEquals(os.listdir(self.cache_dir), [])
+
+
+class TestReadPathAnalysis(unittest.TestCase):
+
+    def test_argument_paths(self):
+        paths = argument_paths("function (doc, meta) { if (doc.address.city) { emit(doc['age'], doc.name.toUpperCase()); } }")
+        self.assertEquals(paths, set([("address", "city"), ("age",), ("name",)]))
+        self.assertEquals(argument_paths("function (doc, meta) { emit(meta.id, null); }", 1), set([("id",)]))
+        self.assertIsNone(argument_paths("function (doc, meta) { emit(Object.keys(doc), null); }"))
+        self.assertIsNone(argument_paths("function (doc, meta) { var field = 'age'; emit(doc[field], null); }"))
+        self.assertIsNone(argument_paths("function (doc, meta) { emit(arguments[0].age, null); }"))
+
+    def test_unread_fields_skip_map(self):
+        view_dir = os.path.join(os.path.dirname(__file__), "views")
+        connection = MockCouchbaseConnection(view_dir=view_dir)
+        view = connection.views["default"]["gender"]
+        connection.set("read_paths", {"gender": "Male", "name": "before"})
+        connection.query("default", "gender")
+        mapped = count_mapped(self, view.index)
+        connection.set("read_paths", {"gender": "Male", "name": "after"})
+        self.assertEquals(len(connection.query("default", "gender", key="Male")), 1)
+        self.assertEquals(mapped, [])
+        connection.set("read_paths", {"gender": "Female", "name": "after"})
+        self.assertEquals(len(connection.query("default", "gender", key="Female")), 1)
+        self.assertEquals(mapped, ["read_paths"])
+
+
+class TestMapMemo(unittest.TestCase):
+
+    def test_identical_documents_map_once(self):
+        view_dir = os.path.join(os.path.dirname(__file__), "views")
+        connection = MockCouchbaseConnection(view_dir=view_dir)
+        view = connection.views["default"]["gender"]
+        mapped = count_mapped(self, view.index)
+        for i in range(3):
+            connection.set("memo_%d" % i, {"gender": "Female"})
+        self.assertEquals(len(connection.query("default", "gender", key="Female")), 3)
+        self.assertEquals(len(mapped), 1)
+        connection.set("memo_3", json.dumps({"gender": "Female"}))
+        connection.set("memo_4", {"gender": "Female"})
+        self.assertEquals(len(connection.query("default", "gender", key="Female")), 5)
+        self.assertEquals(len(mapped), 1)
+        connection.set("memo_5", {"gender": "Male"})
+        self.assertEquals(len(connection.query("default", "gender", key="Male")), 1)
+        self.assertEquals(len(mapped), 2)
+        stats = view.memo_stats()
+        self.assertEquals(stats["hits"], 4)
+        self.assertEquals(stats["misses"], 2)
+        self.assertEquals(stats["size"], 2)
+        self.assertAlmostEquals(stats["hit_rate"], 4.0 / 6)
+
+
+class TestLazyViews(unittest.TestCase):
+
+    def setUp(self):
+        data_dir = os.path.join(os.path.dirname(__file__), "data")
+        view_dir = os.path.join(os.path.dirname(__file__), "views")
+        self.connection = MockCouchbaseConnection(data_dir, view_dir)
+        self.ddoc = {"views": {"by_id": {"map": "function (doc, meta) { emit(meta.id, null); }"}}}
+
+    def test_built_on_first_query(self):
+        self.connection.set("lazy_1", {"gender": "Male"})
+        views = self.connection.views["default"]
+        self.assertFalse(views["gender"].built)
+        self.assertEquals(len(views["gender"].dirty), 0)
+        self.assertEquals(len(self.connection.query("default", "gender", key="Male")), 1)
+        self.assertTrue(views["gender"].built)
+        self.assertFalse(views["all_doc_ids"].built)
+
+    def test_stale_ok_after_wait_for_index(self):
+        for i in range(5):
+            self.connection.set("lazy_{0}".format(i), {"gender": "Female"})
+        self.assertTrue(self.connection.wait_for_index())
+        self.assertTrue(self.connection.views["default"]["all_doc_ids"].built)
+        rows = self.connection.query("default", "gender", key="Female", stale="ok")
+        self.assertEquals(len([row for row in rows if row.docid.startswith("lazy_")]), 5)
+
+    def test_first_query_builds_whatever_stale_says(self):
+        self.connection.set("lazy_1", {"gender": "Female"})
+        rows = self.connection.query("default", "gender", key="Female", stale="update_after")
+        self.assertTrue("lazy_1" in [row.docid for row in rows])
+
+    def test_design_create_indexes_existing_documents(self):
+        self.connection.design_create("lazy", self.ddoc)
+        self.assertEquals(len(self.connection.query("lazy", "by_id", key="2319")), 1)
+
+    def test_syncwait_builds_eagerly(self):
+        self.connection.design_create("lazy", self.ddoc, syncwait=30)
+        view = self.connection.views["lazy"]["by_id"]
+        self.assertTrue(view.built)
+        self.assertEquals(len(self.connection.query("lazy", "by_id", stale="ok")), 1)
+
+    def test_design_publish_keeps_index(self):
+        self.connection.design_create("dev_lazy", self.ddoc, syncwait=30)
+        view = self.connection.views["dev_lazy"]["by_id"]
+        self.connection.design_publish("lazy")
+        self.assertNotIn("dev_lazy", self.connection.views)
+        self.assertIs(self.connection.views["lazy"]["by_id"], view)
+        self.assertEquals(len(self.connection.query("lazy", "by_id", stale="ok")), 1)
+        with self.assertRaises(NotFoundError):
+            self.connection.design_publish("lazy")
+
+    def test_design_publish_releases_replaced_views(self):
+        indexes = len(self.connection.view_indexes)
+        self.connection.design_create("lazy", {"views": {"by_name": {
+            "map": "function(doc, meta) { emit(doc.name, null); }"}}})
+        self.connection.design_create("dev_lazy", self.ddoc)
+        self.assertEquals(len(self.connection.view_indexes), indexes + 2)
+        self.connection.design_publish("lazy")
+        self.assertEquals(len(self.connection.view_indexes), indexes + 1)
+
+
+class TestViewHotReload(unittest.TestCase):
+
+    def setUp(self):
+        self.view_dir = tempfile.mkdtemp()
+        self.write_view("by_gender", "function (doc, meta) { emit(doc.gender, null); }")
+        self.write_view("by_name", "function (doc, meta) { emit(doc.name, null); }")
+        self.connection = MockCouchbaseConnection(view_dir=self.view_dir, watch_views=True)
+        self.watcher = self.connection.watchers[0]
+        self.watcher.stop()
+        self.connection.set("hot_reload", {"gender": "Male", "name": "Sam"})
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.view_dir)
+
+    def write_view(self, name, map_func):
+        with open(os.path.join(self.view_dir, name + ".json"), "w") as fp:
+            json.dump({"map": map_func}, fp)
+
+    def test_only_changed_views_rebuild(self):
+        self.assertEquals(len(self.connection.query("default", "by_gender", key="Male")), 1)
+        self.assertEquals(len(self.connection.query("default", "by_name", key="Sam")), 1)
+        views = self.connection.views["default"]
+        by_name = views["by_name"]
+        self.assertFalse(self.watcher.poll())
+        self.write_view("by_gender", "function (doc, meta) { emit(doc.gender.toLowerCase(), null); }")
+        self.write_view("by_age", "function (doc, meta) { emit(doc.age, null); }")
+        self.assertTrue(self.watcher.poll())
+        self.assertFalse(views["by_gender"].built)
+        self.assertIs(views["by_name"], by_name)
+        self.assertTrue(by_name.built)
+        self.assertIn("by_age", views)
+        self.assertEquals(len(self.connection.query("default", "by_gender", key="male")), 1)
+
+
+class TestSharedViewIndexes(unittest.TestCase):
+
+    def test_identical_maps_share_an_index(self):
+        connection = MockCouchbaseConnection()
+        gender_map = "function (doc, meta) { emit(doc.gender, null); }"
+        connection.design_create("dev_people", {"views": {"by_gender": {"map": gender_map}}})
+        connection.design_create("people", {"views": {
+            "by_gender": {"map": "function(doc,meta){\n  // same map\n  emit(doc.gender, null);\n}"},
+            "gender_count": {"map": gender_map, "reduce": "_count"},
+        }})
+        self.assertEquals(len(connection.view_indexes), 1)
+        index = connection.views["dev_people"]["by_gender"].index
+        self.assertIs(connection.views["people"]["gender_count"].index, index)
+        self.assertEquals(index.refcount, 3)
+        connection.set("shared_1", {"gender": "Male"})
+        self.assertEquals(len(connection.query("people", "by_gender", key="Male")), 1)
+        self.assertEquals(len(connection.query("dev_people", "by_gender", key="Male", stale="ok")), 1)
+        connection.design_delete("dev_people")
+        self.assertEquals(index.refcount, 2)
+        connection.design_create("people", {"views": {"by_gender": {"map": "function (doc, meta) { emit(doc.name, null); }"}}})
+        self.assertEquals(len(connection.view_indexes), 1)
+        self.assertIsNot(connection.views["people"]["by_gender"].index, index)
+
+    def test_string_literals_are_not_normalized(self):
+        connection = MockCouchbaseConnection()
+        connection.design_create("people", {"views": {
+            "a": {"map": "function (doc, meta) { emit('a  b', null); }"},
+            "b": {"map": "function (doc, meta) { emit('a b', null); }"},
+        }})
+        self.assertEquals(len(connection.view_indexes), 2)
+
+
+class TestViewFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+        self.connection.design_create("orders", {"views": {
+            "by_total": {"map": "function (doc, meta) { if (doc.type == 'order') { emit(doc.total, null); } }"},
+            "by_key": {"map": "function (doc, meta) { emit(meta.id, null); }", "filter": {"key_prefix": "order::"}},
+        }})
+        self.by_total = self.connection.views["orders"]["by_total"].index
+        self.by_key = self.connection.views["orders"]["by_key"].index
+        self.connection.set("order::1", {"type": "order", "total": 5})
+        self.connection.set("user::1", {"type": "user"})
+        self.mapped = list()
+        for index in (self.by_total, self.by_key):
+            count_mapped(self, index, self.mapped)
+
+    def test_infer_filter(self):
+        self.assertEquals(infer_filter("function (doc, meta) { if (doc.type === 'order' && doc.total) { emit(doc.total, null); } }"),
+                          {"field": "type", "value": "order"})
+        self.assertEquals(infer_filter("function (doc, meta) { if (meta.id.indexOf('order::') !== 0) return; emit(doc.total, null); }"),
+                          {"key_prefix": "order::"})
+        self.assertIsNone(infer_filter("function (doc, meta) { if (doc.type == 'order') { emit(doc.total, null); } emit(null, null); }"))
+        self.assertIsNone(infer_filter("function (doc, meta) { if (doc.type == 'order' || doc.paid) { emit(doc.total, null); } }"))
+
+    def test_filtered_documents_skip_the_engine(self):
+        self.assertEquals(len(self.connection.query("orders", "by_total")), 1)
+        self.assertEquals(len(self.connection.query("orders", "by_key")), 1)
+        self.assertEquals(sorted(self.mapped), ["order::1", "order::1"])
+        self.connection.set("user::2", {"type": "user"})
+        self.assertEquals(len(self.by_total.dirty), 0)
+        self.assertEquals(len(self.by_key.dirty), 0)
+
+    def test_documents_leaving_the_filter_are_removed(self):
+        self.assertEquals(len(self.connection.query("orders", "by_total")), 1)
+        self.connection.set("order::1", {"type": "refund", "total": 5})
+        self.assertEquals(self.by_total.dirty, set(["order::1"]))
+        self.assertEquals(len(self.connection.query("orders", "by_total")), 0)
+
+
+class TestSpatialViews(unittest.TestCase):
+
+    def test_rtree_matches_a_scan(self):
+        rng = random.Random(35)
+        tree = CBMockRTree(max_entries=8)
+        boxes = dict()
+        for i in range(400):
+            x, y = rng.uniform(-180, 180), rng.uniform(-90, 90)
+            boxes[i] = (x, y, x + rng.uniform(0, 5), y + rng.uniform(0, 5))
+            tree.insert(boxes[i], i)
+        for i in range(0, 400, 2):
+            self.assertTrue(tree.delete(boxes.pop(i), i))
+        self.assertFalse(tree.delete((0, 0, 0, 0), 1))
+        self.assertEquals(len(tree), 200)
+        for _ in range(20):
+            x, y = rng.uniform(-180, 180), rng.uniform(-90, 90)
+            query = (x, y, x + 40, y + 20)
+            expected = set(i for i, bbox in boxes.items()
+                           if bbox[0] <= query[2] and query[0] <= bbox[2] and bbox[1] <= query[3] and query[1] <= bbox[3])
+            self.assertEquals(set(item for bbox, item in tree.search(query)), expected)
+        self.assertEquals(len(list(tree.search())), 200)
+
+    def test_geometry_bbox(self):
+        self.assertEquals(geometry_bbox([-93.26, 44.98]), (-93.26, 44.98, -93.26, 44.98))
+        self.assertEquals(geometry_bbox([[-94, -93], [44, 45]]), (-94, 44, -93, 45))
+        self.assertEquals(geometry_bbox({"type": "Point", "coordinates": [1, 2], "bbox": [0, 0, 5, 5]}), (0, 0, 5, 5))
+        self.assertEquals(geometry_bbox({"type": "LineString", "coordinates": [[0, 3], [2, 1]]}), (0, 1, 2, 3))
+
+    def test_bbox_query(self):
+        connection = MockCouchbaseConnection()
+        connection.design_create("places", {"spatial": {
+            "points": "function (doc, meta) { if (doc.loc) { emit({type: 'Point', coordinates: doc.loc}, doc.name); } }",
+        }})
+        connection.set("minneapolis", {"name": "Minneapolis", "loc": [-93.26, 44.98]})
+        connection.set("st_paul", {"name": "St Paul", "loc": [-93.09, 44.95]})
+        connection.set("chicago", {"name": "Chicago", "loc": [-87.63, 41.88]})
+        results = connection.query_spatial("places", "points", bbox=[-94, 44, -93, 45])
+        self.assertEquals(sorted(row.value for row in results), ["Minneapolis", "St Paul"])
+        connection.set("chicago", {"name": "Chicago", "loc": [-93.2, 44.9]})
+        connection.delete("minneapolis")
+        results = connection.query_spatial("places", "points", bbox="-94,44,-93,45", include_docs=True)
+        self.assertEquals(sorted(row.docid for row in results), ["chicago", "st_paul"])
+        self.assertEquals(len(connection.query_spatial("places", "points", limit=1)), 1)
+        connection.set("st_paul_again", {"name": "St Paul", "loc": [-93.09, 44.95]})
+        connection.query_spatial("places", "points", stale=False)
+        stats = connection.spatial_views["places"]["points"].stats()
+        self.assertEquals((stats["rows"], stats["distinct_keys"], stats["documents"]), (3, 2, 3))
+        self.assertTrue(stats["memory_bytes"] > 0)
+
+
+class TestFullTextSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+        self.connection.search_index_create("products", ["name", "description", "tags"])
+        self.connection.set("lamp", {"name": "Desk lamp", "description": "A small brass desk lamp", "tags": ["office"]})
+        self.connection.set("desk", {"name": "Standing desk", "description": "An oak desk", "tags": ["office", "furniture"]})
+        self.connection.set("rug", {"name": "Wool rug", "description": "Hand woven", "tags": ["furniture"]})
+
+    def test_term_query(self):
+        hits = self.connection.search("products", "desk")
+        self.assertEquals(sorted(hit.docid for hit in hits), ["desk", "lamp"])
+        self.assertTrue(all(hit.score > 0 for hit in hits))
+        hits = self.connection.search("products", "furniture wool")
+        self.assertEquals(hits[0].docid, "rug")
+        self.assertEquals(len(self.connection.search("products", "desk", limit=1)), 1)
+
+    def test_phrase_query(self):
+        hits = self.connection.search("products", '"desk lamp"')
+        self.assertEquals([hit.docid for hit in hits], ["lamp"])
+        self.assertEquals(self.connection.search("products", '"lamp desk"'), [])
+        # phrases don't run from one field into the next
+        self.assertEquals(self.connection.search("products", '"lamp a"'), [])
+
+    def test_incremental_updates(self):
+        self.connection.search("products", "desk")
+        self.connection.set("rug", {"name": "Desk rug"})
+        self.connection.delete("lamp")
+        hits = self.connection.search("products", "desk")
+        self.assertEquals(sorted(hit.docid for hit in hits), ["desk", "rug"])
+        self.assertEquals(self.connection.search("products", "wool"), [])
+
+
+class TestN1QL(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+        self.connection.set("user::1", {"type": "user", "name": "Ann", "age": 31, "city": "Oslo"})
+        self.connection.set("user::2", {"type": "user", "name": "Bob", "age": 25, "city": "Rome"})
+        self.connection.set("user::3", {"type": "user", "name": "Cid", "age": 40, "city": "Oslo"})
+        self.connection.set("order::1", {"type": "order", "user": "user::1", "total": 12.5})
+        self.connection.set("blob", "not json")
+
+    def test_select(self):
+        rows = list(self.connection.n1ql_query(
+            "SELECT name, age FROM bucket WHERE type = 'user' AND age > $1 ORDER BY age DESC", 30))
+        self.assertEquals(rows, [{"name": "Cid", "age": 40}, {"name": "Ann", "age": 31}])
+        rows = list(self.connection.n1ql_query(
+            "SELECT META(b).id, b.name AS who FROM bucket b WHERE b.name LIKE $pattern", pattern="B%"))
+        self.assertEquals(rows, [{"id": "user::2", "who": "Bob"}])
+        rows = list(self.connection.n1ql_query(
+            "SELECT RAW name FROM bucket WHERE type = 'user' ORDER BY name LIMIT 2 OFFSET 1"))
+        self.assertEquals(rows, ["Bob", "Cid"])
+        rows = list(self.connection.n1ql_query("SELECT * FROM bucket USE KEYS ['order::1', 'nope']"))
+        self.assertEquals(rows, [{"bucket": {"type": "order", "user": "user::1", "total": 12.5}}])
+
+    def test_group_by(self):
+        rows = list(self.connection.n1ql_query(
+            "SELECT city, COUNT(*) AS users, AVG(age) AS age FROM bucket WHERE type = 'user' "
+            "GROUP BY city HAVING COUNT(*) > 1"))
+        self.assertEquals(rows, [{"city": "Oslo", "users": 2, "age": 35.5}])
+        rows = list(self.connection.n1ql_query("SELECT MAX(age) AS oldest, SUM(total) AS total FROM bucket"))
+        self.assertEquals(rows, [{"oldest": 40, "total": 12.5}])
+
+    def test_limit_stops_the_scan(self):
+        parsed = list()
+
+        def counting_parse_document(document):
+            parsed.append(document)
+            return parse_document(document)
+        n1ql.parse_document = counting_parse_document
+        try:
+            rows = list(self.connection.n1ql_query("SELECT RAW META().id FROM bucket LIMIT 1"))
+            self.assertEquals(len(rows), 1)
+            self.assertTrue(len(parsed) < len(self.connection.data))
+            del parsed[:]
+            list(self.connection.n1ql_query("SELECT * FROM bucket USE KEYS 'user::2'"))
+            self.assertEquals(parsed, [self.connection.data["user::2"]])
+        finally:
+            n1ql.parse_document = parse_document
+        self.assertRaises(Exception, self.connection.n1ql_query, "SELECT FROM")
+
+
+class TestN1QLIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+        for i in range(50):
+            self.connection.set("user::{0}".format(i), {"type": "user", "age": i, "name": "user {0}".format(i)})
+        self.connection.n1ql_query("CREATE INDEX idx_age ON bucket(type, age)")
+
+    def explain(self, statement):
+        return list(self.connection.n1ql_query("EXPLAIN " + statement))[0]["plan"]["~children"][0]
+
+    def test_index_scan(self):
+        statement = "SELECT name FROM bucket WHERE type = 'user' AND age >= 10 AND age < 13"
+        scan = self.explain(statement)
+        self.assertEquals(scan["#operator"], "IndexScan")
+        self.assertEquals(scan["index"], "idx_age")
+        self.assertEquals(scan["spans"], [{"low": ["user", 10], "high": ["user", 13], "inclusion": 1}])
+        self.assertFalse(scan["covering"])
+        rows = list(self.connection.n1ql_query(statement))
+        self.assertEquals(sorted(row["name"] for row in rows), ["user 10", "user 11", "user 12"])
+        self.assertEquals(self.explain("SELECT name FROM bucket WHERE age = 3")["#operator"], "KeyspaceScan")
+
+    def test_covering_scan(self):
+        statement = "SELECT RAW age FROM bucket b WHERE b.type = 'user' AND b.age > 47"
+        self.assertTrue(self.explain(statement)["covering"])
+        self.connection.data = CBMockStore()
+        self.assertEquals(sorted(self.connection.n1ql_query(statement)), [48, 49])
+
+    def test_index_maintenance(self):
+        statement = "SELECT RAW META().id FROM bucket WHERE type = 'user' AND age = 7"
+        self.connection.set("user::7", {"type": "user", "age": 70})
+        self.connection.set("user::new", {"type": "user", "age": 7})
+        self.connection.delete("user::new")
+        self.connection.set("other", {"type": "user", "age": 7})
+        self.assertEquals(list(self.connection.n1ql_query(statement)), ["other"])
+        self.connection.n1ql_query("DROP INDEX bucket.idx_age")
+        self.assertEquals(self.explain(statement)["#operator"], "KeyspaceScan")
+        self.connection.n1ql_query("CREATE PRIMARY INDEX ON bucket")
+        self.assertEquals(self.explain(statement)["#operator"], "PrimaryScan")
+        self.assertRaises(KeyExistsError, self.connection.n1ql_query, "CREATE PRIMARY INDEX ON bucket")
+
+    def test_writes_during_build(self):
+        data = self.connection.data
+        snapshot = data.snapshot
+
+        def write_while_building():
+            pinned = snapshot()
+            # lands after the index pinned its snapshot, before it is built
+            self.connection.set("user::7", {"type": "user", "age": 70})
+            return pinned
+        data.snapshot = write_while_building
+        self.connection.n1ql_query("CREATE INDEX idx_name ON bucket(type, name)")
+        del data.snapshot
+        statement = "SELECT RAW name FROM bucket WHERE type = 'user' AND name = 'user 7'"
+        self.assertEquals(self.explain(statement)["index"], "idx_name")
+        self.assertEquals(list(self.connection.n1ql_query(statement)), [])
+
+
+@unittest.skipIf(numpy is None, "numpy isn't installed")
+class TestColumnarSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+        self.connection.set("order::1", {"type": "order", "status": "open", "amount": 10, "customer": {"region": "eu"}})
+        self.connection.set("order::2", {"type": "order", "status": "open", "amount": 5.5, "customer": {"region": "us"}})
+        self.connection.set("order::3", {"type": "order", "status": "shipped", "amount": 20, "customer": {"region": "eu"}})
+        self.connection.set("user::1", {"type": "user", "name": "Ann"})
+        self.snapshot = self.connection.columnar_snapshot(["type", "status", "amount", "customer.region"])
+
+    def tearDown(self):
+        self.snapshot.close()
+
+    def test_aggregate(self):
+        totals = self.snapshot.aggregate({"rows": ("count", None), "total": ("sum", "amount"),
+                                          "largest": ("max", "amount"), "first": ("min", "status")})
+        self.assertEquals(totals, {"rows": 4, "total": 35.5, "largest": 20, "first": "open"})
+        by_status = self.snapshot.aggregate({"orders": ("count", "amount"), "average": ("avg", "amount")},
+                                            group_by="status", where={"type": "order"})
+        self.assertEquals(by_status, [{"status": "open", "orders": 2, "average": 7.75},
+                                      {"status": "shipped", "orders": 1, "average": 20}])
+        by_region = self.snapshot.aggregate({"total": ("sum", "amount")}, group_by=["customer.region", "status"])
+        self.assertEquals(by_region, [
+            {"customer.region": None, "status": None, "total": None},
+            {"customer.region": "eu", "status": "open", "total": 10},
+            {"customer.region": "eu", "status": "shipped", "total": 20},
+            {"customer.region": "us", "status": "open", "total": 5.5},
+        ])
+
+    def test_incremental_refresh(self):
+        self.snapshot.aggregate({"rows": ("count", None)})
+        self.connection.delete("order::1")
+        self.connection.set("order::2", {"type": "order", "status": "shipped", "amount": 1})
+        for i in range(4, 40):
+            self.connection.set("order::{0}".format(i), {"type": "order", "status": "new", "amount": i})
+        self.assertEquals(len(self.snapshot.dirty), 38)
+        result = self.snapshot.aggregate({"total": ("sum", "amount")}, group_by="status")
+        self.assertEquals(result, [{"status": None, "total": None}, {"status": "new", "total": sum(range(4, 40))},
+                                   {"status": "shipped", "total": 21}])
+        self.assertEquals(len(self.snapshot), 39)
+        self.assertEquals(self.snapshot.dirty, set())
+
+
+class TestViewStats(unittest.TestCase):
+
+    def setUp(self):
+        view_dir = os.path.join(os.path.dirname(__file__), "views")
+        self.connection = MockCouchbaseConnection(view_dir=view_dir)
+        for i in range(4):
+            self.connection.set("stats_%d" % i, {"gender": "Female" if i % 2 else "Male", "n": i})
+
+    def test_stats(self):
+        view = self.connection.views["default"]["gender"]
+        self.assertFalse(view.stats()["built"])
+        self.connection.query("default", "gender", key="Female")
+        stats = view.stats()
+        self.assertEquals(stats["rows"], 4)
+        self.assertEquals(stats["distinct_keys"], 2)
+        self.assertTrue(stats["memory_bytes"] > 0)
+        self.assertTrue(stats["build_seconds"] > 0)
+        self.assertEquals(stats["map_latency"]["samples"], 4)
+        self.assertTrue(stats["map_latency"]["p50"] <= stats["map_latency"]["p99"])
+        self.connection.set("stats_4", {"gender": "Male"})
+        self.assertEquals(view.stats()["dirty"], 1)
+
+    def test_explain(self):
+        explanation = self.connection.query("default", "gender", key="Male", include_docs=True, explain=True)
+        self.assertEquals(len(explanation["rows"]), 2)
+        self.assertEquals(explanation["rows_returned"], 2)
+        self.assertEquals(explanation["keys_scanned"], 1)
+        self.assertFalse(explanation["cache_hit"])
+        self.assertEquals(explanation["documents_mapped"], 4)
+        self.assertTrue(explanation["engine_seconds"] > 0)
+        self.assertTrue(explanation["include_docs_seconds"] > 0)
+        explanation = self.connection.query("default", "gender", explain=True)
+        self.assertTrue(explanation["cache_hit"])
+        self.assertEquals(explanation["engine_seconds"], 0)
+        self.assertEquals(explanation["rows_scanned"], 4)
+        self.assertEquals(explanation["keys_scanned"], 2)
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def run_threads(self, target, count=8):
+        errors = list()
+
+        def run(number):
+            try:
+                target(number)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(number,)) for number in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_writes(self):
+        connection = MockCouchbaseConnection()
+
+        def write(number):
+            for i in range(500):
+                connection.set("thread_{0}_{1}".format(number, i), {"n": i})
+                connection.get("thread_{0}_{1}".format(number, i))
+                if i % 2:
+                    connection.delete("thread_{0}_{1}".format(number, i))
+        self.assertEquals(self.run_threads(write), [])
+        self.assertEquals(len(connection.data), 8 * 250)
+
+    def test_one_add_wins(self):
+        connection = MockCouchbaseConnection()
+        errors = self.run_threads(lambda number: connection.add("contended", number), 16)
+        self.assertEquals(len(errors), 15)
+        self.assertTrue(all(isinstance(error, KeyExistsError) for error in errors))
+
+    def test_cas_values_are_unique(self):
+        connection = MockCouchbaseConnection()
+        values = list()
+        self.run_threads(lambda number: values.extend(connection.lock("key_{0}_{1}".format(number, i))
+                                                      for i in range(200)))
+        self.assertEquals(len(set(values)), 8 * 200)
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+        for i in range(5):
+            self.connection.set("key_{0}".format(i), i)
+
+    def test_snapshot_reads(self):
+        data = self.connection.data
+        snapshot = data.snapshot()
+        self.connection.set("key_0", "changed")
+        self.connection.delete("key_1")
+        self.connection.set("key_new", "new")
+        self.connection.set("key_0", "changed again")
+        self.assertEquals(snapshot["key_0"], 0)
+        self.assertEquals(snapshot.get("key_1"), 1)
+        self.assertFalse("key_new" in snapshot)
+        self.assertEquals(sorted(snapshot.items()), [("key_{0}".format(i), i) for i in range(5)])
+        later = data.snapshot()
+        self.assertEquals(later["key_0"], "changed again")
+        self.assertEquals(later.synced, set([vbucket("key_0")]))
+        self.assertEquals(data.versions(), 4)
+        self.assertEquals(len(data.kept), 3)
+        snapshot.release()
+        self.assertEquals(data.versions(), 0)
+        self.connection.set("key_2", "changed")
+        self.assertEquals(later["key_2"], 2)
+        later.release()
+        self.assertEquals((data.versions(), data.pins, data.kept), (0, dict(), set()))
+
+    def test_stable_iteration(self):
+        rows = self.connection.n1ql_query("SELECT RAW META().id FROM bucket")
+        first = next(rows)
+        for i in range(5, 100):
+            self.connection.set("key_{0}".format(i), i)
+        self.connection.delete("key_4" if first != "key_4" else "key_3")
+        self.assertEquals(len([first] + list(rows)), 5)
+        results = self.connection.get_multi(["key_0", "missing"])
+        self.assertEquals(results["key_0"].value, 0)
+        self.assertFalse(results.all_ok)
+        self.assertEquals(self.connection.data.pins, dict())
+
+
+class TestVBuckets(unittest.TestCase):
+
+    def test_partitioning(self):
+        self.assertEquals(vbucket("key_0"), vbucket(u"key_0"))
+        connection = MockCouchbaseConnection()
+        for i in range(2000):
+            connection.set("key_{0}".format(i), i)
+        data = connection.data
+        counts = data.counts()
+        self.assertEquals((len(counts), sum(counts), len(data)), (1024, 2000, 2000))
+        self.assertTrue(len([count for count in counts if count]) > 800)
+        partition = data.partition("key_0")
+        self.assertTrue(connection.key_lock("key_0") is partition.lock)
+        seqno = partition.seqno
+        connection.set("key_0", "changed")
+        self.assertEquals(partition.seqno, seqno + 1)
+        self.assertEquals(sum(other.seqno for other in data.partitions), 2001)
+
+    def test_partition_scans(self):
+        connection = MockCouchbaseConnection()
+        for i in range(100):
+            connection.set("key_{0}".format(i), i)
+        with connection.data.snapshot() as snapshot:
+            connection.delete("key_0")
+            halves = [list(snapshot.iteritems(range(start, 1024, 2))) for start in (0, 1)]
+            self.assertEquals(sorted(halves[0] + halves[1]), sorted(("key_{0}".format(i), i) for i in range(100)))
+            self.assertTrue(all(vbucket(key) % 2 == 0 for key, value in halves[0]))
+        self.assertEquals(connection.data.versions(), 0)
+
+
+class TestCas(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+
+    def test_mutations_check_cas(self):
+        connection = self.connection
+        upcoming = connection.cas_counter
+        first = connection.set("key", 1).cas
+        self.assertEquals((first, connection.cas_counter), (upcoming, upcoming + 1))
+        self.assertEquals(connection.get("key").cas, first)
+        second = connection.replace("key", 2, cas=first).cas
+        self.assertNotEquals(first, second)
+        self.assertRaises(KeyExistsError, connection.set, "key", 3, cas=first)
+        self.assertRaises(KeyExistsError, connection.delete, "key", cas=first)
+        self.assertRaises(NotFoundError, connection.set, "missing", 3, cas=first)
+        self.assertEquals(connection.get_multi(["key"])["key"].cas, second)
+        self.assertTrue(connection.add("other", 1).cas > second)
+        connection.delete("key", cas=second)
+        self.assertRaises(NotFoundError, connection.get, "key")
+
+    def test_lock_cas_is_the_documents(self):
+        connection = self.connection
+        stale = connection.set("key", 1).cas
+        cas = connection.lock("key")
+        self.assertEquals(connection.get("key").cas, cas)
+        self.assertRaises(KeyExistsError, connection.set, "key", 2, cas=stale)
+        connection.unlock("key", cas)
+        connection.set("key", 2, cas=cas)
+
+    def test_optimistic_increments(self):
+        connection = self.connection
+        connection.set("counter", 0)
+
+        def increment():
+            while True:
+                result = connection.get("counter")
+                try:
+                    connection.set("counter", result.value + 1, cas=result.cas)
+                    return
+                except KeyExistsError:
+                    pass
+
+        threads = [threading.Thread(target=lambda: [increment() for i in range(200)]) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(connection.get("counter").value, 800)
+
+
+class TestExpiry(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+        # TTLs over 30 days are unix times, this one is already past
+        self.past = int(time.time()) - 10
+
+    def test_ttls(self):
+        connection = self.connection
+        connection.set("gone", 1, ttl=self.past)
+        self.assertRaises(NotFoundError, connection.get, "gone")
+        connection.add("gone", 2)
+        connection.set("kept", 1, ttl=100)
+        self.assertTrue(99 < connection.data.item("kept").expiry - time.time() <= 100)
+        self.assertEquals(connection.get("kept").value, 1)
+        connection.get("kept", ttl=self.past)
+        self.assertFalse(connection.get_multi(["kept"]).all_ok)
+
+    def test_bounded_reaping(self):
+        connection = self.connection
+        for i in range(40):
+            connection.data.write("key_{0}".format(i), i, expiry=self.past)
+        connection.data.write("key_0", "rewritten")
+        self.assertEquals(connection.reap_expired(10), 10)
+        self.assertEquals(len(connection.data), 30)
+        connection.set("other", 1)
+        self.assertEquals(len(connection.data), 30 - connection.REAP_BATCH + 1)
+        self.assertEquals(connection.reap_expired(), 30 - connection.REAP_BATCH - 1)
+        self.assertEquals(connection.data.keys(), ["other", "key_0"] if vbucket("other") < vbucket("key_0") else ["key_0", "other"])
+        self.assertEquals(connection.data.expiries, list())
+
+    def test_expired_documents_leave_views(self):
+        connection = self.connection
+        connection.design_create("docs", {"views": {"all": {"map": "function (doc, meta) { emit(meta.id, null); }"}}})
+        connection.set("short", {"a": 1})
+        connection.set("long", {"a": 2})
+        self.assertEquals(len(connection.query("docs", "all", stale=False)), 2)
+        connection.set("short", {"a": 1}, ttl=self.past)
+        self.assertEquals([row.docid for row in connection.query("docs", "all", stale=False)], ["long"])
+
+
+class TestCounters(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+
+    def test_incr_and_decr(self):
+        connection = self.connection
+        self.assertRaises(NotFoundError, connection.incr, "counter")
+        self.assertEquals(connection.incr("counter", 10, initial=5).value, 5)
+        result = connection.incr("counter", 10)
+        self.assertEquals((result.value, connection.get("counter").value), (15, 15))
+        self.assertEquals(connection.get("counter").cas, result.cas)
+        self.assertEquals(connection.decr("counter", 20).value, 0)
+        connection.set("string", "41")
+        self.assertEquals(connection.incr("string").value, 42)
+        connection.set("big", 2 ** 64 - 1)
+        self.assertEquals(connection.incr("big").value, 0)
+        connection.set("text", "forty two")
+        self.assertRaises(DeltaBadvalError, connection.incr, "text")
+
+    def test_concurrent_increments(self):
+        connection = self.connection
+        connection.incr("counter", initial=0)
+
+        def increment():
+            for i in range(500):
+                connection.incr("counter")
+        threads = [threading.Thread(target=increment) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(connection.get("counter").value, 2000)
+
+    def test_multi(self):
+        connection = self.connection
+        connection.design_create("counters", {"views": {"all": {"map": "function (doc, meta) { emit(meta.id, doc); }"}}})
+        keys = ["counter_{0}".format(i) for i in range(1000)]
+        results = connection.incr_multi(keys, initial=1)
+        self.assertTrue(results.all_ok)
+        connection.set("text", "not a number")
+        results = connection.incr_multi(dict([(key, 2) for key in keys[:10]] + [("text", 1)]))
+        self.assertFalse(results.all_ok)
+        self.assertEquals((results["counter_0"].value, results["text"]), (3, None))
+        results = connection.decr_multi(keys[:2], 5)
+        self.assertEquals(results["counter_1"].value, 0)
+        rows = dict((row.docid, row.value) for row in connection.query("counters", "all", stale=False))
+        self.assertEquals((rows["counter_0"], rows["counter_9"], rows["counter_10"], len(rows)), (0, 3, 1, 1000))
+
+
+class TestAppend(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+
+    def test_append_and_prepend(self):
+        connection = self.connection
+        self.assertRaises(NotStoredError, connection.append, "log", "line")
+        connection.set("log", "b")
+        connection.append("log", "c")
+        cas = connection.prepend("log", "a").cas
+        self.assertEquals(connection.get("log").value, "abc")
+        self.assertRaises(KeyExistsError, connection.append, "log", "d", cas=cas + 1)
+        connection.append("log", "d", cas=cas)
+        self.assertEquals(connection.get("log").value, "abcd")
+        connection.incr("counter", initial=4)
+        connection.append("counter", "2")
+        self.assertEquals(connection.incr("counter").value, 43)
+
+    def test_snapshots_keep_their_chunks(self):
+        connection = self.connection
+        connection.set("log", "")
+        for i in range(10000):
+            connection.append("log", "x")
+        with connection.data.snapshot() as snapshot:
+            connection.append("log", "y")
+            connection.prepend("log", "z")
+            self.assertEquals(snapshot["log"], "x" * 10000)
+        self.assertEquals(connection.get("log").value, "z" + "x" * 10000 + "y")
+
+    def test_appends_to_indexed_documents(self):
+        connection = self.connection
+        connection.design_create("logs", {"views": {"all": {"map": "function(doc, meta) { emit(meta.id, null); }"}}})
+        connection.set("log", '"')
+        for i in range(1000):
+            connection.append("log", "x")
+        connection.append("log", '"')
+        # nothing read the value yet
+        self.assertEquals(connection.data.item("log").raw.back_size, 1002)
+        rows = list(connection.query("logs", "all", stale=False))
+        self.assertEquals([row.docid for row in rows], ["log"])
+
+
+class TestMultiOperations(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MockCouchbaseConnection()
+        self.connection.design_create("docs", {"views": {"by_n": {"map": "function (doc, meta) { emit(doc.n, null); }"}}})
+
+    def test_set_add_replace_delete(self):
+        connection = self.connection
+        docs = dict(("key_{0}".format(i), {"n": i}) for i in range(1000))
+        results = connection.set_multi(docs)
+        self.assertTrue(results.all_ok)
+        self.assertEquals(connection.get("key_7").cas, results["key_7"].cas)
+        self.assertEquals(len(connection.query("docs", "by_n", stale=False)), 1000)
+        results = connection.add_multi({"key_0": {"n": -1}, "new": {"n": 1000}})
+        self.assertFalse(results.all_ok)
+        self.assertEquals((results["key_0"], connection.get("new").value), (None, {"n": 1000}))
+        results = connection.replace_multi({"key_1": {"n": -1}, "missing": {"n": 0}})
+        self.assertEquals((results["key_1"] is not None, results["missing"]), (True, None))
+        stale = connection.set_multi({"key_2": {"n": 2}})
+        connection.set("key_2", {"n": 2})
+        results = connection.delete_multi(stale)
+        self.assertEquals(results["key_2"], None)
+        connection.delete_multi(["key_{0}".format(i) for i in range(2, 1000)])
+        rows = connection.query("docs", "by_n", stale=False)
+        self.assertEquals(sorted(row.docid for row in rows), ["key_0", "key_1", "new"])
+
+    def test_lock_and_unlock(self):
+        connection = self.connection
+        connection.set_multi({"a": 1, "b": 2})
+        locks = connection.lock_multi(["a", "b"], ttl=10)
+        self.assertEquals(connection.get("a").cas, locks["a"].cas)
+        self.assertFalse(connection.set_multi({"a": 3, "b": 4}).all_ok)
+        self.assertFalse(connection.unlock_multi({"a": locks["b"].cas}).all_ok)
+        self.assertTrue(connection.unlock_multi(locks).all_ok)
+        self.assertTrue(connection.set_multi({"a": 3, "b": 4}).all_ok)
+        self.assertEquals(connection.locks, dict())